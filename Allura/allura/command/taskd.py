@@ -16,6 +16,7 @@
 #       under the License.
 
 import logging
+import logging.config
 import os
 import time
 import Queue
@@ -28,7 +29,7 @@
 import pylons
 from setproctitle import setproctitle, getproctitle
 import tg
-from paste.deploy import loadapp
+from paste.deploy import loadapp, appconfig
 from paste.deploy.converters import asint
 from webob import Request
 
@@ -61,14 +62,43 @@ class TaskdCommand(base.Command):
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
+    parser.add_option('--pools', dest='pools', type='string', default=None,
+                      help='run as a supervisor forking pools of workers, e.g. '
+                      '"index_tasks.*=8,repo_tasks.*=2,*=4".  Each entry is '
+                      'task name patterns (separated by |) and a worker count; '
+                      '"*" takes every task not matched by another pool.  '
+                      'Defaults to the taskd.pools config setting, if any')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=None,
+                      help='claim and run up to this many tasks at a time, '
+                      'which saves round trips for small tasks.  Defaults to '
+                      'the monq.batch_size config setting, or 1')
+
+    # workers exiting sooner than this (in seconds) are restarted with a delay
+    min_worker_lifetime = 10
 
     def command(self):
-        setproctitle('taskd')
-        self.basic_setup()
         self.keep_running = True
         self.restart_when_done = False
+        pools = self.options.pools
+        if pools is None:
+            conf = appconfig('config:%s' % self.args[0], relative_to=os.getcwd())
+            pools = conf.get('taskd.pools')
+        if pools:
+            # fork before basic_setup, so that no mongo connections are
+            # shared between the supervisor and its workers
+            self.supervisor(parse_pools(pools))
+            return
+        setproctitle('taskd')
+        self.basic_setup()
         base.log.info('Starting taskd, pid %s' % os.getpid())
-        signal.signal(signal.SIGHUP, self.graceful_restart)
+        self.setup_signals()
+        only = self.options.only
+        if only:
+            only = only.split(',')
+        self.worker(only=only)
+
+    def setup_signals(self, restart_handler=None):
+        signal.signal(signal.SIGHUP, restart_handler or self.graceful_restart)
         signal.signal(signal.SIGTERM, self.graceful_stop)
         signal.signal(signal.SIGUSR1, self.log_current_task)
         # restore default behavior of not interrupting system calls
@@ -77,7 +107,94 @@ def command(self):
         signal.siginterrupt(signal.SIGHUP, False)
         signal.siginterrupt(signal.SIGTERM, False)
         signal.siginterrupt(signal.SIGUSR1, False)
-        self.worker()
+
+    def supervisor(self, pools):
+        '''Fork and watch over pools of worker processes, restarting any that
+        exit unexpectedly.
+
+        SIGTERM stops all workers gracefully; SIGHUP does the same and then
+        restarts the supervisor itself (which starts fresh workers).
+        '''
+        setproctitle('taskd-supervisor')
+        logging.config.fileConfig(self.args[0].split('#')[0],
+                                  disable_existing_loggers=False)
+        log.info('Starting taskd supervisor, pid %s, pools: %s',
+                 os.getpid(), ', '.join('%s=%s' % ('|'.join(patterns), size)
+                                        for patterns, size in pools))
+        signal.signal(signal.SIGHUP, self.supervisor_restart)
+        signal.signal(signal.SIGTERM, self.supervisor_stop)
+        signal.signal(signal.SIGINT, self.supervisor_stop)
+        signal.siginterrupt(signal.SIGHUP, False)
+        signal.siginterrupt(signal.SIGTERM, False)
+        workers = {}  # pid -> (pool index, start time)
+        respawn_at = [0] * len(pools)
+        while self.keep_running:
+            for i, (patterns, size) in enumerate(pools):
+                running = sum(1 for p, _ in workers.itervalues() if p == i)
+                while running < size and time.time() >= respawn_at[i]:
+                    only, exclude = pool_task_names(pools, i)
+                    pid = self.spawn_worker(only, exclude)
+                    workers[pid] = (i, time.time())
+                    running += 1
+            pid, status = self._reap()
+            if pid:
+                i, started = workers.pop(pid, (None, None))
+                if i is not None and self.keep_running:
+                    log.warn('taskd worker pid %s (pool %s) exited with status %s',
+                             pid, '|'.join(pools[i][0]), status)
+                    if time.time() - started < self.min_worker_lifetime:
+                        # don't spin if workers are crashing on startup
+                        respawn_at[i] = time.time() + self.min_worker_lifetime
+            else:
+                time.sleep(1)
+        log.info('taskd supervisor pid %s stopping %s workers',
+                 os.getpid(), len(workers))
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        while workers:
+            pid, status = self._reap(block=True)
+            workers.pop(pid, None)
+        if self.restart_when_done:
+            log.info('taskd supervisor pid %s restarting itself', os.getpid())
+            os.execv(sys.argv[0], sys.argv)
+
+    def supervisor_restart(self, signum, frame):
+        log.info('taskd supervisor pid %s received signal %s, restarting workers',
+                 os.getpid(), signum)
+        self.keep_running = False
+        self.restart_when_done = True
+
+    def supervisor_stop(self, signum, frame):
+        log.info('taskd supervisor pid %s received signal %s, stopping',
+                 os.getpid(), signum)
+        self.keep_running = False
+
+    def _reap(self, block=False):
+        try:
+            return os.waitpid(-1, 0 if block else os.WNOHANG)
+        except OSError:
+            return 0, 0
+
+    def spawn_worker(self, only, exclude):
+        pid = os.fork()
+        if pid:
+            return pid
+        try:
+            setproctitle('taskd')
+            # the supervisor handles restarts, so a worker just stops on SIGHUP
+            self.setup_signals(restart_handler=self.graceful_stop)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.basic_setup()
+            base.log.info('Starting taskd worker, pid %s, only: %s, exclude: %s',
+                          os.getpid(), only, exclude)
+            self.worker(only=only, exclude=exclude)
+        except:
+            log.exception('taskd worker pid %s failed', os.getpid())
+            os._exit(1)
+        os._exit(0)
 
     def graceful_restart(self, signum, frame):
         base.log.info(
@@ -98,15 +215,13 @@ def log_current_task(self, signum, frame):
         status_log.info(entry)
         base.log.info(entry)
 
-    def worker(self):
+    def worker(self, only=None, exclude=None):
         from allura import model as M
+        from allura.model.monq_model import TaskWakeup
         name = '%s pid %s' % (os.uname()[1], os.getpid())
         wsgi_app = loadapp('config:%s#task' %
                            self.args[0], relative_to=os.getcwd())
         poll_interval = asint(pylons.config.get('monq.poll_interval', 10))
-        only = self.options.only
-        if only:
-            only = only.split(',')
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -117,6 +232,10 @@ def start_response(status, headers, exc_info=None):
         def waitfunc_noq():
             time.sleep(poll_interval)
 
+        def waitfunc_wakeup():
+            # returns as soon as a task is posted, or after poll_interval
+            wakeup.wait(poll_interval)
+
         def check_running(func):
             def waitfunc_checks_running():
                 if self.keep_running:
@@ -125,15 +244,46 @@ def waitfunc_checks_running():
                     raise StopIteration
             return waitfunc_checks_running
 
-        waitfunc = waitfunc_noq
+        if TaskWakeup.enabled():
+            wakeup = TaskWakeup()
+            waitfunc = waitfunc_wakeup
+        else:
+            waitfunc = waitfunc_noq
         waitfunc = check_running(waitfunc)
+        batch_size = self.options.batch_size or asint(
+            pylons.config.get('monq.batch_size', 1))
         while self.keep_running:
             try:
-                while self.keep_running:
+                while self.keep_running and batch_size > 1:
+                    tasks = M.MonQTask.get_batch(
+                        process=name,
+                        limit=batch_size,
+                        only=only,
+                        exclude=exclude)
+                    if not tasks:
+                        try:
+                            waitfunc()
+                        except StopIteration:
+                            break
+                        continue
+                    self.task = tasks
+                    with(proctitle("taskd:batch:{0}".format(len(tasks)))):
+                        request_path = '/--batch--/%s/' % tasks[0]._id
+                        r = Request.blank(request_path,
+                                          base_url=tg.config['base_url'].rstrip(
+                                              '/') + request_path,
+                                          environ={'task': tasks[0],
+                                                   'tasks': tasks,
+                                                   'nocapture': self.options.nocapture,
+                                                   })
+                        list(wsgi_app(r.environ, start_response))
+                        self.task = None
+                while self.keep_running and batch_size <= 1:
                     self.task = M.MonQTask.get(
                         process=name,
                         waitfunc=waitfunc,
-                        only=only)
+                        only=only,
+                        exclude=exclude)
                     if self.task:
                         with(proctitle("taskd:{0}:{1}".format(
                                 self.task.task_name, self.task._id))):
@@ -162,6 +312,32 @@ def waitfunc_checks_running():
             os.execv(sys.argv[0], sys.argv)
 
 
+def parse_pools(spec):
+    '''Parse a worker pool spec like ``"index_tasks.*=8,repo_tasks.*=2,*=4"``
+    into a list of ``(patterns, size)`` tuples.'''
+    pools = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        patterns, _, size = entry.rpartition('=')
+        if not patterns:
+            raise ValueError('Invalid taskd pool %r, expected patterns=size' % entry)
+        pools.append(([p.strip() for p in patterns.split('|')], int(size)))
+    return pools
+
+
+def pool_task_names(pools, index):
+    '''Return the ``(only, exclude)`` task name lists for the workers of one
+    pool.  A ``*`` pool takes everything not claimed by the other pools.'''
+    patterns = pools[index][0]
+    if '*' not in patterns:
+        return patterns, None
+    exclude = [p for i, (pats, _) in enumerate(pools) if i != index
+               for p in pats if p != '*']
+    return None, exclude or None
+
+
 class TaskCommand(base.Command):
     summary = 'Task command'
     parser = base.Command.standard_parser(verbose=True)
@@ -210,6 +386,9 @@ def _purge(self):
         base.log.info('Purge complete/forget tasks')
         M.MonQTask.query.remove(
             dict(state='complete', result_type='forget'))
+        days = int(tg.config.get('monq.metrics.retention_days', 30))
+        base.log.info('Purge task metrics older than %s days', days)
+        M.MonQTaskMetrics.clear_old(datetime.utcnow() - timedelta(days=days))
 
     def _timeout(self):
         '''Reset tasks that have been busy too long to 'ready' state'''
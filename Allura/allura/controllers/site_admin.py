@@ -566,6 +566,21 @@ def index(self, page_num=1, minutes=10, state=None, task_name=None, host=None):
             window_end=end_dt,
         )
 
+    @expose('jinja:allura:templates/site_admin_task_metrics.html')
+    @without_trailing_slash
+    def metrics(self, hours=24, **kw):
+        """Show per-task-name queue wait, run time, error rate and backlog"""
+        try:
+            hours = int(hours)
+        except ValueError:
+            hours = 24
+        since = datetime.utcnow() - timedelta(hours=hours)
+        return dict(
+            metrics=M.MonQTaskMetrics.summary(since),
+            hours=hours,
+            now=datetime.utcnow(),
+        )
+
     @expose('jinja:allura:templates/site_admin_task_view.html')
     @without_trailing_slash
     def view(self, task_id):
@@ -28,6 +28,12 @@ class TaskController(object):
     def __call__(self, environ, start_response):
         task = environ['task']
         nocapture = environ['nocapture']
+        tasks = environ.get('tasks')
+        if tasks:
+            from allura import model as M
+            M.MonQTask.run_batch(tasks, nocapture=nocapture)
+            start_response('200 OK', [])
+            return []
         result = task(restore_context=False, nocapture=nocapture)
         start_response('200 OK', [])
         return [result]
@@ -30,6 +30,7 @@
 from subprocess import Popen, PIPE
 import os
 import time
+import threading
 import traceback
 
 import activitystream
@@ -52,6 +53,7 @@
 
 import allura.tasks.event_tasks
 from allura import model as M
+from allura.lib.markdown_cache import MarkdownRenderCache, MacroOutputCache
 from allura.lib.markdown_extensions import (
     ForgeExtension,
     CommitMessageExtension,
@@ -61,7 +63,7 @@
 from allura.lib import gravatar, plugin, utils
 from allura.lib import helpers as h
 from allura.lib.widgets import analytics
-from allura.lib.security import Credentials
+from allura.lib.security import Credentials, DecisionCache
 from allura.lib.solr import MockSOLR, make_solr_from_config
 from allura.model.session import artifact_orm_session
 
@@ -70,6 +72,49 @@
 
 class ForgeMarkdown(markdown.Markdown):
 
+    # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+    bugfix_rev = 3
+
+    def __init__(self, *args, **kwargs):
+        markdown.Markdown.__init__(self, *args, **kwargs)
+        # set by extensions when the html depends on more than the source
+        # text, e.g. on artifacts found by links or on macros
+        self.context_dependent = False
+        # set while rendering a skeleton with placeholders for macros
+        self.defer_macros = False
+        self.render_cache_key = self._render_cache_key(
+            kwargs.get('extensions', []), kwargs.get('output_format'))
+
+    @staticmethod
+    def _render_cache_key(extensions, output_format):
+        """Return a string identifying the configuration of this instance for
+        the shared render cache, or None if it can't be shared.
+
+        Extension objects must provide a ``render_cache_key()`` identifying
+        their own configuration.
+        """
+        keys = []
+        for ext in extensions:
+            if isinstance(ext, basestring):
+                keys.append(ext)
+            elif hasattr(ext, 'render_cache_key'):
+                keys.append('%s.%s(%s)' % (
+                    ext.__class__.__module__, ext.__class__.__name__,
+                    ext.render_cache_key()))
+            else:
+                return None
+        return '%s:%s' % (output_format, ','.join(keys))
+
+    def _render_cache(self):
+        if self.render_cache_key is None:
+            return None
+        try:
+            from pylons import app_globals as g
+            return g.markdown_render_cache
+        except (TypeError, AttributeError):
+            # no globals outside of an app (or cache not configured)
+            return None
+
     def convert(self, source, render_limit=True):
         if render_limit and len(source) > asint(config.get('markdown_render_max_length', 40000)):
             # if text is too big, markdown can take a long time to process it,
@@ -77,8 +122,40 @@ def convert(self, source, render_limit=True):
             log.info('Text is too big. Skipping markdown processing')
             escaped = cgi.escape(h.really_unicode(source))
             return h.html.literal(u'<pre>%s</pre>' % escaped)
+        render_cache = self._render_cache()
+        macros = self.inlinePatterns.get('macro') if '[[' in source else None
+        if macros is not None and not macros.can_defer(source):
+            render_cache = None
+        # Text with macros is cached as a skeleton, and the macros are
+        # evaluated on every convert.
+        defer_macros = bool(render_cache and macros is not None)
+        if render_cache:
+            # links are rewritten according to these settings
+            config_key = '%s;%s;%s' % (self.render_cache_key,
+                                       config.get('nofollow_exempt_domains', ''),
+                                       config.get('base_url', ''))
+            key = render_cache.key(source, config_key, self.bugfix_rev)
+            html = render_cache.get(key)
+            if html is not None:
+                if defer_macros:
+                    return macros.expand(html)
+                return h.html.literal(html)
         try:
-            return markdown.Markdown.convert(self, source)
+            self.context_dependent = False
+            self.defer_macros = defer_macros
+            postprocessors = self.postprocessors
+            if defer_macros:
+                self.postprocessors = macros.skeleton_postprocessors()
+            try:
+                html = markdown.Markdown.convert(self, source)
+            finally:
+                self.defer_macros = False
+                self.postprocessors = postprocessors
+            if render_cache and not self.context_dependent:
+                render_cache.set(key, html)
+            if defer_macros:
+                return macros.expand(html)
+            return html
         except Exception:
             log.info('Invalid markdown: %s  Upwards trace is %s', source,
                      ''.join(traceback.format_stack()), exc_info=True)
@@ -104,13 +181,13 @@ def cached_convert(self, artifact, field_name):
                 field_name, artifact.__class__.__name__)
             return self.convert(source_text)
 
-        bugfix_rev = 3  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
         md5 = None
         # If a cached version exists and it is valid, return it.
         if cache.md5 is not None:
             md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
-            if cache.md5 == md5 and getattr(cache, 'fix7528', False) == bugfix_rev:
-                return h.html.literal(cache.html)
+            html = self.fresh_cache_html(cache, md5)
+            if html is not None:
+                return h.html.literal(html)
 
         # Convert the markdown and time the result.
         start = time.time()
@@ -130,13 +207,24 @@ def cached_convert(self, artifact, field_name):
             if md5 is None:
                 md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
             cache.md5, cache.html, cache.render_time = md5, html, render_time
-            cache.fix7528 = bugfix_rev  # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
+            cache.fix7528 = self.bugfix_rev  # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
 
             # Prevent cache creation from updating the mod_date timestamp.
             _session = artifact_orm_session._get()
             _session.skip_mod_date = True
         return html
 
+    @classmethod
+    def fresh_cache_html(cls, cache, md5):
+        """Return the html of MarkdownCache ``cache`` if it is valid for
+        source text with the md5 hexdigest ``md5``, otherwise None.
+
+        """
+        if cache and cache.get('md5') is not None and cache['md5'] == md5 and \
+                cache.get('fix7528', False) == cls.bugfix_rev:
+            return cache['html']
+        return None
+
 
 class NeighborhoodCache(object):
     """Cached Neighborhood objects by url_prefix.
@@ -184,6 +272,7 @@ def __init__(self):
             return
         self.allura_templates = pkg_resources.resource_filename(
             'allura', 'templates')
+        self._markdown_pool = threading.local()
         # Setup SOLR
         self.solr_server = aslist(config.get('solr.server'), ',')
         # skip empty strings in case of extra commas
@@ -312,6 +401,12 @@ def __missing__(self, key):
         duration = asint(config.get('neighborhood.cache.duration', 0))
         self.neighborhood_cache = NeighborhoodCache(duration)
 
+        # Shared cache of rendered markdown
+        self.markdown_render_cache = MarkdownRenderCache.from_config(
+            config, self.entry_points['allura.markdown_render_cache'])
+        self.macro_cache = MacroOutputCache.from_config(config)
+        self.access_decision_cache = DecisionCache.from_config(config)
+
         # Set listeners to update stats
         statslisteners = []
         for name, ep in self.entry_points['stats'].iteritems():
@@ -448,6 +543,16 @@ def forge_markdown(self, **kwargs):
     def markdown(self):
         return self.forge_markdown()
 
+    def pooled_markdown(self):
+        '''return a markdown.Markdown object like :attr:`markdown`, shared by
+        all callers in the current thread instead of being built for each
+        call.  It is reset, so don't hold on to it across calls.'''
+        md = getattr(self._markdown_pool, 'md', None)
+        if md is None:
+            md = self._markdown_pool.md = self.forge_markdown()
+        md.reset()
+        return md
+
     @property
     def markdown_wiki(self):
         if c.project.is_nbhd_project:
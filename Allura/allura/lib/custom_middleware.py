@@ -30,6 +30,7 @@
 import pysolr
 
 from allura.lib import helpers as h
+from allura.lib.security import Credentials
 import allura.model.repository
 
 log = logging.getLogger(__name__)
@@ -340,6 +341,12 @@ def timers(self):
     def before_logging(self, stat_record):
         if hasattr(c, "app") and hasattr(c.app, "config"):
             stat_record.add('request_category', c.app.config.tool_name.lower())
+        try:
+            cred = Credentials.get()
+            stat_record.add('has_access_cache', dict(
+                hits=cred.decision_hits, misses=cred.decision_misses))
+        except TypeError:
+            pass  # no credentials registered for this request
         return stat_record
 
     def entry_point_timers(self):
@@ -50,16 +50,32 @@ def myotherfunc():
         # No email notifications will be sent for c.project during this task
         pass
 
+    @task(coalesce=utils.union_first_arg,
+          coalesce_barriers=['mymodule.unindex_things'])
+    def index_things(ids, update=True):
+        # Posting this again before an earlier post has started merges the
+        # ids into the waiting task (if the other arguments match), instead
+        # of queueing a new one.  Not if an unindex_things task for any of
+        # the ids was posted in between, so the two don't run out of order.
+        pass
+
+    index_things.post(chunk, coalesce=False)  # always a task of its own
+
     """
     def task_(func):
         def post(*args, **kwargs):
             delay = kwargs.pop('delay', 0)
+            coalesce = kwargs.pop('coalesce', True)
             project = getattr(c, 'project', None)
             cm = (h.notifications_disabled if project and
                   kw.get('notifications_disabled') else h.null_contextmanager)
+            merge = kw.get('coalesce') if coalesce else None
+            coalesce_key = repr(sorted(kwargs.items())) if merge else None
             with cm(project):
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay)
+                return M.MonQTask.post(func, args, kwargs, delay=delay,
+                                       coalesce_key=coalesce_key, merge=merge,
+                                       barriers=kw.get('coalesce_barriers'))
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
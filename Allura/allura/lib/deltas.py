@@ -0,0 +1,110 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""Compressed deltas between documents, as stored by
+:class:`allura.model.artifact.Snapshot`.
+
+A delta lists the top level fields of the new document which were added,
+changed or removed.  Long text fields are stored as line based patches (runs
+of lines copied from the base, and new text), everything else as the new
+value.  The delta is BSON encoded and zlib compressed.
+"""
+
+import difflib
+import zlib
+
+import bson
+
+
+# text shorter than this is stored whole rather than patched
+PATCH_MIN_LENGTH = 256
+
+
+def encode(base, doc):
+    """Return the delta from the document ``base`` to ``doc``, as a
+    :class:`bson.Binary`."""
+    changed = {}
+    patched = {}
+    for key, value in doc.iteritems():
+        if key in base and _same(base[key], value):
+            continue
+        old = base.get(key)
+        if (isinstance(value, basestring) and isinstance(old, basestring) and
+                len(value) >= PATCH_MIN_LENGTH):
+            patched[key] = _diff(_unicode(old), _unicode(value))
+        else:
+            changed[key] = value
+    removed = [key for key in base if key not in doc]
+    delta = dict(changed=changed, patched=patched, removed=removed)
+    return bson.Binary(zlib.compress(bson.BSON.encode(delta)))
+
+
+def apply(base, delta):
+    """Return the document ``delta`` was encoded from, given the same
+    ``base``.  ``base`` is not modified; values which didn't change are
+    shared with it."""
+    delta = bson.BSON(zlib.decompress(delta)).decode()
+    doc = dict((key, value) for key, value in base.iteritems()
+               if key not in delta['removed'])
+    doc.update(delta['changed'])
+    for key, ops in delta['patched'].iteritems():
+        doc[key] = _patch(_unicode(base[key]), ops)
+    return doc
+
+
+def size(doc):
+    """The size of ``doc`` when stored whole, to compare deltas to."""
+    return len(bson.BSON.encode(doc))
+
+
+def _same(old, new):
+    # a str and a unicode value differ, so the new type is kept (and they
+    # can't be compared without decoding the str)
+    if isinstance(old, basestring) and isinstance(new, basestring) and \
+            type(old) is not type(new):
+        return False
+    return old == new
+
+
+def _unicode(text):
+    if isinstance(text, str):
+        return text.decode('utf-8')
+    return text
+
+
+def _diff(old, new):
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j1 < j2:
+            ops.append(u''.join(new_lines[j1:j2]))
+    return ops
+
+
+def _patch(old, ops):
+    old_lines = old.splitlines(True)
+    parts = []
+    for op in ops:
+        if isinstance(op, list):
+            parts.extend(old_lines[op[0]:op[1]])
+        else:
+            parts.append(op)
+    return u''.join(parts)
@@ -23,6 +23,7 @@
 import oembed
 import jinja2
 from operator import attrgetter
+from contextlib import contextmanager
 from urlparse import urlparse, urlunparse
 
 import pymongo
@@ -41,10 +42,25 @@
 
 class macro(object):
 
-    def __init__(self, context=None):
+    """Register a macro function.
+
+    :param context: only run the macro in markdown rendered for this context
+    :param cache: how the output of the macro may be shared between
+        requests: None (never, the default), 'project' (by everyone viewing
+        the same project) or 'user' (by the same user viewing the same
+        project).  Cached output is also keyed by the macro arguments.
+    :param cache_ttl: seconds cached output is used for
+    """
+
+    def __init__(self, context=None, cache=None, cache_ttl=300):
+        assert cache in (None, 'project', 'user'), cache
         self._context = context
+        self._cache = cache
+        self._cache_ttl = cache_ttl
 
     def __call__(self, func):
+        func.macro_cache = self._cache
+        func.macro_cache_ttl = self._cache_ttl
         _macros[func.__name__] = (func, self._context)
         return func
 
@@ -70,7 +86,7 @@ def __call__(self, s):
                     if '=' not in t:
                         return '[-%s: missing =-]' % ' '.join(parts)
                 args = dict(t.split('=', 1) for t in parts[1:])
-                response = macro(**h.encode_keys(args))
+                response = call_macro(macro, args)
                 return response
             except (ValueError, TypeError) as ex:
                 log.warn('macro error.  Upwards stack is %s',
@@ -90,7 +106,52 @@ def _lookup_macro(self, s):
             return None
 
 
-@macro('neighborhood-wiki')
+def call_macro(macro, args):
+    """Return the output of ``macro`` called with ``args``, from
+    ``g.macro_cache`` if the macro's cache policy allows it.
+
+    Widget resources registered by the macro are registered again when its
+    output comes from the cache.
+    """
+    policy = getattr(macro, 'macro_cache', None)
+    cache = g.macro_cache if policy else None
+    if cache is None:
+        return macro(**h.encode_keys(args))
+    key = [macro.__module__, macro.__name__, tuple(sorted(args.items())),
+           getattr(c.project, '_id', None)]
+    if policy == 'user':
+        key.append(getattr(c.user, '_id', None))
+    key = tuple(key)
+    cached = cache.get(key)
+    if cached is not None:
+        response, resources = cached
+        for resource in resources:
+            g.resource_manager.register(resource)
+        return response
+    with _recording_resources() as resources:
+        response = macro(**h.encode_keys(args))
+    cache.set(key, (response, resources), macro.macro_cache_ttl)
+    return response
+
+
+@contextmanager
+def _recording_resources():
+    """Record what is registered with the request's resource manager."""
+    resource_manager = g.resource_manager
+    register = resource_manager.register
+    resources = []
+
+    def recording_register(resource, *args, **kwargs):
+        resources.append(resource)
+        return register(resource, *args, **kwargs)
+    resource_manager.register = recording_register
+    try:
+        yield resources
+    finally:
+        resource_manager.register = register
+
+
+@macro('neighborhood-wiki', cache='project')
 def neighborhood_feeds(tool_name, max_number=5, sort='pubdate'):
     from allura import model as M
     from allura.lib.widgets.macros import NeighborhoodFeeds
@@ -112,7 +173,7 @@ def neighborhood_feeds(tool_name, max_number=5, sort='pubdate'):
     return response
 
 
-@macro('neighborhood-wiki')
+@macro('neighborhood-wiki', cache='user', cache_ttl=60)
 def neighborhood_blog_posts(max_number=5, sort='timestamp', summary=False):
     from forgeblog import model as BM
     from allura.lib.widgets.macros import BlogPosts
@@ -136,7 +197,7 @@ def neighborhood_blog_posts(max_number=5, sort='timestamp', summary=False):
     return response
 
 
-@macro()
+@macro(cache='user', cache_ttl=60)
 def project_blog_posts(max_number=5, sort='timestamp', summary=False, mount_point=None):
     from forgeblog import model as BM
     from allura.lib.widgets.macros import BlogPosts
@@ -265,7 +326,7 @@ def get_projects_for_macro(
     return response
 
 
-@macro('neighborhood-wiki')
+@macro('neighborhood-wiki', cache='user')
 def projects(category=None, sort='last_updated',
              show_total=False, limit=100, labels='', award='', private=False,
              columns=1, show_proj_icon=True, show_download_button=False, show_awards_banner=True,
@@ -280,7 +341,7 @@ def projects(category=None, sort='last_updated',
         initial_q=initial_q)
 
 
-@macro('userproject-wiki')
+@macro('userproject-wiki', cache='user')
 def my_projects(category=None, sort='last_updated',
                 show_total=False, limit=100, labels='', award='', private=False,
                 columns=1, show_proj_icon=True, show_download_button=False, show_awards_banner=True,
@@ -304,7 +365,7 @@ def my_projects(category=None, sort='last_updated',
         initial_q=initial_q)
 
 
-@macro()
+@macro(cache='project')
 def project_screenshots():
     from allura.lib.widgets.project_list import ProjectScreenshots
     ps = ProjectScreenshots()
@@ -313,7 +374,7 @@ def project_screenshots():
     return response
 
 
-@macro()
+@macro(cache='project', cache_ttl=3600)
 def gittip_button(username):
     from allura.lib.widgets.macros import GittipButton
     button = GittipButton(username=username)
@@ -410,7 +471,7 @@ def img(src=None, **kw):
         return '<img src="./attachment/%s" %s/>' % (src, ' '.join(attrs))
 
 
-@macro()
+@macro(cache='project')
 def project_admins():
     admins = c.project.users_with_role('Admin')
     from allura.lib.widgets.macros import ProjectAdmins
@@ -424,7 +485,7 @@ def project_admins():
     return response
 
 
-@macro()
+@macro(cache='project')
 def members(limit=20):
     from allura.lib.widgets.macros import Members
     limit = asint(limit)
@@ -444,7 +505,7 @@ def members(limit=20):
     return response
 
 
-@macro()
+@macro(cache='project', cache_ttl=3600)
 def embed(url=None):
     consumer = oembed.OEmbedConsumer()
     endpoint = oembed.OEmbedEndpoint(
@@ -16,8 +16,12 @@
 #       under the License.
 
 import re
+import time
+import socket
 import logging
 import smtplib
+from threading import Thread, Lock
+from Queue import Queue
 import email.feedparser
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
@@ -216,8 +220,20 @@ def isvalid(addr):
 
 class SMTPClient(object):
 
+    '''An SMTP session which is kept open between messages.
+
+    The connection is opened on the first send and reused after that.  If it
+    has been idle for more than ``smtp_keepalive`` seconds it is checked with
+    a NOOP first, and it is replaced after ``smtp_max_messages`` messages
+    (0, the default, for no limit).  A send which fails because of the
+    connection is retried once over a new one; one the server refuses is
+    not.
+    '''
+
     def __init__(self):
         self._client = None
+        self._sent = 0
+        self._last_used = None
 
     def sendmail(
             self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message,
@@ -253,17 +269,74 @@ def sendmail(
             log.warning('No valid addrs in %s, so not sending mail',
                         map(unicode, addrs))
             return
+        self._check_connection()
         try:
             self._client.sendmail(
                 config.return_path,
                 smtp_addrs,
                 content)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                smtplib.SMTPDataError):
+            # the server answered, so the session is fine but retrying
+            # wouldn't help
+            raise
         except:
             self._connect()
             self._client.sendmail(
                 config.return_path,
                 smtp_addrs,
                 content)
+        self._sent += 1
+        self._last_used = time.time()
+
+    def send_batch(self, messages):
+        '''Send several messages over this session.
+
+        :param messages: keyword dicts for :meth:`sendmail`
+
+        Every message is tried even if an earlier one fails; the first error
+        is raised at the end.
+        '''
+        error = None
+        for message in messages:
+            try:
+                self.sendmail(**message)
+            except Exception as e:
+                log.exception('Error sending mail %s to %s',
+                              message.get('message_id'), message.get('addrs'))
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def close(self):
+        if self._client is not None:
+            try:
+                self._client.quit()
+            except Exception:
+                pass
+        self._client = None
+
+    def _check_connection(self):
+        if self._client is None:
+            self._connect()
+            return
+        max_messages = asint(tg.config.get('smtp_max_messages', 0))
+        keepalive = float(tg.config.get('smtp_keepalive', 30))
+        if max_messages and self._sent >= max_messages:
+            log.debug('Sent %s messages, reconnecting', self._sent)
+            self.close()
+            self._connect()
+        elif keepalive and self._last_used and \
+                time.time() - self._last_used > keepalive:
+            try:
+                code = self._client.noop()[0]
+            except (smtplib.SMTPException, socket.error):
+                code = None
+            if code in (None, 421):
+                log.debug('SMTP connection went away while idle, reconnecting')
+                self.close()
+                self._connect()
 
     def _connect(self):
         if asbool(tg.config.get('smtp_ssl', False)):
@@ -278,9 +351,76 @@ def _connect(self):
                 asint(tg.config.get('smtp_port', 465)),
                 timeout=float(tg.config.get('smtp_timeout', 10)),
             )
+        # start TLS before logging in, so the credentials are encrypted
+        if asbool(tg.config.get('smtp_tls', False)):
+            smtp_client.starttls()
         if tg.config.get('smtp_user', None):
             smtp_client.login(tg.config['smtp_user'],
                               tg.config['smtp_password'])
-        if asbool(tg.config.get('smtp_tls', False)):
-            smtp_client.starttls()
         self._client = smtp_client
+        self._sent = 0
+        self._last_used = time.time()
+
+
+class SMTPSenderPool(object):
+
+    '''Send mail from a fixed number of threads, each holding its own
+    :class:`SMTPClient` connection.
+
+    Each job is a list of keyword dicts for :meth:`SMTPClient.sendmail`; the
+    messages of one job are sent in order by the same thread, since they may
+    share MIME parts.  Jobs are queued with a bounded queue, so
+    :meth:`submit` blocks while all the senders are busy.
+    '''
+
+    def __init__(self, concurrency):
+        self.concurrency = max(1, concurrency)
+        self.sent = 0
+        self.errors = 0
+        self._lock = Lock()
+        self._jobs = Queue(maxsize=self.concurrency * 2)
+        self._globals = None
+        try:
+            self._globals = g._current_obj()
+        except TypeError:  # no app globals registered for this thread
+            pass
+        self._threads = []
+        for i in range(self.concurrency):
+            t = Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, messages):
+        self._jobs.put(messages)
+
+    def join(self):
+        '''Wait for all submitted mail to be sent and stop the senders'''
+        for t in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _run(self):
+        if self._globals is not None:
+            g._push_object(self._globals)
+        client = SMTPClient()
+        while True:
+            messages = self._jobs.get()
+            if messages is None:
+                break
+            for message in messages:
+                try:
+                    client.sendmail(**message)
+                except Exception:
+                    with self._lock:
+                        self.errors += 1
+                    log.exception('Error sending mail %s to %s',
+                                  message.get('message_id'), message.get('addrs'))
+                else:
+                    with self._lock:
+                        self.sent += 1
+        client.close()
+        if self._globals is not None:
+            g._pop_object(self._globals)
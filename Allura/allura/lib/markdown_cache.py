@@ -0,0 +1,196 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+import pymongo
+from paste.deploy.converters import asint
+
+from allura.lib import helpers as h
+
+log = logging.getLogger(__name__)
+
+
+class MarkdownRenderCache(object):
+
+    """Shared cache of markdown rendered to html, used by every
+    :class:`~allura.lib.app_globals.ForgeMarkdown`.
+
+    Entries are content-addressed: the key is a hash of the markdown source,
+    the configuration of the markdown instance which rendered it and
+    :attr:`ForgeMarkdown.bugfix_rev`, so identical text (templated
+    descriptions, repeated commit messages) is only rendered once, and
+    entries never need to be invalidated.
+
+    Lookups go to an in-process LRU of ``size`` entries first, then to the
+    optional ``store``, an object with memcached-style ``get(key)`` and
+    ``set(key, html)`` methods, e.g. :class:`MongoMarkdownRenderStore`.
+    """
+
+    def __init__(self, size=1000, store=None):
+        self.size = size
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, config, entry_points):
+        """Return a cache configured by ``markdown_render_cache.*`` settings,
+        or None if it is disabled.
+
+        ``markdown_render_cache.store`` names an entry point in
+        ``entry_points`` (the ``allura.markdown_render_cache`` group), which
+        is instantiated with ``config``.
+        """
+        size = asint(config.get('markdown_render_cache.size', 1000))
+        method = config.get('markdown_render_cache.store')
+        store = entry_points[method](config) if method else None
+        if not size and not store:
+            return None
+        return cls(size, store)
+
+    @staticmethod
+    def key(source, config_key, bugfix_rev):
+        sha = hashlib.sha1()
+        sha.update('%s\0%s\0' % (bugfix_rev, config_key))
+        sha.update(h.really_unicode(source).encode('utf-8'))
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Return the html cached under ``key``, or None."""
+        with self._lock:
+            html = self._data.pop(key, None)
+            if html is not None:
+                self._data[key] = html
+        if html is None and self.store is not None:
+            try:
+                html = self.store.get(key)
+            except Exception:
+                log.exception('Error reading markdown render cache store')
+                html = None
+            if html is not None:
+                self._add(key, html)
+        if html is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return html
+
+    def set(self, key, html):
+        self._add(key, html)
+        if self.store is not None:
+            try:
+                self.store.set(key, html)
+            except Exception:
+                log.exception('Error writing markdown render cache store')
+
+    def _add(self, key, html):
+        if not self.size:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = html
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+
+class MongoMarkdownRenderStore(object):
+
+    """Second tier for :class:`MarkdownRenderCache`, shared by all processes.
+
+    Rendered html is kept in a capped collection, so the store is bounded by
+    ``markdown_render_cache.mongo.size`` bytes and the oldest renders are
+    dropped first.
+
+    Enabled with ``markdown_render_cache.store = mongo``.
+    """
+    collection_name = 'markdown_render_cache'
+
+    def __init__(self, config):
+        self.capped_size = asint(
+            config.get('markdown_render_cache.mongo.size', 100 * 1024 * 1024))
+        self._collection = None
+
+    def collection(self):
+        if self._collection is None:
+            from allura.model.session import main_doc_session
+            db = main_doc_session.db
+            if self.collection_name not in db.collection_names():
+                try:
+                    db.create_collection(
+                        self.collection_name,
+                        capped=True,
+                        size=self.capped_size)
+                except pymongo.errors.CollectionInvalid:
+                    pass  # created concurrently by another process
+            self._collection = db[self.collection_name]
+        return self._collection
+
+    def get(self, key):
+        doc = self.collection().find_one({'_id': key}, {'html': 1})
+        return doc['html'] if doc else None
+
+    def set(self, key, html):
+        try:
+            self.collection().insert(
+                {'_id': key, 'html': unicode(html)}, w=0)
+        except pymongo.errors.DuplicateKeyError:
+            pass  # rendered concurrently by another process
+
+
+class MacroOutputCache(object):
+
+    """In-process cache of macro output, holding up to ``size`` entries,
+    each until its own expiry.  Used by :mod:`allura.lib.macro` for macros
+    declaring a ``cache`` policy.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Return a cache of ``markdown_render_cache.macros.size`` entries,
+        or None if it is disabled."""
+        size = asint(config.get('markdown_render_cache.macros.size', 0))
+        return cls(size) if size else None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
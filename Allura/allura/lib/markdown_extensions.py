@@ -39,6 +39,14 @@
 )
 
 MACRO_PATTERN = r'\[\[([^\]\[]+)\]\]'
+# placeholder for a macro in a skeleton render, holding the hex encoded macro
+# text; must survive all processing of text by markdown
+MACRO_PLACEHOLDER = 'ALLURAMACRO%sENDMACRO'
+MACRO_PLACEHOLDER_RE = re.compile(r'(<p>)?ALLURAMACRO([0-9a-f]*)ENDMACRO(</p>)?')
+# postprocessors of ForgeExtension, run on skeletons after their macros are
+# expanded
+EXPAND_POSTPROCESSORS = ('sanitize_html', 'rewrite_relative_links',
+                         'add_custom_class', 'mark_safe')
 
 
 class CommitMessageExtension(markdown.Extension):
@@ -75,6 +83,7 @@ def extendMarkdown(self, md, md_globals):
         # remove default preprocessors and add our own
         md.preprocessors.clear()
         md.preprocessors['trac_refs'] = PatternReplacingProcessor(TracRef1(), TracRef2(), TracRef3(self.app))
+        md.preprocessors['trac_refs'].markdown = md
         # remove all inlinepattern processors except short refs and links
         md.inlinePatterns.clear()
         md.inlinePatterns["link"] = markdown.inlinepatterns.LinkPattern(markdown.inlinepatterns.LINK_RE, md)
@@ -94,6 +103,9 @@ def extendMarkdown(self, md, md_globals):
     def reset(self):
         self.forge_link_tree_processor.reset()
 
+    def render_cache_key(self):
+        return getattr(getattr(self.app, 'config', None), '_id', None)
+
 
 class Pattern(object):
 
@@ -104,6 +116,8 @@ class Pattern(object):
 
     """
     BEGIN, END = r'(^|\b|\s)', r'($|\b|\s)'
+    # replacements depend on artifacts looked up, not only on the text
+    context_dependent = False
 
     def sub(self, line):
         return self.pattern.sub(self.repl, line)
@@ -125,6 +139,7 @@ class TracRef1(Pattern):
 
     """
     pattern = re.compile(r'(?<!\[|\w)([#r]\d+)(?!\]|\w)')
+    context_dependent = True
 
     def repl(self, match):
         shortlink = M.Shortlink.lookup(match.group(1))
@@ -145,6 +160,7 @@ class TracRef2(Pattern):
     """
     pattern = re.compile(
         Pattern.BEGIN + r'((comment:(\d+):)?(ticket:)(\d+))' + Pattern.END)
+    context_dependent = True
 
     def repl(self, match):
         shortlink = M.Shortlink.lookup('#' + match.group(6))
@@ -228,8 +244,11 @@ def __init__(self, *patterns):
 
     def run(self, lines):
         new_lines = []
+        md = getattr(self, 'markdown', None)
         for line in lines:
             for pattern in self.patterns:
+                if md and pattern.context_dependent and pattern.pattern.search(line):
+                    md.context_dependent = True
                 line = pattern.sub(line)
             new_lines.append(line)
         return new_lines
@@ -272,6 +291,9 @@ def extendMarkdown(self, md, md_globals):
     def reset(self):
         self.forge_link_tree_processor.reset()
 
+    def render_cache_key(self):
+        return '%s,%s,%s' % (self._use_wiki, self._is_email, self._macro_context)
+
 
 class ForgeLinkPattern(markdown.inlinepatterns.LinkPattern):
 
@@ -323,6 +345,9 @@ def _expand_alink(self, link, is_link_with_brackets):
             classes = 'alink'
         href = link
         shortlink = M.Shortlink.lookup(link)
+        if shortlink or is_link_with_brackets:
+            # the html depends on which artifacts exist
+            self.markdown.context_dependent = True
         if shortlink and shortlink.ref and not getattr(shortlink.ref.artifact, 'deleted', False):
             href = shortlink.url
             if getattr(shortlink.ref.artifact, 'is_closed', False):
@@ -382,10 +407,47 @@ def __init__(self, *args, **kwargs):
         markdown.inlinepatterns.Pattern.__init__(self, *args, **kwargs)
 
     def handleMatch(self, m):
+        if getattr(self.markdown, 'defer_macros', False):
+            return MACRO_PLACEHOLDER % m.group(2).encode('utf-8').encode('hex')
+        self.markdown.context_dependent = True
         html = self.macro(m.group(2))
         placeholder = self.markdown.htmlStash.store(html)
         return placeholder
 
+    def can_defer(self, source):
+        """Can macros in ``source`` be deferred to :meth:`expand`?  Not if
+        the text itself looks like it has placeholders."""
+        return 'ALLURAMACRO' not in source
+
+    def skeleton_postprocessors(self):
+        """The postprocessors of a render with ``defer_macros`` set, which
+        leaves out those :meth:`expand` runs on the whole document."""
+        postprocessors = markdown.odict.OrderedDict()
+        for name, pp in self.markdown.postprocessors.items():
+            if name not in EXPAND_POSTPROCESSORS:
+                postprocessors[name] = pp
+        return postprocessors
+
+    def expand(self, skeleton):
+        """Evaluate the macros left as placeholders in ``skeleton`` by a
+        render with ``defer_macros`` set, and run the postprocessors it left
+        out, giving the same html as a normal render.
+        """
+        raw_html = self.markdown.postprocessors['raw_html']
+
+        def repl(m):
+            # not a literal, which would escape the html around it
+            html = unicode(self.macro(m.group(2).decode('hex').decode('utf-8')))
+            if m.group(1) and m.group(3) and raw_html.isblocklevel(html):
+                # like markdown's raw html postprocessor, don't wrap block
+                # level html in <p>
+                return html + '\n'
+            return (m.group(1) or '') + html + (m.group(3) or '')
+        html = MACRO_PLACEHOLDER_RE.sub(repl, skeleton)
+        for name in EXPAND_POSTPROCESSORS:
+            html = self.markdown.postprocessors[name].run(html)
+        return html
+
 
 class ForgeLinkTreeProcessor(markdown.treeprocessors.Treeprocessor):
 
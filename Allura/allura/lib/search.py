@@ -17,6 +17,7 @@
 
 import re
 import socket
+import hashlib
 from logging import getLogger
 from urllib import urlencode
 from itertools import imap
@@ -86,9 +87,21 @@ def should_update_index(self, old_doc, new_doc):
         return old_doc != new_doc
 
     def solarize(self):
+        doc, shortlinks = self.solarize_with_shortlinks(shortlinks=False)
+        return doc
+
+    def solarize_with_shortlinks(self, shortlinks=True):
+        """Return the solr document of :meth:`solarize` and the shortlinks
+        referenced in its text, as `(doc, shortlinks)`.
+
+        The text is rendered with a single markdown pass, which gives both the
+        plain text stored by solr and the shortlinks.  A fresh markdown cache
+        of the text on the artifact is used instead when the shortlinks
+        aren't needed.  `shortlinks` is None if it wasn't asked for.
+        """
         doc = self.index()
         if doc is None:
-            return None
+            return None, None
         # if index() returned doc without text, assume empty text
         text = doc.get('text')
         if text is None:
@@ -96,9 +109,37 @@ def solarize(self):
 
         # Convert text to plain text (It usually contains markdown markup).
         # To do so, we convert markdown into html, and then strip all html tags.
-        text = g.markdown.convert(text)
-        doc['text'] = jinja2.Markup.escape(text).striptags()
-        return doc
+        links = None
+        if shortlinks:
+            md = g.pooled_markdown()
+            # no render limit, shortlinks are wanted from all of the text
+            html = md.convert(text, render_limit=False)
+            links = [link for link in md.treeprocessors['links'].alinks
+                     if link is not None]
+        else:
+            html = self._cached_markdown(text)
+            if html is None:
+                html = g.pooled_markdown().convert(text)
+        doc['text'] = jinja2.Markup.escape(html).striptags()
+        return doc, links
+
+    def _cached_markdown(self, text):
+        """Return the html of a fresh markdown cache (a `*_cache` field) of
+        this artifact rendered from `text`, or None."""
+        from allura.lib.app_globals import ForgeMarkdown
+        md5 = None
+        for name in dir(type(self)):
+            if not name.endswith('_cache'):
+                continue
+            cache = getattr(self, name, None)
+            if not isinstance(cache, dict) or not cache.get('md5'):
+                continue
+            if md5 is None:
+                md5 = hashlib.md5(h.really_unicode(text).encode('utf-8')).hexdigest()
+            html = ForgeMarkdown.fresh_cache_html(cache, md5)
+            if html is not None:
+                return h.html.literal(html)
+        return None
 
     @classmethod
     def translate_query(cls, q, fields):
@@ -145,9 +186,11 @@ def search(q, short_timeout=False, ignore_errors=True, **kw):
                               (match.group(1) if match else e))
 
 
-def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None, **kw):
+def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None, fq=None, **kw):
     """Performs SOLR search.
 
+    ``fq`` is a list of additional solr filter queries.
+
     Raises SearchError if SOLR returns an error.
     """
     # first, grab an artifact and get the fields that it indexes
@@ -160,7 +203,7 @@ def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filte
     fq = [
         'type_s:%s' % fields['type_s'],
         'project_id_s:%s' % c.project._id,
-        'mount_point_s:%s' % c.app.config.options.mount_point ]
+        'mount_point_s:%s' % c.app.config.options.mount_point ] + list(fq or [])
     for name, values in (filter or {}).iteritems():
         field_name = name + '_s'
         parts = []
@@ -19,13 +19,16 @@
 This module provides the security predicates used in decorating various models.
 """
 import logging
-from collections import defaultdict
+import time
+from collections import defaultdict, OrderedDict
+from threading import Lock
 
-from pylons import tmpl_context as c
+from pylons import tmpl_context as c, app_globals as g
 from pylons import request
 from webob import exc
 from itertools import chain
 from ming.utils import LazyProperty
+from paste.deploy.converters import asint
 
 from allura.lib.utils import TruthyCallable
 
@@ -39,6 +42,8 @@ class Credentials(object):
     '''
 
     def __init__(self):
+        self.decision_hits = 0
+        self.decision_misses = 0
         self.clear()
 
     @property
@@ -59,6 +64,7 @@ def clear(self):
         'clear cache'
         self.users = {}
         self.projects = {}
+        self.decisions = {}
 
     def clear_user(self, user_id, project_id=None):
         if project_id == '*':
@@ -70,6 +76,44 @@ def clear_user(self, user_id, project_id=None):
             self.projects.pop(pid, None)
             self.users.pop((uid, pid), None)
 
+    def clear_project(self, project_id):
+        'clear cached roles of everyone in a project'
+        self.projects.pop(project_id, None)
+        for uid, pid in self.users.keys():
+            if pid in (project_id, None):
+                del self.users[uid, pid]
+
+    @LazyProperty
+    def decision_cache(self):
+        'the :class:`DecisionCache` shared by all requests, if enabled'
+        try:
+            return g.access_decision_cache
+        except (TypeError, AttributeError):
+            return None
+
+    def decision(self, key, evaluate):
+        '''Return the :func:`has_access` decision cached under key, calling
+        evaluate() to make it on a miss.
+
+        Decisions are cached for the life of this instance (i.e. the
+        request) and in the :attr:`decision_cache`, under keys built by
+        :func:`decision_key`.
+        '''
+        result = self.decisions.get(key)
+        if result is not None:
+            self.decision_hits += 1
+            return result
+        self.decision_misses += 1
+        shared = self.decision_cache
+        if shared is not None:
+            result = shared.get(key)
+        if result is None:
+            result = bool(evaluate())
+            if shared is not None:
+                shared.set(key, result)
+        self.decisions[key] = result
+        return result
+
     def load_user_roles(self, user_id, *project_ids):
         '''Load the credentials with all user roles for a set of projects'''
         # Don't reload roles
@@ -268,6 +312,102 @@ def reaching_ids_set(self):
         return set(self.reaching_ids)
 
 
+class DecisionCache(object):
+    '''
+    LRU cache of up to ``size`` :func:`has_access` decisions, shared by all
+    requests in the process, each kept for ``max_age`` seconds at most.  See
+    :meth:`Credentials.decision`.
+    '''
+
+    def __init__(self, size=10000, max_age=60):
+        self.size = size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        '''Return a cache of ``security.decision_cache.size`` entries, kept
+        for ``security.decision_cache.max_age`` seconds, or None if it is
+        disabled.'''
+        size = asint(config.get('security.decision_cache.size', 0))
+        max_age = asint(config.get('security.decision_cache.max_age', 60))
+        return cls(size, max_age) if size else None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time() - self.max_age:
+                self.misses += 1
+                return None
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, result):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), result)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+
+def _security_project(obj):
+    '''The project whose roles are used to check access to obj'''
+    from allura import model as M
+    if isinstance(obj, M.Neighborhood):
+        return obj.neighborhood_project
+    elif isinstance(obj, M.Project):
+        return obj.root_project
+    else:
+        project = getattr(obj, 'project', None) or c.project
+        return project.root_project
+
+
+def _acl_chain(obj):
+    '''The class, ``_id`` and ACL of obj and each of its parent security
+    contexts'''
+    chain = []
+    while obj is not None:
+        chain.append((obj.__class__, getattr(obj, '_id', None), tuple(
+            (ace.access, ace.role_id, ace.permission) for ace in obj.acl)))
+        obj = obj.parent_security_context()
+    return tuple(chain)
+
+
+def _roles_key(user, project):
+    '''The user's own and reaching roles in project'''
+    roles = Credentials.get().user_roles(user_id=user._id, project_id=project._id)
+    return tuple(sorted(roles.index)), tuple(sorted(roles.reaching_ids))
+
+
+def decision_key(obj, permission, user, project, roles):
+    '''
+    Return a hashable key for a top-level :func:`has_access` decision: the
+    user, their ``roles`` in ``project``, the permission, and everything else
+    the decision reads: the ACLs of obj and its parent security contexts, the
+    user's roles in the root project (which can deny access), and for the
+    neighborhood and project admin checks made when no ACL allows access,
+    the ACLs of the neighborhood and project and the user's roles in the
+    neighborhood project.
+
+    Changing any of these ACLs or the user's roles changes the key, so a
+    cached decision never outlives them.
+    '''
+    from allura import model as M
+    key = (user._id, permission, _acl_chain(obj), project._id,
+           tuple(sorted(roles)), _roles_key(user, project.root_project))
+    if not isinstance(obj, M.Neighborhood):
+        neighborhood = project.neighborhood
+        key += (_acl_chain(neighborhood),
+                _roles_key(user, neighborhood.neighborhood_project))
+        if not isinstance(obj, M.Project):
+            key += (_acl_chain(project),)
+    return key
+
+
 def has_access(obj, permission, user=None, project=None):
     '''Return whether the given user has the permission name on the given object.
 
@@ -306,6 +446,8 @@ def has_access(obj, permission, user=None, project=None):
          traversal of the ACLs, then access is allowed.
 
       3. Otherwise, DENY access to the resource.
+
+    Decisions are cached by :meth:`Credentials.decision`.
     '''
     from allura import model as M
 
@@ -318,21 +460,18 @@ def predicate(obj=obj, user=user, project=project, roles=None):
             assert user, 'c.user should always be at least M.User.anonymous()'
             cred = Credentials.get()
             if project is None:
-                if isinstance(obj, M.Neighborhood):
-                    project = obj.neighborhood_project
-                    if project is None:
-                        log.error('Neighborhood project missing for %s', obj)
-                        return False
-                elif isinstance(obj, M.Project):
-                    project = obj.root_project
-                else:
-                    project = getattr(obj, 'project', None) or c.project
-                    project = project.root_project
+                project = _security_project(obj)
+                if project is None:
+                    log.error('Neighborhood project missing for %s', obj)
+                    return False
             roles = cred.user_roles(
                 user_id=user._id, project_id=project._id).reaching_ids
+            return cred.decision(
+                decision_key(obj, permission, user, project, roles),
+                lambda: predicate(obj, user, project, roles))
 
         # TODO: move deny logic into loop below; see ticket [#6715]
-        if user != M.User.anonymous():
+        if user._id is not None:  # not anonymous, without looking it up
             user_roles = Credentials.get().user_roles(user_id=user._id,
                                                       project_id=project.root_project._id)
             for r in user_roles:
@@ -369,6 +508,96 @@ def predicate(obj=obj, user=user, project=project, roles=None):
     return TruthyCallable(predicate)
 
 
+class AccessFilter(object):
+    '''
+    Compiles a user's roles into query filters matching the artifacts under
+    parent (e.g. the tickets of a tracker's
+    :class:`~allura.model.project.AppConfig`) which :func:`has_access` would
+    allow permission on, so they can be listed, counted and faceted by the
+    datastore instead of checked one by one.
+
+    An artifact with an empty ACL inherits parent's; otherwise the user needs
+    an ALLOW in it for one of their reaching roles, unless they are a project
+    or neighborhood admin.  This matches :func:`has_access` for ACLs which
+    list ALLOWs before a final DENY, like those of private tickets.
+
+    Solr filters expect artifacts to index ``private_b`` (whether they have
+    an ACL of their own) and :meth:`index_roles` as ``<permission>_roles_ws``.
+    '''
+
+    def __init__(self, parent, permission, user=None, project=None):
+        if user is None:
+            user = c.user
+        if project is None:
+            project = _security_project(parent)
+        self.permission = permission
+        self.inherited = bool(has_access(parent, permission, user, project)())
+        if (has_access(project.neighborhood, 'admin', user)() or
+                has_access(project, 'admin', user)()):
+            self.role_ids = None
+        else:
+            self.role_ids = list(Credentials.get().user_roles(
+                user_id=user._id, project_id=project._id).reaching_ids)
+
+    @property
+    def key(self):
+        '''Hashable key, equal for users matching the same artifacts'''
+        role_ids = self.role_ids
+        if role_ids is not None:
+            role_ids = tuple(sorted(role_ids))
+        return (self.permission, self.inherited, role_ids)
+
+    @staticmethod
+    def index_roles(acl, permission):
+        '''The roles allowed permission by acl, as indexed in solr'''
+        from allura.model.types import ACE, EVERYONE, ALL_PERMISSIONS
+        return ' '.join(
+            'everyone' if ace.role_id == EVERYONE else str(ace.role_id)
+            for ace in acl
+            if ace.access == ACE.ALLOW
+            and ace.permission in (permission, ALL_PERMISSIONS))
+
+    def mongo_query(self, query=None):
+        '''Return query restricted to the allowed artifacts'''
+        from allura.model.types import ACE, EVERYONE, ALL_PERMISSIONS
+        query = dict(query or {})
+        clauses = []
+        if self.role_ids is None:
+            if not self.inherited:
+                clauses.append({'acl': {'$ne': []}})
+        else:
+            if self.inherited:
+                clauses.append({'acl': []})
+            if self.role_ids:
+                clauses.append({'acl': {'$elemMatch': {
+                    'access': ACE.ALLOW,
+                    'role_id': {'$in': self.role_ids + [EVERYONE]},
+                    'permission': {'$in': [self.permission, ALL_PERMISSIONS]},
+                }}})
+            if not clauses:
+                clauses.append({'_id': {'$in': []}})
+        if not clauses:
+            return query
+        restriction = clauses[0] if len(clauses) == 1 else {'$or': clauses}
+        if set(restriction) & set(query):
+            return {'$and': [query, restriction]}
+        query.update(restriction)
+        return query
+
+    def solr_filter(self):
+        '''Return a list of solr ``fq`` parameters matching the allowed
+        artifacts'''
+        if self.role_ids is None:
+            return [] if self.inherited else ['private_b:True']
+        parts = []
+        if self.inherited:
+            parts.append('private_b:False')
+        if self.role_ids:
+            parts += ['%s_roles_ws:%s' % (self.permission, role_id)
+                      for role_id in self.role_ids + ['everyone']]
+        return [' OR '.join(parts) or '-*:*']
+
+
 def all_allowed(obj, user_or_role=None, project=None):
     '''
     List all the permission names that a given user or named role
@@ -15,11 +15,21 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import shlex
+import sys
+import time
+import logging
+from threading import Thread
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
 
 from tg import config
 from paste.deploy.converters import asbool
 import pysolr
+import requests
+
+log = logging.getLogger(__name__)
 
 escape_rules = {'+': r'\+',
                '-': r'\-',
@@ -60,11 +70,46 @@ def make_solr_from_config(push_servers, query_server=None, **kwargs):
         commit=asbool(config.get('solr.commit', True)),
         commitWithin=config.get('solr.commitWithin'),
         timeout=int(config.get('solr.long_timeout', 60)),
+        failure_policy=config.get('solr.push_failure_policy', 'fail'),
     )
     solr_kwargs.update(kwargs)
     return Solr(push_servers, query_server, **solr_kwargs)
 
 
+class PersistentSolr(pysolr.Solr):
+
+    """A :class:`pysolr.Solr` which keeps its HTTP connections open.
+
+    pysolr opens a new connection for every request; this sends them
+    through a :class:`requests.Session` instead, which keeps a pool of
+    connections to the server.
+    """
+
+    def __init__(self, *args, **kw):
+        super(PersistentSolr, self).__init__(*args, **kw)
+        self.session = requests.Session()
+
+    def _send_request(self, method, path, body=None, headers=None):
+        url = self.base_url + path
+        start_time = time.time()
+        self.log.debug("Starting request to '%s' (%s) with body '%s'..." % (
+            url, method, str(body)[:10]))
+        try:
+            response = self.session.request(
+                method, url, data=body, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            error_message = "Failed to connect to server at '%s': %s" % (url, e)
+            self.log.error(error_message)
+            raise pysolr.SolrError(error_message)
+        self.log.info("Finished '%s' (%s) with body '%s' in %0.3f seconds." % (
+            url, method, str(body)[:10], time.time() - start_time))
+        if response.status_code != 200:
+            error_message = self._extract_error(response.headers, response.content)
+            self.log.error(error_message)
+            raise pysolr.SolrError(error_message)
+        return response.content
+
+
 class Solr(object):
 
     """Solr interface that pushes updates to multiple solr instances.
@@ -75,45 +120,161 @@ class Solr(object):
     Also, accepts default values for `commit` and `commitWithin`
     and passes those values through to each `add` and `delete` call,
     unless explicitly overridden.
+
+    Updates are pushed to all the servers at once, from a thread per server,
+    and each server has `timeout` seconds to answer.  If some fail, the
+    `failure_policy` decides what happens: ``fail`` raises the first error
+    (after the other servers have been updated), ``queue`` posts a
+    :func:`~allura.tasks.index_tasks.solr_push_retry` task to repeat the
+    update on each failed server later.
     """
 
     def __init__(self, push_servers, query_server=None,
-                 commit=True, commitWithin=None, **kw):
-        self.push_pool = [pysolr.Solr(s, **kw) for s in push_servers]
+                 commit=True, commitWithin=None, failure_policy='fail', **kw):
+        self.push_servers = push_servers
+        self.push_pool = [PersistentSolr(s, **kw) for s in push_servers]
         if query_server:
-            self.query_server = pysolr.Solr(query_server, **kw)
+            self.query_server = PersistentSolr(query_server, **kw)
         else:
             self.query_server = self.push_pool[0]
         self._commit = commit
         self.commitWithin = commitWithin
+        self.timeout = kw.get('timeout', 60)
+        if failure_policy not in ('fail', 'queue'):
+            raise ValueError('Unknown solr failure policy: %s' % failure_policy)
+        self.failure_policy = failure_policy
+        self._threads = None
+        self._threads_pid = None
 
     def add(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
         if self.commitWithin and 'commitWithin' not in kw:
             kw['commitWithin'] = self.commitWithin
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.add(*args, **kw))
-        return responses
+        return self._push('add', args, kw)
 
     def delete(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.delete(*args, **kw))
-        return responses
+        return self._push('delete', args, kw)
 
     def commit(self, *args, **kw):
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.commit(*args, **kw))
-        return responses
+        return self._push('commit', args, kw)
 
     def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
 
+    def _push(self, method, args, kw):
+        '''Call `method` on every push server at once and return their
+        responses, in order (None for a server which failed)'''
+        responses = []
+        failures = []
+        if len(self.push_pool) == 1:
+            try:
+                responses.append(getattr(self.push_pool[0], method)(*args, **kw))
+            except Exception:
+                responses.append(None)
+                failures.append((self.push_servers[0], sys.exc_info()))
+        else:
+            threads = self._thread_pool()
+            results = [threads.apply_async(getattr(solr, method), args, kw)
+                       for solr in self.push_pool]
+            for server, result in zip(self.push_servers, results):
+                try:
+                    responses.append(result.get(self.timeout))
+                except Exception:
+                    responses.append(None)
+                    failures.append((server, sys.exc_info()))
+        if failures:
+            self._failed(method, args, kw, failures)
+        return responses
+
+    def _failed(self, method, args, kw, failures):
+        if self.failure_policy == 'queue':
+            from allura.tasks import index_tasks
+            for server, exc_info in failures:
+                log.warning('Solr %s failed on %s, queueing it for retry',
+                            method, server, exc_info=exc_info)
+                index_tasks.solr_push_retry.post(server, method, list(args), kw)
+            return
+        for server, exc_info in failures:
+            log.error('Solr %s failed on %s', method, server, exc_info=exc_info)
+        exc_info = failures[0][1]
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _thread_pool(self):
+        # threads don't survive a fork, so a forked process needs its own
+        if self._threads is None or self._threads_pid != os.getpid():
+            self._threads = ThreadPool(len(self.push_pool))
+            self._threads_pid = os.getpid()
+        return self._threads
+
+
+class SolrPusher(object):
+
+    """Add documents to solr in fixed size batches from a background thread.
+
+    Documents passed to :meth:`add` are collected into batches of
+    `batch_size`, and full batches are queued for the pushing thread.  At
+    most `queue_size` batches wait in the queue, so :meth:`add` blocks
+    (instead of piling up documents in memory) when solr falls behind.  A
+    batch which fails is retried up to `retries` times, waiting `backoff`
+    seconds and then twice as long each time.
+
+    :meth:`close` pushes what is left, waits for the thread and returns the
+    `sys.exc_info()` of each batch which could not be pushed.
+    """
+
+    def __init__(self, solr, batch_size=500, queue_size=2, retries=3,
+                 backoff=1.0):
+        self.solr = solr
+        self.batch_size = max(1, batch_size)
+        self.retries = retries
+        self.backoff = backoff
+        self.errors = []
+        self._docs = []
+        self._batches = Queue(maxsize=max(1, queue_size))
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, docs):
+        self._docs.extend(docs)
+        while len(self._docs) >= self.batch_size:
+            self._batches.put(self._docs[:self.batch_size])
+            self._docs = self._docs[self.batch_size:]
+
+    def close(self):
+        if self._docs:
+            self._batches.put(self._docs)
+            self._docs = []
+        self._batches.put(None)
+        self._thread.join()
+        return self.errors
+
+    def _run(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                break
+            self._push(batch)
+
+    def _push(self, batch):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                self.solr.add(batch)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    log.exception('Error adding %s documents to solr', len(batch))
+                    self.errors.append(sys.exc_info())
+                    return
+                log.warning('Error adding %s documents to solr, retrying in %ss',
+                            len(batch), delay, exc_info=True)
+                time.sleep(delay)
+                delay *= 2
+
 
 class MockSOLR(object):
 
@@ -149,33 +310,41 @@ def search(self, q, fq=None, **kw):
         # Parse query
         preds = []
         q_parts = shlex.split(q)
-        if fq:
-            q_parts += fq
         for part in q_parts:
             if part == '&&':
                 continue
             if ':' in part:
                 field, value = part.split(':', 1)
-                preds.append((field, value))
+                preds.append([(field, value)])
             else:
-                preds.append(('text', part))
+                preds.append([('text', part)])
+        # filter queries may be disjunctions of field:value terms
+        for part in fq or []:
+            preds.append([tuple(term.split(':', 1)) if ':' in term
+                          else ('text', term)
+                          for term in part.split(' OR ')])
         result = self.MockHits()
         for obj in self.db.values():
-            for field, value in preds:
-                neg = False
-                if field[0] == '!':
-                    neg = True
-                    field = field[1:]
-                if field == 'text' or field.endswith('_t'):
-                    if (value not in str(obj.get(field, ''))) ^ neg:
-                        break
-                else:
-                    if (value != str(obj.get(field, ''))) ^ neg:
-                        break
+            for alternatives in preds:
+                if not any(self._matches(obj, field, value)
+                           for field, value in alternatives):
+                    break
             else:
                 result.append(obj)
         return result
 
+    def _matches(self, obj, field, value):
+        neg = False
+        if field[0] == '!':
+            neg = True
+            field = field[1:]
+        if field == 'text' or field.endswith('_t'):
+            return (value in str(obj.get(field, ''))) ^ neg
+        elif field.endswith('_ws'):
+            return (value in str(obj.get(field, '')).split()) ^ neg
+        else:
+            return (value == str(obj.get(field, ''))) ^ neg
+
     def delete(self, *args, **kwargs):
         if kwargs.get('q', None) == '*:*':
             self.db = {}
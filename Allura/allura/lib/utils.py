@@ -22,6 +22,7 @@
 import binascii
 import logging.handlers
 import codecs
+from ming import mim
 from ming.odm import session
 import os.path
 import datetime
@@ -35,6 +36,7 @@
 
 import tg
 import pylons
+import pymongo
 import json
 import webob.multidict
 from formencode import Invalid
@@ -240,6 +242,76 @@ def chunked_iter(iterable, max_size):
         yield (x for i, x in chunk)
 
 
+def union_first_arg(old_args, old_kwargs, args, kwargs, max_size=10000):
+    '''
+    Merge function for coalescing tasks (see :func:`allura.lib.decorators.task`)
+    whose first argument is a list of ids: the waiting task gets the union of
+    both lists.  Declines to merge if the other arguments differ, or once the
+    list would exceed ``max_size``, to keep task documents (and the work done
+    by a single task) bounded.
+    '''
+    if list(old_args[1:]) != list(args[1:]):
+        return None
+    ids = list(old_args[0])
+    seen = set(ids)
+    ids.extend(i for i in args[0] if i not in seen)
+    if len(ids) > max_size:
+        return None
+    return [ids] + list(old_args[1:]), old_kwargs
+
+
+def bulk_write(collection, inserts=(), updates=(), saves=(), upsert=False,
+               ignore_duplicates=False):
+    '''
+    Write documents to a pymongo collection with a single unordered bulk
+    operation.  ``updates`` is an iterable of ``(spec, update)`` pairs, each
+    applied to one document (upserting if ``upsert`` is True).  ``saves`` are
+    whole documents to insert or replace by ``_id``, like ``collection.save``.
+
+    If ``ignore_duplicates`` is True, inserts of documents that already exist
+    are skipped instead of raising.
+
+    Falls back to one write per document on mim (in tests), which inherits
+    the bulk operation API from pymongo without supporting it.
+    '''
+    inserts = list(inserts)
+    updates = list(updates)
+    saves = list(saves)
+    if not inserts and not updates and not saves:
+        return
+    if isinstance(collection, mim.Collection):
+        for doc in inserts:
+            try:
+                collection.insert(doc)
+            except pymongo.errors.DuplicateKeyError:
+                if not ignore_duplicates:
+                    raise
+        for spec, update in updates:
+            collection.update(spec, update, upsert=upsert)
+        for doc in saves:
+            collection.save(doc)
+        return
+    bulk = collection.initialize_unordered_bulk_op()
+    for doc in inserts:
+        bulk.insert(doc)
+    for spec, update in updates:
+        if upsert:
+            bulk.find(spec).upsert().update_one(update)
+        else:
+            bulk.find(spec).update_one(update)
+    for doc in saves:
+        bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+    try:
+        return bulk.execute()
+    except pymongo.errors.BulkWriteError as e:
+        # 11000 is mongo's duplicate key error code
+        if ignore_duplicates and all(
+                err['code'] == 11000 for err in e.details['writeErrors']) \
+                and not e.details.get('writeConcernErrors'):
+            return e.details
+        raise
+
+
 class AntiSpam(object):
 
     '''Helper class for bot-protecting forms'''
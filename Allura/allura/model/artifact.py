@@ -16,19 +16,24 @@
 #       under the License.
 
 import logging
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
+from threading import Lock
 
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request
+from tg import config
+from paste.deploy.converters import asint
 from ming import schema as S
-from ming.orm import state, session
+from ming.base import Object
+from ming.orm import state, session, mapper
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 from ming.utils import LazyProperty
 from webhelpers import feedgenerator as FG
 
+from allura.lib import deltas
 from allura.lib import helpers as h
 from allura.lib import security
 from allura.lib import utils
@@ -40,7 +45,7 @@
 from .session import project_orm_session
 
 from .session import artifact_orm_session
-from .index import ArtifactReference
+from .index import ArtifactReference, Shortlink
 from .types import ACL, MarkdownCache
 from .project import AppConfig
 from .notification import MailFooter
@@ -189,6 +194,73 @@ def related_artifacts(self):
                 related_artifacts.append(artifact)
         return sorted(related_artifacts, key=lambda a: a.url())
 
+    @classmethod
+    def insert_many(cls, artifacts, ignore_duplicates=False):
+        """Insert new ``artifacts`` and their artifact references and
+        shortlinks with one bulk write per collection, instead of one write
+        each when their session is flushed.
+
+        The artifacts are left clean in their session, and are not indexed:
+        pass their :meth:`index_id` to
+        :func:`allura.tasks.index_tasks.add_artifacts`.
+
+        If ``ignore_duplicates`` is True, artifacts clashing with an existing
+        document are expunged from their session instead of raising.
+
+        Returns the artifacts inserted.
+        """
+        inserted = []
+        for collection, pairs in cls._docs_by_collection(artifacts):
+            utils.bulk_write(collection, inserts=[doc for a, doc in pairs],
+                             ignore_duplicates=ignore_duplicates)
+            if ignore_duplicates:
+                found = set(d['_id'] for d in collection.find(
+                    {'_id': {'$in': [a._id for a, doc in pairs]}}, ['_id']))
+            for a, doc in pairs:
+                if ignore_duplicates and a._id not in found:
+                    session(a).expunge(a)
+                    continue
+                state(a).status = state(a).clean
+                inserted.append(a)
+        ArtifactReference.from_new_artifacts(inserted)
+        Shortlink.from_artifacts(inserted)
+        return inserted
+
+    @classmethod
+    def update_many(cls, artifacts):
+        """Save the changes of ``artifacts`` and refresh their shortlinks with
+        one bulk write per collection, instead of one write each when their
+        session is flushed.
+
+        The artifacts are left clean in their session, and are not indexed:
+        pass their :meth:`index_id` to
+        :func:`allura.tasks.index_tasks.add_artifacts`.
+        """
+        artifacts = list(artifacts)
+        for collection, pairs in cls._docs_by_collection(artifacts):
+            utils.bulk_write(collection, updates=[
+                ({'_id': doc['_id']},
+                 {'$set': dict((k, v) for k, v in doc.iteritems() if k != '_id')})
+                for a, doc in pairs])
+            for a, doc in pairs:
+                state(a).status = state(a).clean
+        Shortlink.from_artifacts(artifacts)
+
+    @staticmethod
+    def _docs_by_collection(artifacts):
+        """Run the before_save hooks of ``artifacts`` and group their
+        documents by collection"""
+        by_collection = defaultdict(list)
+        for a in artifacts:
+            doc_cls = mapper(a).collection
+            doc = doc_cls(state(a).document, skip_from_bson=True)
+            if doc_cls.m.before_save:
+                doc_cls.m.before_save(doc)
+            state(a).update(doc)
+            by_collection[doc_cls.m.collection_name].append((a, dict(doc)))
+        return [(mapper(pairs[0][0]).collection.m.collection, pairs)
+                for pairs in by_collection.itervalues()]
+
     def subscribe(self, user=None, topic=None, type='direct', n=1, unit='day'):
         """Subscribe ``user`` to the :class:`allura.model.notification.Mailbox`
         for this Artifact.
@@ -451,9 +523,31 @@ def is_limit_exceeded(cls, app_config, user=None, count_by_user=None):
         return False
 
 
+class SnapshotDataProperty(FieldProperty):
+
+    """The ``data`` of a :class:`Snapshot`.  Snapshots stored as a delta are
+    reconstructed from their keyframe when their data is first read."""
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        if instance.delta is None:
+            return FieldProperty.__get__(self, instance, cls)
+        data = instance.__dict__.get('_full_data')
+        if data is None:
+            data = instance.__dict__['_full_data'] = instance.reconstruct()
+        return data
+
+
 class Snapshot(Artifact):
 
-    """A snapshot of an :class:`Artifact <allura.model.artifact.Artifact>`, used in :class:`VersionedArtifact <allura.model.artifact.VersionedArtifact>`"""
+    """A snapshot of an :class:`Artifact <allura.model.artifact.Artifact>`, used in :class:`VersionedArtifact <allura.model.artifact.VersionedArtifact>`
+
+    Most snapshots don't hold a full copy of the artifact: every
+    ``snapshot.keyframe_interval`` versions a keyframe does, and the snapshots
+    in between hold a compressed delta from the latest keyframe instead (see
+    :mod:`allura.lib.deltas`).  :attr:`data` is always the full data.
+    """
     class __mongometa__:
         session = artifact_orm_session
         name = 'artifact_snapshot'
@@ -472,7 +566,100 @@ class __mongometa__:
         display_name=str,
         logged_ip=str))
     timestamp = FieldProperty(datetime)
-    data = FieldProperty(None)
+    data = SnapshotDataProperty(None)
+    # the version of the keyframe which delta applies to, for delta snapshots
+    keyframe = FieldProperty(S.Int, if_missing=None)
+    delta = FieldProperty(S.Binary, if_missing=None)
+
+    # see keyframe_data()
+    keyframe_cache_size = 100
+    _keyframe_cache = OrderedDict()
+    _keyframe_lock = Lock()
+
+    @classmethod
+    def from_data(cls, data, keyframe=None):
+        '''Create a snapshot of the given fields, storing ``data['data']`` as a
+        delta from ``keyframe`` (the version and data of the latest keyframe of
+        the artifact) if it is worthwhile.'''
+        ss = cls(**cls.compact(data, keyframe))
+        if ss.delta is not None:
+            ss.__dict__['_full_data'] = Object.from_bson(data['data'])
+        return ss
+
+    @classmethod
+    def compact(cls, data, keyframe):
+        '''Return the fields of snapshot ``data``, with its data stored as a
+        delta from ``keyframe``, or unchanged if it should be a keyframe:
+        every ``snapshot.keyframe_interval`` versions, and when the delta
+        would be more than half the size of the data.'''
+        if keyframe is None:
+            return data
+        interval = asint(config.get('snapshot.keyframe_interval', 20))
+        kf_version, kf_data = keyframe
+        if interval <= 1 or data['version'] - kf_version >= interval:
+            return data
+        delta = deltas.encode(kf_data, data['data'])
+        if len(delta) * 2 > deltas.size(data['data']):
+            return data
+        return dict(data, data=None, keyframe=kf_version, delta=delta)
+
+    @classmethod
+    def latest_keyframes(cls, artifact_ids):
+        '''Return the version and data of the latest keyframe of each of
+        ``artifact_ids``, by artifact id'''
+        collection = mapper(cls).collection.m.collection
+        latest = {}
+        for artifact_id in artifact_ids:
+            for doc in collection.find(
+                    {'artifact_id': artifact_id, 'delta': None},
+                    {'version': 1, 'data': 1}).sort(
+                        'version', pymongo.DESCENDING).limit(1):
+                latest[artifact_id] = (doc['version'], doc['data'])
+        return latest
+
+    @classmethod
+    def keyframe_data(cls, artifact_id, version):
+        '''Return the data of keyframe ``version`` of an artifact, or None if
+        it is missing.
+
+        The data of a keyframe never changes, so the most recently used ones
+        are cached in the process, and the snapshots between two keyframes are
+        all reconstructed from a single query.  A keyframe which has since
+        been stored as a delta itself (by the compact_snapshots script, while
+        a new version was committed) is reconstructed from its own keyframe.'''
+        key = (mapper(cls).collection.m.collection_name, artifact_id, version)
+        with cls._keyframe_lock:
+            data = cls._keyframe_cache.pop(key, None)
+            if data is not None:
+                cls._keyframe_cache[key] = data
+                return data
+        doc = mapper(cls).collection.m.collection.find_one(
+            {'artifact_id': artifact_id, 'version': version},
+            {'data': 1, 'keyframe': 1, 'delta': 1})
+        if doc is None:
+            return None
+        data = doc.get('data')
+        if data is None and doc.get('delta') is not None and \
+                doc.get('keyframe') is not None and doc['keyframe'] < version:
+            base = cls.keyframe_data(artifact_id, doc['keyframe'])
+            if base is not None:
+                data = deltas.apply(base, doc['delta'])
+        if data is None:
+            return None
+        with cls._keyframe_lock:
+            cls._keyframe_cache[key] = data
+            while len(cls._keyframe_cache) > cls.keyframe_cache_size:
+                cls._keyframe_cache.popitem(last=False)
+        return data
+
+    def reconstruct(self):
+        '''Return the full data of a delta snapshot'''
+        base = self.keyframe_data(self.artifact_id, self.keyframe)
+        if base is None:
+            # not an AttributeError, which would end up in __getattr__('data')
+            raise ValueError('Keyframe %s of %s version %s is missing' % (
+                self.keyframe, self.artifact_id, self.version))
+        return Object.from_bson(deltas.apply(base, self.delta))
 
     def index(self):
         result = Artifact.index(self)
@@ -537,28 +724,39 @@ class __mongometa__:
 
     version = FieldProperty(S.Int, if_missing=0)
 
-    def commit(self, update_stats=True):
-        '''Save off a snapshot of the artifact and increment the version #'''
-        try:
-            ip_address = utils.ip_address(request)
-        except:
-            ip_address = '0.0.0.0'
-        data = dict(
+    def _snapshot_data(self, author=None):
+        if author is None:
+            author = self._snapshot_author()
+        return dict(
             artifact_id=self._id,
             artifact_class='%s.%s' % (
                 self.__class__.__module__,
                 self.__class__.__name__),
-            author=dict(
-                id=c.user._id,
-                username=c.user.username,
-                display_name=c.user.get_pref('display_name'),
-                logged_ip=ip_address),
+            author=author,
             data=state(self).clone())
+
+    @staticmethod
+    def _snapshot_author():
+        try:
+            ip_address = utils.ip_address(request)
+        except:
+            ip_address = '0.0.0.0'
+        return dict(
+            id=c.user._id,
+            username=c.user.username,
+            display_name=c.user.get_pref('display_name'),
+            logged_ip=ip_address)
+
+    def commit(self, update_stats=True):
+        '''Save off a snapshot of the artifact and increment the version #'''
+        data = self._snapshot_data()
+        HC = self.__mongometa__.history_class
+        keyframe = HC.latest_keyframes([self._id]).get(self._id)
         while True:
             self.version += 1
             data['version'] = self.version
             data['timestamp'] = datetime.utcnow()
-            ss = self.__mongometa__.history_class(**data)
+            ss = HC.from_data(data, keyframe)
             try:
                 session(ss).insert_now(ss, state(ss))
             except pymongo.errors.DuplicateKeyError:
@@ -579,6 +777,46 @@ def commit(self, update_stats=True):
                     self.type_s, self.mod_date, self.project, c.user)
         return ss
 
+    @classmethod
+    def commit_many(cls, artifacts, update_stats=True):
+        '''Like :meth:`commit` for each of ``artifacts``, but inserts the
+        snapshots with :meth:`Artifact.insert_many`.  Returns the snapshots,
+        which are not indexed.'''
+        artifacts = list(artifacts)
+        author = cls._snapshot_author()
+        timestamp = datetime.utcnow()
+        keyframes = {}
+        for a in artifacts:
+            HC = a.__mongometa__.history_class
+            if HC not in keyframes:
+                keyframes[HC] = HC.latest_keyframes(
+                    b._id for b in artifacts
+                    if b.__mongometa__.history_class is HC)
+        snapshots = []
+        for a in artifacts:
+            HC = a.__mongometa__.history_class
+            data = a._snapshot_data(author)
+            a.version += 1
+            data.update(version=a.version, timestamp=timestamp)
+            snapshots.append(HC.from_data(data, keyframes[HC].get(a._id)))
+        inserted = set(id(ss) for ss in Artifact.insert_many(
+            snapshots, ignore_duplicates=True))
+        result = []
+        for a, ss in zip(artifacts, snapshots):
+            if id(ss) not in inserted:
+                # version taken by a concurrent commit, retry with the next
+                a.version -= 1
+                ss = VersionedArtifact.commit(a, update_stats=False)
+            result.append(ss)
+            if update_stats:
+                if a.version > 1:
+                    g.statsUpdater.modifiedArtifact(
+                        a.type_s, a.mod_date, a.project, c.user)
+                else:
+                    g.statsUpdater.newArtifact(
+                        a.type_s, a.mod_date, a.project, c.user)
+        return result
+
     def get_version(self, n):
         if n < 0:
             n = self.version + n + 1
@@ -32,7 +32,7 @@
 from pylons import request
 from ming import schema as S
 from ming import Field, collection
-from ming.orm import session, state
+from ming.orm import session, state, MapperExtension
 from ming.orm import FieldProperty, RelationProperty, ForeignIdProperty
 from ming.orm.declarative import MappedClass
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -42,6 +42,7 @@
 import allura.tasks.mail_tasks
 from allura.lib import helpers as h
 from allura.lib import plugin
+from allura.lib import security
 from allura.lib import utils
 from allura.lib.decorators import memoize
 from allura.lib.search import SearchIndexable
@@ -823,6 +824,24 @@ class __mongometa__:
         unique_indexes = [('user_id', 'project_id', 'name')]
 
 
+class ProjectRoleMapperExtension(MapperExtension):
+
+    def _clear_credentials(self, obj):
+        try:
+            security.Credentials.get().clear_project(obj.project_id)
+        except TypeError:
+            pass  # no credentials registered, e.g. outside of a request
+
+    def after_insert(self, obj, state, sess):
+        self._clear_credentials(obj)
+
+    def after_update(self, obj, state, sess):
+        self._clear_credentials(obj)
+
+    def after_delete(self, obj, state, sess):
+        self._clear_credentials(obj)
+
+
 class ProjectRole(MappedClass):
     """
     Per-project roles, called "Groups" in the UI.
@@ -837,6 +856,7 @@ class ProjectRole(MappedClass):
     class __mongometa__:
         session = main_orm_session
         name = 'project_role'
+        extensions = [ProjectRoleMapperExtension]
         unique_indexes = [('user_id', 'project_id', 'name')]
         indexes = [
             ('user_id',),
@@ -26,7 +26,7 @@
 import tg
 
 from ming import schema
-from ming.orm.base import session
+from ming.orm.base import session, state
 from ming.orm.property import (FieldProperty, RelationProperty,
                                ForeignIdProperty)
 from ming.utils import LazyProperty
@@ -329,6 +329,81 @@ def post(self, text, message_id=None, parent_id=None, notify=True,
             self.notify_moderators(post)
         return post
 
+    @classmethod
+    def post_many(cls, thread_texts):
+        """Like :meth:`post` with ``notify=False`` for each ``(thread, text)``
+        of ``thread_texts``, but writing the posts, their snapshots and the
+        thread stats with bulk writes.
+
+        Posts which may need moderation or a spam check go through
+        :meth:`post`.
+
+        Returns the posts, and the artifacts written in bulk, which are not
+        indexed yet.
+        """
+        roles = [r.name for r in c.project.named_roles]
+        trusted = c.user._id in [
+            u._id for u in c.project.users_with_role(*roles)]
+        moderated_once = c.app.config.options.get(
+            'PostingPolicy') == 'ApproveOnceModerated'
+        author_roles = {}
+        posts, bulk = [], []
+        for thread, text in thread_texts:
+            if not (trusted and has_access(thread, 'unmoderated_post')()):
+                posts.append(thread.post(text, notify=False))
+                continue
+            require_access(thread, 'post')
+            artifact = thread.artifact if thread.ref_id else None
+            if artifact:
+                artifact.subscribe()
+            slug, full_slug = thread.post_class().make_slugs()
+            post = thread.post_class()(
+                _id=h.gen_message_id(),
+                discussion_id=thread.discussion_id,
+                full_slug=full_slug,
+                slug=slug,
+                thread_id=thread._id,
+                text=text,
+                status='ok')
+            project = post.project
+            if project._id not in author_roles:
+                author_roles[project._id] = ProjectRole.by_user(
+                    c.user, project=project, upsert=True)
+            role_id = author_roles[project._id]._id
+            security.simple_grant(post.acl, role_id, 'moderate')
+            if moderated_once and c.user._id is not None:
+                security.simple_grant(post.acl, role_id, 'unmoderated_post')
+            posts.append(post)
+            bulk.append((thread, artifact or thread.artifact or thread, post))
+        if not bulk:
+            return posts, []
+        new_posts = [p for t, target, p in bulk]
+        written = VersionedArtifact.commit_many(new_posts)
+        written += Artifact.insert_many(new_posts)
+
+        # threads with no other pending changes are saved in bulk too, the
+        # others when their session is flushed
+        clean_threads = dict(
+            (thread._id, thread) for thread, target, post in bulk
+            if state(thread).status == state(thread).clean)
+        for thread, target, post in bulk:
+            thread.last_post_date = max(thread.last_post_date, post.mod_date)
+            thread.num_replies = (thread.num_replies or 0) + 1
+        Artifact.update_many(clean_threads.values())
+        written += clean_threads.values()
+
+        targets = {}
+        for thread, target, post in bulk:
+            targets[id(target)] = target
+            if post.text:
+                g.director.create_activity(
+                    c.user, 'posted', post, target=target,
+                    related_nodes=[post.app_config.project], tags=['comment'])
+        for target in targets.itervalues():
+            if hasattr(target, 'update_stats'):
+                target.update_stats()
+        return posts, written
+
     def notify_moderators(self, post):
         ''' Notify moderators that a post needs approval [#2963] '''
         artifact = self.artifact or self
@@ -33,6 +33,7 @@
 from ming.orm import ForeignIdProperty, RelationProperty
 
 from allura.lib import helpers as h
+from allura.lib import utils
 
 from .session import main_doc_session, main_orm_session
 from .project import Project
@@ -91,6 +92,20 @@ def from_artifact(cls, artifact):
             session(obj).expunge(obj)
             return cls.query.get(_id=artifact.index_id())
 
+    @classmethod
+    def from_new_artifacts(cls, artifacts):
+        '''Write the references of new ``artifacts`` with one bulk write,
+        like :meth:`from_artifact` does for each'''
+        utils.bulk_write(ArtifactReferenceDoc.m.collection, saves=[
+            dict(_id=a.index_id(),
+                 artifact_reference=dict(
+                     cls=bson.Binary(dumps(a.__class__)),
+                     project_id=a.app_config.project_id,
+                     app_config_id=a.app_config._id,
+                     artifact_id=a._id),
+                 references=[])
+            for a in artifacts])
+
     @LazyProperty
     def artifact(self):
         '''Look up the artifact referenced'''
@@ -148,6 +163,25 @@ def from_artifact(cls, a):
             return None
         return result
 
+    @classmethod
+    def from_artifacts(cls, artifacts):
+        '''Create or refresh the shortlinks of ``artifacts`` with one bulk
+        write, like :meth:`from_artifact` does for each'''
+        updates, removed = [], []
+        for a in artifacts:
+            link = a.shorthand_id()
+            if link is None:
+                removed.append(a.index_id())
+                continue
+            updates.append(({'ref_id': a.index_id()}, {'$set': dict(
+                project_id=a.app_config.project_id,
+                app_config_id=a.app_config._id,
+                link=link,
+                url=a.url())}))
+        utils.bulk_write(ShortlinkDoc.m.collection, updates=updates, upsert=True)
+        if removed:
+            ShortlinkDoc.m.remove({'ref_id': {'$in': removed}})
+
     @classmethod
     def from_links(cls, *links):
         '''Convert a sequence of shortlinks to the matching Shortlink objects'''
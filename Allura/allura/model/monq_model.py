@@ -15,6 +15,7 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import re
 import sys
 import time
 import traceback
@@ -33,11 +34,109 @@
 from ming.orm.declarative import MappedClass
 
 from allura.lib.helpers import log_output, null_contextmanager
-from .session import task_orm_session
+from allura.lib.utils import bulk_write
+from .session import task_orm_session, task_doc_session
 
 log = logging.getLogger(__name__)
 
 
+class TaskWakeup(object):
+
+    '''Channel used to wake up idle taskd workers as soon as a task is posted.
+
+    :meth:`MonQTask.post` inserts a tiny document into a capped collection,
+    and idle workers block on a tailable cursor over that collection instead
+    of sleeping for the whole ``monq.poll_interval``.  Polling is kept as the
+    fallback: :meth:`wait` never blocks longer than the given timeout, and if
+    the channel can't be used at all it simply sleeps.
+
+    Enabled with ``monq.wakeup = true``.
+    '''
+    collection_name = 'monq_task_signal'
+    _collection = None  # (db, collection) once looked up or created
+
+    def __init__(self):
+        self._cursor = None
+        self._last_id = None
+        self._broken = False
+        try:
+            last = self.collection().find(
+                {}, sort=[('$natural', pymongo.DESCENDING)], limit=1)
+            for doc in last:
+                self._last_id = doc['_id']
+        except Exception:
+            log.exception('Task wakeup channel unavailable, falling back to polling')
+            self._broken = True
+
+    @staticmethod
+    def enabled():
+        return asbool(config.get('monq.wakeup', False))
+
+    @classmethod
+    def collection(cls):
+        db = task_doc_session.db
+        cached = cls._collection
+        if cached is not None and cached[0] is db:
+            return cached[1]
+        if cls.collection_name not in db.collection_names():
+            try:
+                db.create_collection(
+                    cls.collection_name,
+                    capped=True,
+                    size=int(config.get('monq.wakeup.size', 1024 * 1024)),
+                    max=int(config.get('monq.wakeup.max', 10000)))
+            except pymongo.errors.CollectionInvalid:
+                pass  # created concurrently by another process
+        collection = db[cls.collection_name]
+        cls._collection = (db, collection)
+        return collection
+
+    @classmethod
+    def notify(cls, task_name):
+        '''Signal waiting workers that a task named ``task_name`` is ready.'''
+        if not cls.enabled():
+            return
+        try:
+            cls.collection().insert(
+                dict(task_name=task_name, time=datetime.utcnow()),
+                w=0)
+        except Exception:
+            log.exception('Error signalling task wakeup for %s', task_name)
+
+    def wait(self, timeout):
+        '''Block until a task is signalled or ``timeout`` seconds pass.
+
+        Returns True if woken by a signal, False on timeout.
+        '''
+        deadline = time.time() + timeout
+        if self._broken:
+            time.sleep(timeout)
+            return False
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                if self._cursor is None or not self._cursor.alive:
+                    query = {}
+                    if self._last_id is not None:
+                        query['_id'] = {'$gt': self._last_id}
+                    self._cursor = self.collection().find(
+                        query, tailable=True, await_data=True)
+                # with await_data, the server holds an empty getmore open for
+                # a short while before returning, so this doesn't spin
+                for doc in self._cursor:
+                    self._last_id = doc['_id']
+                    return True
+            except pymongo.errors.PyMongoError:
+                log.exception('Error waiting on task wakeup channel')
+                self._cursor = None
+            if self._cursor is None or not self._cursor.alive:
+                # empty capped collection or error: tailable cursors die
+                # immediately, so pause a little before re-opening
+                time.sleep(min(remaining, 0.5))
+
+
 class MonQTask(MappedClass):
 
     '''Task to be executed by the taskd daemon.
@@ -58,6 +157,9 @@ class MonQTask(MappedClass):
         - args - ``*args`` to be sent to the task function
         - kwargs - ``**kwargs`` to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - coalesce_key - if set, later posts of the same task with the same key
+          and context are merged into this one while it is still 'ready'
+        - coalesced - number of posts merged into this task
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
     result_types = ('keep', 'forget')
@@ -77,6 +179,10 @@ class __mongometa__:
                 # used by repo tarball status check, etc
                 'state', 'task_name', 'time_queue'
             ],
+            [
+                # used to find a task to coalesce with in MonQTask.post()
+                'coalesce_key', 'state'
+            ],
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -97,6 +203,8 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    coalesce_key = FieldProperty(str, if_missing=None)
+    coalesced = FieldProperty(int, if_missing=0)
 
     def __repr__(self):
         from allura import model as M
@@ -135,8 +243,22 @@ def post(cls,
              kwargs=None,
              result_type='forget',
              priority=10,
-             delay=0):
-        '''Create a new task object based on the current context.'''
+             delay=0,
+             coalesce_key=None,
+             merge=None,
+             barriers=None):
+        '''Create a new task object based on the current context.
+
+        If ``coalesce_key`` and ``merge`` are given and a task with the same
+        name, key and context is still waiting to be run, the new arguments
+        are merged into the latest such task instead of creating a new one.
+        ``merge`` is called as ``merge(old_args, old_kwargs, args, kwargs)``
+        and returns the combined ``(args, kwargs)``, or None to post a separate
+        task anyway.  ``barriers`` are names of tasks which must not be jumped:
+        if one posted after the waiting task hasn't finished yet and its first
+        argument shares an item with the new first argument, a separate task
+        is posted.
+        '''
         if args is None:
             args = ()
         if kwargs is None:
@@ -157,6 +279,14 @@ def post(cls,
             context['app_config_id'] = c.app.config._id
         if getattr(c, 'user', None):
             context['user_id'] = c.user._id
+        if coalesce_key is not None and merge is not None:
+            coalesce_key = '%s:%s' % (task_name, coalesce_key)
+            obj = cls._coalesce(coalesce_key, context, args, kwargs, merge,
+                                barriers)
+            if obj is not None:
+                return obj
+        else:
+            coalesce_key = None
         obj = cls(
             state='ready',
             priority=priority,
@@ -167,27 +297,104 @@ def post(cls,
             process=None,
             result=None,
             context=context,
+            coalesce_key=coalesce_key,
             time_queue=datetime.utcnow() + timedelta(seconds=delay))
         session(obj).flush(obj)
+        if not delay:
+            TaskWakeup.notify(task_name)
         return obj
 
     @classmethod
-    def get(cls, process='worker', state='ready', waitfunc=None, only=None):
+    def _coalesce(cls, coalesce_key, context, args, kwargs, merge,
+                  barriers=None, attempts=3):
+        '''Merge args into the latest ready task with the given key and
+        context, and return it.  Returns None if there is no such task, a
+        barrier task (see :meth:`post`) was posted after it, or the merge was
+        declined.
+
+        The update is conditional on the task still being ready and on its
+        ``coalesced`` counter, so a task claimed by a worker or merged into
+        by another process in the meantime is never modified.
+        '''
+        spec = {'coalesce_key': coalesce_key, 'state': 'ready'}
+        for k, v in context.iteritems():
+            spec['context.' + k] = v
+        for i in xrange(attempts):
+            existing = cls._collection().find(spec).sort('_id', -1).limit(1)
+            existing = next(iter(existing), None)
+            if existing is None:
+                return None
+            if barriers and args:
+                barrier = cls._collection().find({
+                    '_id': {'$gt': existing['_id']},
+                    'task_name': {'$in': list(barriers)},
+                    'state': {'$in': ['ready', 'busy']},
+                    'args.0': {'$in': list(args[0])},
+                }, fields=['_id']).limit(1)
+                if next(iter(barrier), None) is not None:
+                    return None
+            merged = merge(existing['args'], existing['kwargs'], list(args), kwargs)
+            if merged is None:
+                return None
+            new_args, new_kwargs = merged
+            result = cls._collection().update(
+                {'_id': existing['_id'],
+                 'state': 'ready',
+                 'coalesced': existing.get('coalesced', 0)},
+                {'$set': {'args': new_args, 'kwargs': new_kwargs},
+                 '$inc': {'coalesced': 1}})
+            if result and result.get('n'):
+                return cls.query.find({'_id': existing['_id']}, refresh=True).first()
+        return None
+
+    @staticmethod
+    def task_name_pattern(name):
+        '''Convert a task name to a value usable in a task_name query.
+
+        Names containing ``*`` are glob patterns matched against the dotted
+        task name or any dotted suffix of it, so ``index_tasks.*`` matches
+        ``allura.tasks.index_tasks.add_artifacts``.  Other names must match
+        exactly.
+        '''
+        if '*' not in name:
+            return name
+        body = '.*'.join(re.escape(part) for part in name.split('*'))
+        return re.compile(r'(^|\.)%s$' % body)
+
+    @classmethod
+    def task_name_spec(cls, only=None, exclude=None):
+        '''Build the task_name part of a query from lists of task names or
+        patterns to include and to exclude.  Returns None if there are no
+        restrictions.'''
+        spec = {}
+        if only:
+            spec['$in'] = [cls.task_name_pattern(n) for n in only]
+        if exclude:
+            spec['$nin'] = [cls.task_name_pattern(n) for n in exclude]
+        return spec or None
+
+    @classmethod
+    def get(cls, process='worker', state='ready', waitfunc=None, only=None,
+            exclude=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
         current process.  If no task is available and waitfunc is supplied, call
         the waitfunc before trying to get the task again.  If waitfunc is None
         and no tasks are available, return None.  If waitfunc raises a
-        StopIteration, stop waiting for a task
+        StopIteration, stop waiting for a task.
+
+        ``only`` and ``exclude`` are lists of task names (or patterns, see
+        :meth:`task_name_pattern`) to restrict which tasks are taken.
         '''
         sort = [
             ('priority', ming.DESCENDING),
             ('time_queue', ming.ASCENDING)]
+        name_spec = cls.task_name_spec(only, exclude)
         while True:
             try:
                 query = dict(state=state)
                 query['time_queue'] = {'$lte': datetime.utcnow()}
-                if only:
-                    query['task_name'] = {'$in': only}
+                if name_spec:
+                    query['task_name'] = name_spec
                 obj = cls.query.find_and_modify(
                     query=query,
                     update={
@@ -217,6 +424,21 @@ def timeout_tasks(cls, older_than):
         spec['time_start'] = {'$lt': older_than}
         cls.query.update(spec, {'$set': dict(state='ready')}, multi=True)
 
+    @classmethod
+    def backlog(cls):
+        '''Return the number of ready and busy tasks per task name, as a list
+        of ``{'_id': {'task_name': ..., 'state': ...}, 'count': ..., 'oldest': ...}``
+        dicts, where ``oldest`` is the earliest ``time_queue``.'''
+        result = cls._collection().aggregate([
+            {'$match': {'state': {'$in': ['ready', 'busy']}}},
+            {'$group': {
+                '_id': {'task_name': '$task_name', 'state': '$state'},
+                'count': {'$sum': 1},
+                'oldest': {'$min': '$time_queue'},
+            }},
+        ])
+        return result.get('result', [])
+
     @classmethod
     def clear_complete(cls):
         '''Delete the task objects for complete tasks'''
@@ -232,20 +454,105 @@ def run_ready(cls, worker=None):
             task()
         return i
 
-    def __call__(self, restore_context=True, nocapture=False):
-        '''Call the task function with its context.  If restore_context is True,
-        c.project/app/user will be restored to the values they had before this
-        function was called.
+    @classmethod
+    def _collection(cls):
+        return task_doc_session.db[cls.__mongometa__.name]
+
+    @classmethod
+    def get_batch(cls, process='worker', limit=10, state='ready', only=None,
+                  exclude=None):
+        '''Claim up to ``limit`` of the highest-priority, oldest, ready tasks
+        for the current process at once, and return them in priority order.
+        Returns an empty list if no tasks are available.
+
+        Candidates are claimed with a single conditional multi-update, so a
+        task raced away by another process is simply left out of the result.
+        Run the tasks with :meth:`run_batch`.
         '''
-        from allura import model as M
-        self.time_start = datetime.utcnow()
-        session(self).flush(self)
-        log.info('starting %r', self)
-        old_cproject = getattr(c, 'project', None)
-        old_capp = getattr(c, 'app', None)
-        old_cuser = getattr(c, 'user', None)
+        sort = [
+            ('priority', ming.DESCENDING),
+            ('time_queue', ming.ASCENDING)]
+        query = dict(state=state)
+        query['time_queue'] = {'$lte': datetime.utcnow()}
+        name_spec = cls.task_name_spec(only, exclude)
+        if name_spec:
+            query['task_name'] = name_spec
+        cursor = cls._collection().find(query, fields=['_id'])
+        ids = [doc['_id'] for doc in cursor.sort(sort).limit(limit)]
+        if not ids:
+            return []
+        cls.query.update(
+            {'_id': {'$in': ids}, 'state': state},
+            {'$set': dict(state='busy',
+                          process=process,
+                          time_start=datetime.utcnow())},
+            multi=True)
+        tasks = cls.query.find(
+            {'_id': {'$in': ids}, 'state': 'busy', 'process': process}).all()
+        order = dict((_id, i) for i, _id in enumerate(ids))
+        tasks.sort(key=lambda t: order[t._id])
+        return tasks
+
+    @classmethod
+    def run_batch(cls, tasks, nocapture=False):
+        '''Run tasks claimed by :meth:`get_batch` one after another.
+
+        The restored project/app/user context is reused between tasks that
+        share the same context, and the tasks' state changes are written back
+        with one bulk write at the end rather than two flushes per task.  A
+        task which raises (with ``monq.raise_errors``) is put in the error
+        state, and the tasks after it are put back in the ready state.
+        '''
+        from ming.orm import ThreadLocalORMSession
+        # keep the tasks out of the session, so flushing the work done by
+        # each task doesn't also write the task documents one by one
+        for task in tasks:
+            session(task).expunge(task)
+        context_cache = {}
+        done = []
         try:
-            func = self.function
+            for task in tasks:
+                try:
+                    task(restore_context=False, nocapture=nocapture,
+                         context_cache=context_cache, flush=False)
+                except Exception:
+                    task.state = 'error'
+                    task.result = traceback.format_exc()
+                    raise
+                finally:
+                    done.append(task)
+                # each task sees the previous tasks' changes, as it would
+                # have if run in separate requests
+                ThreadLocalORMSession.flush_all()
+        finally:
+            updates = [
+                ({'_id': t._id},
+                 {'$set': dict(state=t.state,
+                               result=t.result,
+                               time_start=t.time_start,
+                               time_stop=t.time_stop)})
+                for t in done]
+            updates += [
+                ({'_id': t._id}, {'$set': dict(state='ready', process=None)})
+                for t in tasks if t not in done]
+            bulk_write(cls._collection(), updates=updates)
+            MonQTaskMetrics.record(done)
+        return [t.result for t in done]
+
+    def _restore_context(self, context_cache=None):
+        '''Set c.project, c.app and c.user from this task's context.  If a
+        ``context_cache`` dict is given, objects looked up for a previous task
+        with the same context are reused.'''
+        from allura import model as M
+        key = (self.context.project_id,
+               self.context.app_config_id,
+               self.context.user_id)
+        if context_cache is not None and key in context_cache:
+            c.project, c.app, c.user = context_cache[key]
+            if c.project:
+                c.project.notifications_disabled = self.context.get(
+                    'notifications_disabled', False)
+        else:
             c.project = M.Project.query.get(_id=self.context.project_id)
             c.app = None
             if c.project:
@@ -256,6 +563,26 @@ def __call__(self, restore_context=True, nocapture=False):
                 if app_config:
                     c.app = c.project.app_instance(app_config)
             c.user = M.User.query.get(_id=self.context.user_id)
+            if context_cache is not None:
+                context_cache[key] = (c.project, c.app, c.user)
+
+    def __call__(self, restore_context=True, nocapture=False,
+                 context_cache=None, flush=True):
+        '''Call the task function with its context.  If restore_context is True,
+        c.project/app/user will be restored to the values they had before this
+        function was called.  If flush is False, the task's own state changes
+        are not flushed (used by :meth:`run_batch`).
+        '''
+        self.time_start = datetime.utcnow()
+        if flush:
+            session(self).flush(self)
+        log.info('starting %r', self)
+        old_cproject = getattr(c, 'project', None)
+        old_capp = getattr(c, 'app', None)
+        old_cuser = getattr(c, 'user', None)
+        try:
+            func = self.function
+            self._restore_context(context_cache)
             with null_contextmanager() if nocapture else log_output(log):
                 self.result = func(*self.args, **self.kwargs)
             self.state = 'complete'
@@ -273,7 +600,9 @@ def __call__(self, restore_context=True, nocapture=False):
                     self.result = traceback.format_exc()
         finally:
             self.time_stop = datetime.utcnow()
-            session(self).flush(self)
+            if flush:
+                session(self).flush(self)
+                MonQTaskMetrics.record([self])
             if restore_context:
                 c.project = old_cproject
                 c.app = old_capp
@@ -291,3 +620,149 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class MonQTaskMetrics(MappedClass):
+
+    '''Hourly per-task-name aggregates of finished tasks, recorded by taskd.
+
+    Properties
+
+        - task_name - full dotted name of the task function
+        - period - start of the hour the tasks finished in
+        - count - number of tasks finished
+        - errors - number of tasks that finished in the 'error' state
+        - wait_total, wait_max - seconds spent queued (time_queue to time_start)
+        - run_total, run_max - seconds spent running (time_start to time_stop)
+        - wait_hist, run_hist - number of tasks per :attr:`buckets` bucket,
+          keyed by bucket index (the last one is for anything bigger)
+
+    Enabled unless ``monq.metrics = false``.
+    '''
+    # upper bounds, in seconds, of the histogram buckets
+    buckets = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+    class __mongometa__:
+        session = task_orm_session
+        name = 'monq_task_metrics'
+        indexes = [
+            ('period', 'task_name'),
+        ]
+        unique_indexes = [
+            ('task_name', 'period'),
+        ]
+
+    _id = FieldProperty(S.ObjectId)
+    task_name = FieldProperty(str)
+    period = FieldProperty(datetime)
+    count = FieldProperty(int, if_missing=0)
+    errors = FieldProperty(int, if_missing=0)
+    wait_total = FieldProperty(float, if_missing=0.0)
+    wait_max = FieldProperty(float, if_missing=0.0)
+    run_total = FieldProperty(float, if_missing=0.0)
+    run_max = FieldProperty(float, if_missing=0.0)
+    wait_hist = FieldProperty({str: int})
+    run_hist = FieldProperty({str: int})
+
+    @staticmethod
+    def enabled():
+        return asbool(config.get('monq.metrics', True))
+
+    @classmethod
+    def bucket(cls, seconds):
+        for i, bound in enumerate(cls.buckets):
+            if seconds <= bound:
+                return str(i)
+        return str(len(cls.buckets))
+
+    @classmethod
+    def percentile(cls, hist, count, fraction, maximum):
+        '''Estimate a percentile from a histogram: the upper bound of the
+        bucket it falls in (or ``maximum``, if that's lower).'''
+        if not count:
+            return None
+        target = fraction * count
+        seen = 0
+        for i, bound in enumerate(cls.buckets):
+            seen += hist.get(str(i), 0)
+            if seen >= target:
+                return min(bound, maximum)
+        return maximum
+
+    @classmethod
+    def _update(cls, task):
+        def seconds(delta):
+            return max(delta.total_seconds(), 0.0)
+        wait = seconds(task.time_start - task.time_queue)
+        run = seconds(task.time_stop - task.time_start)
+        period = task.time_stop.replace(minute=0, second=0, microsecond=0)
+        spec = dict(task_name=task.task_name, period=period)
+        update = {
+            '$inc': {
+                'count': 1,
+                'errors': 1 if task.state == 'error' else 0,
+                'wait_total': wait,
+                'run_total': run,
+                'wait_hist.' + cls.bucket(wait): 1,
+                'run_hist.' + cls.bucket(run): 1,
+            },
+            '$max': {'wait_max': wait, 'run_max': run},
+        }
+        return spec, update
+
+    @classmethod
+    def record(cls, tasks):
+        '''Add finished tasks to the metrics for their task name and hour.
+        Never raises, since metrics must not break task processing.'''
+        if not cls.enabled():
+            return
+        try:
+            tasks = [t for t in tasks if t.time_start and t.time_stop]
+            collection = task_doc_session.db[cls.__mongometa__.name]
+            bulk_write(collection,
+                       updates=[cls._update(t) for t in tasks],
+                       upsert=True)
+        except Exception:
+            log.exception('Error recording task metrics')
+
+    @classmethod
+    def summary(cls, since):
+        '''Return per-task-name metrics for all periods starting at or after
+        ``since``, combined with the current backlog, sorted by task name.'''
+        rows = {}
+
+        def row(task_name):
+            return rows.setdefault(task_name, dict(
+                task_name=task_name, count=0, errors=0,
+                wait_total=0.0, wait_max=0.0, run_total=0.0, run_max=0.0,
+                wait_hist={}, run_hist={}, ready=0, busy=0, oldest_ready=None))
+
+        since = since.replace(minute=0, second=0, microsecond=0)
+        for m in cls.query.find(dict(period={'$gte': since})):
+            r = row(m.task_name)
+            for field in ('count', 'errors', 'wait_total', 'run_total'):
+                r[field] += getattr(m, field)
+            for field in ('wait_max', 'run_max'):
+                r[field] = max(r[field], getattr(m, field))
+            for field in ('wait_hist', 'run_hist'):
+                for k, v in (getattr(m, field) or {}).iteritems():
+                    r[field][k] = r[field].get(k, 0) + v
+        for b in MonQTask.backlog():
+            r = row(b['_id']['task_name'])
+            r[b['_id']['state']] = b['count']
+            if b['_id']['state'] == 'ready':
+                r['oldest_ready'] = b['oldest']
+        for r in rows.itervalues():
+            count = r['count']
+            r['error_rate'] = float(r['errors']) / count if count else None
+            for kind in ('wait', 'run'):
+                r[kind + '_avg'] = r[kind + '_total'] / count if count else None
+                for p in (50, 90, 99):
+                    r['%s_p%s' % (kind, p)] = cls.percentile(
+                        r[kind + '_hist'], count, p / 100.0, r[kind + '_max'])
+        return sorted(rows.values(), key=lambda r: r['task_name'])
+
+    @classmethod
+    def clear_old(cls, older_than):
+        '''Delete metrics for periods before ``older_than``.'''
+        cls.query.remove(dict(period={'$lt': older_than}))
@@ -43,24 +43,28 @@
 from tg import config
 import pymongo
 import jinja2
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming import schema as S
-from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session
+from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session, mapper
 from ming.orm.declarative import MappedClass
 
 from allura.lib import helpers as h
 from allura.lib import security
-from allura.lib.utils import take_while_true
+from allura.lib import mail_util
+from allura.lib.utils import take_while_true, bulk_write
 import allura.tasks.mail_tasks
 
-from .session import main_orm_session
+from .session import main_orm_session, main_doc_session
 from .auth import User, AlluraUserProperty
 
 
 log = logging.getLogger(__name__)
 
 MAILBOX_QUIESCENT = None  # Re-enable with [#1384]: timedelta(minutes=10)
+# how long a mailbox claimed by Mailbox.fire_ready stays out of reach of other
+# runs if its claim is never released
+MAILBOX_CLAIM_TIMEOUT = timedelta(minutes=5)
 
 
 class Notification(MappedClass):
@@ -282,6 +286,13 @@ def send_simple(self, toaddr):
             text=(self.text or '') + self.footer(toaddr))
 
     def send_direct(self, user_id):
+        if not self._can_send_direct(user_id):
+            return
+        allura.tasks.mail_tasks.sendmail.post(
+            destinations=[str(user_id)],
+            **self._direct_mail())
+
+    def _can_send_direct(self, user_id):
         user = User.query.get(_id=ObjectId(user_id), disabled=False, pending=False)
         artifact = self.ref.artifact
         log.debug('Sending direct notification %s to user %s',
@@ -290,7 +301,7 @@ def send_direct(self, user_id):
         if not user:
             log.debug("Skipping notification - enabled user %s not found" %
                       user_id)
-            return
+            return False
         # Don't send if user doesn't have read perms to the artifact
         if user and artifact and \
                 not security.has_access(artifact, 'read', user)():
@@ -301,9 +312,13 @@ def send_direct(self, user_id):
                           user_id=user_id, project_id=artifact.project._id).reaching_ids]),
                       ', '.join([str(a) for a in artifact.acl]),
                       ', '.join([str(a) for a in artifact.parent_security_context().acl]))
-            return
-        allura.tasks.mail_tasks.sendmail.post(
-            destinations=[str(user_id)],
+            return False
+        return True
+
+    def _direct_mail(self):
+        '''The sendmail arguments of a direct notification, except for its
+        destinations'''
+        return dict(
             fromaddr=self.from_address,
             reply_to=self.reply_to_address,
             subject=self.subject,
@@ -424,6 +439,8 @@ class __mongometa__:
     # a list of notification _id values
     queue = FieldProperty([str])
     queue_empty = FieldProperty(bool)
+    # set while Mailbox.fire_ready takes the queue
+    fire_claim = FieldProperty(S.ObjectId, if_missing=None)
 
     project = RelationProperty('Project')
     app_config = RelationProperty('AppConfig')
@@ -532,7 +549,9 @@ def subscribed(
     def deliver(cls, nid, artifact_index_id, topic):
         '''Called in the notification message handler to deliver notification IDs
         to the appropriate mailboxes.  Atomically appends the nids
-        to the appropriate mailboxes.
+        to the appropriate mailboxes, all in one bulk write.  If the bulk
+        write fails as a whole, the nid is appended to each mailbox that
+        doesn't have it yet, one at a time.
         '''
         d = {
             'project_id': c.project._id,
@@ -540,24 +559,38 @@ def deliver(cls, nid, artifact_index_id, topic):
             'artifact_index_id': {'$in': [None, artifact_index_id]},
             'topic': {'$in': [None, topic]}
         }
-        mboxes = cls.query.find(d).all()
+        collection = main_doc_session.db[mapper(cls).collection.m.collection_name]
+        mboxes = list(collection.find(d, {'_id': 1, 'user_id': 1}))
         log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join(
-            [str(m._id) for m in mboxes]))
-        for mbox in mboxes:
-            try:
-                mbox.query.update(
-                    {'$push': dict(queue=nid),
-                     '$set': dict(last_modified=datetime.utcnow(),
-                                  queue_empty=False),
-                     })
-                # Make sure the mbox doesn't stick around to be flush()ed
-                session(mbox).expunge(mbox)
-            except:
-                # log error but try to keep processing, lest all the other eligible
-                # mboxes for this notification get skipped and lost forever
-                log.exception(
-                    'Error adding notification: %s for artifact %s on project %s to user %s',
-                    nid, artifact_index_id, c.project._id, mbox.user_id)
+            [str(m['_id']) for m in mboxes]))
+        update = {'$push': dict(queue=nid),
+                  '$set': dict(last_modified=datetime.utcnow(),
+                               queue_empty=False),
+                  }
+        try:
+            bulk_write(collection, updates=[
+                ({'_id': mbox['_id']}, update) for mbox in mboxes])
+        except pymongo.errors.BulkWriteError as e:
+            # the write is unordered, so all the other eligible mboxes have
+            # still got this notification; just log the ones that failed
+            for error in e.details.get('writeErrors', []):
+                log.error(
+                    'Error adding notification: %s for artifact %s on project %s to user %s: %s',
+                    nid, artifact_index_id, c.project._id,
+                    mboxes[error['index']].get('user_id'), error.get('errmsg'))
+        except Exception:
+            log.exception('Error adding notification: %s to mailboxes in bulk', nid)
+            for mbox in mboxes:
+                try:
+                    # part of the bulk write may have been done
+                    collection.update(
+                        {'_id': mbox['_id'], 'queue': {'$nin': [nid]}}, update)
+                except Exception:
+                    # log error but try to keep processing, lest all the other eligible
+                    # mboxes for this notification get skipped and lost forever
+                    log.exception(
+                        'Error adding notification: %s for artifact %s on project %s to user %s',
+                        nid, artifact_index_id, c.project._id, mbox.get('user_id'))
 
     @classmethod
     def fire_ready(cls):
@@ -577,24 +610,34 @@ def fire_ready(cls):
             type={'$in': ['digest', 'summary']},
             next_scheduled={'$lt': now})
 
-        def find_and_modify_direct_mbox():
-            return cls.query.find_and_modify(
-                query=q_direct,
-                update={'$set': dict(
-                    queue=[],
-                    queue_empty=True,
-                )},
-                new=False)
+        collection = main_doc_session.db[mapper(cls).collection.m.collection_name]
+        batch_size = asint(config.get('mailbox.fire.batch_size', 100))
+        fanout = NotificationFanout(
+            concurrency=asint(config.get('mailbox.fire.concurrency', 0)),
+            max_recipients=asint(config.get('mailbox.fire.max_recipients', 100)))
 
-        for mbox in take_while_true(find_and_modify_direct_mbox):
-            try:
-                mbox.fire(now)
-            except:
-                log.exception(
-                    'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
-                # re-raise so we don't keep (destructively) trying to process
-                # mboxes
-                raise
+        def claim_direct_mboxes():
+            return cls._claim(collection, q_direct, batch_size, now)
+
+        try:
+            for mboxes in take_while_true(claim_direct_mboxes):
+                notifications = fanout.load(mboxes)
+                for i, mbox in enumerate(mboxes):
+                    try:
+                        mbox.fire(now, notifications=notifications,
+                                  fanout=fanout)
+                    except:
+                        log.exception(
+                            'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
+                        # the queues of the whole batch were pulled when it
+                        # was claimed; put back the ones not fired yet
+                        cls._requeue(collection, mboxes[i:])
+                        # re-raise so we don't keep (destructively) trying to process
+                        # mboxes
+                        raise
+                fanout.flush()
+        finally:
+            fanout.close()
 
         for mbox in cls.query.find(q_digest):
             next_scheduled = now
@@ -614,12 +657,70 @@ def find_and_modify_direct_mbox():
                 new=False)
             mbox.fire(now)
 
-    def fire(self, now):
+    @classmethod
+    def _claim(cls, collection, query, batch_size, now):
+        '''Take the queues of up to `batch_size` mailboxes matching `query`.
+
+        The mailboxes are claimed in one update, so concurrent runs claim
+        disjoint sets, then exactly the notifications read from their queues
+        are pulled in one bulk write; anything delivered in between stays
+        queued for the next run.  Returns the claimed mailboxes, with the
+        queues they had.
+        '''
+        query = dict(query)
+        query['$or'] = [
+            {'fire_claim': None},
+            {'fire_claim': {'$lt': ObjectId.from_datetime(now - MAILBOX_CLAIM_TIMEOUT)}},
+        ]
+        mboxes = []
+        while not mboxes:
+            ids = [m['_id'] for m in collection.find(query, {'_id': 1}).limit(batch_size)]
+            if not ids:
+                return []
+            claim = ObjectId()
+            collection.update(dict(query, _id={'$in': ids}),
+                              {'$set': {'fire_claim': claim}}, multi=True)
+            # if another run took them all meanwhile, try the next ones
+            mboxes = cls.query.find({'fire_claim': claim}, refresh=True).all()
+        bulk_write(collection, updates=[
+            ({'_id': mbox._id, 'fire_claim': claim},
+             {'$pullAll': {'queue': list(mbox.queue)}, '$set': {'fire_claim': None}})
+            for mbox in mboxes])
+        collection.update(
+            {'_id': {'$in': [mbox._id for mbox in mboxes]}, 'queue': []},
+            {'$set': {'queue_empty': True}}, multi=True)
+        return mboxes
+
+    @classmethod
+    def _requeue(cls, collection, mboxes):
+        '''Put the queues taken by :meth:`_claim` back in `mboxes`'''
+        bulk_write(collection, updates=[
+            ({'_id': mbox._id},
+             {'$push': {'queue': {'$each': list(mbox.queue)}},
+              '$set': {'queue_empty': False}})
+            for mbox in mboxes if mbox.queue])
+
+    def fire(self, now, notifications=None, fanout=None):
         '''
         Send all notifications that this mailbox has enqueued.
+
+        :param notifications: notifications already loaded, by _id, which
+            must include all of this mailbox's queue
+        :param fanout: the :class:`NotificationFanout` to send direct
+            notifications through, instead of one task each
         '''
-        notifications = Notification.query.find(dict(_id={'$in': self.queue}))
-        notifications = notifications.all()
+        if notifications is None:
+            notifications = Notification.query.find(dict(_id={'$in': self.queue}))
+            notifications = notifications.all()
+        else:
+            notifications = [notifications[nid] for nid in self.queue
+                             if nid in notifications]
+
+        def send_direct(n):
+            if fanout is None:
+                n.send_direct(self.user_id)
+            else:
+                fanout.send_direct(n, self.user_id)
         if len(notifications) != len(self.queue):
             log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(
                 self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
@@ -631,7 +732,7 @@ def fire(self, now):
             for n in notifications:
                 try:
                     if n.topic == 'message':
-                        n.send_direct(self.user_id)
+                        send_direct(n)
                         # Messages must be sent individually so they can be replied
                         # to individually
                     else:
@@ -649,7 +750,7 @@ def fire(self, now):
             for (subject, from_address, reply_to_address, author_id), ns in ngroups.iteritems():
                 try:
                     if len(ns) == 1:
-                        ns[0].send_direct(self.user_id)
+                        send_direct(ns[0])
                     else:
                         Notification.send_digest(
                             self.user_id, from_address, subject, ns, reply_to_address)
@@ -670,6 +771,77 @@ def fire(self, now):
                 notifications)
 
 
+class NotificationFanout(object):
+
+    '''Sends the direct notifications of the mailboxes fired by
+    :meth:`Mailbox.fire_ready`.
+
+    Notifications are loaded once per run, however many mailboxes queue
+    them, and the mail of each is rendered once.  With a `concurrency` of 0
+    each recipient gets a `sendmail` task, as from
+    :meth:`Notification.send_direct`.  Otherwise the recipients collected for
+    a batch of mailboxes are handed to a pool of `concurrency` SMTP senders
+    by :meth:`flush`, with up to `max_recipients` recipients per message.
+    '''
+
+    def __init__(self, concurrency=0, max_recipients=100):
+        self.max_recipients = max(1, max_recipients)
+        self.notifications = {}
+        self._mail = {}
+        self._html = {}
+        self._recipients = {}
+        self._pool = None
+        if concurrency > 0:
+            self._pool = mail_util.SMTPSenderPool(concurrency)
+
+    def load(self, mboxes):
+        '''Load the notifications queued in `mboxes` which aren't loaded yet
+        and return all of them, by _id'''
+        nids = set(nid for mbox in mboxes for nid in mbox.queue)
+        nids.difference_update(self.notifications)
+        if nids:
+            for n in Notification.query.find(dict(_id={'$in': list(nids)})):
+                self.notifications[n._id] = n
+        return self.notifications
+
+    def send_direct(self, notification, user_id):
+        if not notification._can_send_direct(user_id):
+            return
+        mail = self._mail.get(notification._id)
+        if mail is None:
+            mail = self._mail[notification._id] = notification._direct_mail()
+        if self._pool is None:
+            allura.tasks.mail_tasks.sendmail.post(
+                destinations=[str(user_id)], **mail)
+        else:
+            self._recipients.setdefault(notification._id, []).append(str(user_id))
+
+    def flush(self):
+        '''Hand the recipients collected so far to the SMTP senders'''
+        for nid, destinations in self._recipients.iteritems():
+            mail = self._mail[nid]
+            html_text = self._html.get(nid)
+            if html_text is None:
+                html_text = self._html[nid] = g.forge_markdown(
+                    email=True).convert(mail['text'])
+            for i in range(0, len(destinations), self.max_recipients):
+                self._pool.submit(allura.tasks.mail_tasks.prepare_sendmail(
+                    destinations=destinations[i:i + self.max_recipients],
+                    html_text=html_text, **mail))
+        self._recipients = {}
+
+    def close(self):
+        '''Send anything still collected and wait for the senders'''
+        if self._pool is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._pool.join()
+        log.info('Sent %s notification emails (%s errors)',
+                 self._pool.sent, self._pool.errors)
+
+
 class MailFooter(object):
     view = jinja2.Environment(
         loader=jinja2.PackageLoader('allura', 'templates'),
@@ -15,24 +15,27 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import logging
 from itertools import chain
 from cPickle import dumps
-from collections import OrderedDict
+from collections import defaultdict, OrderedDict
 
 import bson
 
 import tg
 import jinja2
+from paste.deploy.converters import asint
 from pylons import tmpl_context as c, app_globals as g
 
 from ming.base import Object
-from ming.orm import mapper, session, ThreadLocalORMSession
+from ming.orm import mapper, session, state, ThreadLocalORMSession
 
 from allura.lib import utils
 from allura.lib import helpers as h
+from allura.model.session import main_doc_session
 from allura.model.repository import CommitDoc, TreeDoc, TreesDoc
-from allura.model.repository import CommitRunDoc
+from allura.model.repository import CommitRunDoc, LastCommitDoc, PathHistoryDoc
 from allura.model.repository import Commit, Tree, LastCommit, ModelCache
 from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
 from allura.model.auth import User
@@ -44,10 +47,17 @@
 
 
 def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
-    all_commit_ids = commit_ids = list(repo.all_commit_ids())
-    if not commit_ids:
-        # the repo is empty, no need to continue
-        return
+    tips = repo.ref_tips()
+    commit_ids = None
+    if tips is not None and repo.refresh_tips and not all_commits:
+        # only walk the commits added since the last refresh
+        commit_ids = repo.commits_between(repo.refresh_tips, tips)
+    if commit_ids is None:
+        commit_ids = list(repo.all_commit_ids())
+        if not commit_ids:
+            # the repo is empty, no need to continue
+            return
+    all_commit_ids = commit_ids
     new_commit_ids = unknown_commit_ids(commit_ids)
     stats_log = h.log_action(log, 'commit')
     for ci in new_commit_ids:
@@ -61,46 +71,49 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
         commit_ids = new_commit_ids
     log.info('Refreshing %d commits on %s', len(commit_ids), repo.full_fs_path)
 
-    # Refresh commits
-    seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
+    if repo._refresh_bulk:
+        # Commits, trees, child links, refs and shortlinks in one pass
+        refresh_commits_bulk(repo, commit_ids, lazy=not all_commits)
+        refresh_commit_repos(all_commit_ids, repo)
+    else:
+        # Refresh commits
+        seen = set()
+        for i, oid in enumerate(commit_ids):
+            repo.refresh_commit_info(oid, seen, not all_commits)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
 
-    refresh_commit_repos(all_commit_ids, repo)
+        refresh_commit_repos(all_commit_ids, repo)
 
-    # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-        refresh_children(ci)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s',
-                     (i + 1), ci._id)
+        # Refresh child references
+        for i, oid in enumerate(commit_ids):
+            ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
+            refresh_children(ci)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh child info %d for parents of %s',
+                         (i + 1), ci._id)
 
     if repo._refresh_precompute:
-        # Refresh commit runs
-        commit_run_ids = commit_ids
-        # Check if the CommitRuns for the repo are in a good state by checking for
-        # a CommitRunDoc that contains the last known commit. If there isn't one,
-        # the CommitRuns for this repo are in a bad state - rebuild them
-        # entirely.
-        if commit_run_ids != all_commit_ids:
-            last_commit = last_known_commit_id(all_commit_ids, new_commit_ids)
-            log.info('Last known commit id: %s', last_commit)
-            if not CommitRunDoc.m.find(dict(commit_ids=last_commit)).count():
-                log.info('CommitRun incomplete, rebuilding with all commits')
-                commit_run_ids = all_commit_ids
+        # Refresh commit runs.  New commits are added to the existing runs
+        # incrementally; broken runs are repaired offline by
+        # allura.scripts.repair_commit_runs, not here.
         log.info('Starting CommitRunBuilder for %s', repo.full_fs_path)
-        rb = CommitRunBuilder(commit_run_ids)
-        rb.run()
-        rb.cleanup()
+        rb = CommitRunBuilder(commit_ids)
+        if all_commits:
+            rb.run()
+            rb.cleanup()
+        else:
+            rb.extend()
         log.info('Finished CommitRunBuilder for %s', repo.full_fs_path)
 
+    if repo._path_history:
+        refresh_path_history(repo, commit_ids)
+
     # Refresh trees
     # Like diffs below, pre-computing trees for some SCMs is too expensive,
     # so we skip it here, then do it on-demand later.
-    if repo._refresh_precompute:
+    # The bulk refresh has already written them.
+    if repo._refresh_precompute and not repo._refresh_bulk:
         cache = {}
         for i, oid in enumerate(commit_ids):
             ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
@@ -113,7 +126,10 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
     # For some SCMs, we don't want to pre-compute the LCDs because that
     # would be too expensive, so we skip them here and do them on-demand
     # with caching.
-    if repo._refresh_precompute:
+    lcd_workers = asint(tg.config.get('scm.lcd.workers', 1))
+    if repo._refresh_precompute and lcd_workers > 1 and len(commit_ids) > 1:
+        compute_lcds_parallel(repo, commit_ids, lcd_workers)
+    elif repo._refresh_precompute:
         model_cache = ModelCache()
         lcid_cache = {}
         for i, oid in enumerate(reversed(commit_ids)):
@@ -132,6 +148,10 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
     if repo.cached_tags:
         repo.cached_tags = []
         session(repo).flush()
+
+    if tips is not None:
+        repo.refresh_tips = tips
+        session(repo).flush()
     # The first view can be expensive to cache,
     # so we want to do it here instead of on the first view.
     repo.get_branches()
@@ -185,43 +205,154 @@ def refresh_commit_trees(ci, cache):
     return new_cache
 
 
+def refresh_commits_bulk(repo, commit_ids, lazy=True):
+    '''Refresh the given commits in a single streaming pass.
+
+    Commit and tree data is read once from the SCM through the
+    implementation's ``refresh_commit_docs``, and the resulting ``CommitDoc``,
+    ``TreeDoc`` and ``TreesDoc`` documents, artifact references and shortlinks
+    are written with unordered bulk operations every ``scm.refresh.batch_size``
+    commits.  Child links are written in bulk at the end, once every commit
+    document exists.
+
+    Returns the number of commits refreshed.
+    '''
+    batch_size = asint(tg.config.get('scm.refresh.batch_size', 500))
+    db = main_doc_session.db
+    seen = set()
+    tree_cache = {}
+    children = []
+    count = 0
+    for chunk in utils.chunked_iter(commit_ids, batch_size):
+        ci_docs, tree_docs, refs, links = [], [], [], []
+        for ci_doc, new_tree_docs in repo._impl.refresh_commit_docs(list(chunk), seen):
+            ci_doc['repo_ids'] = [repo._id]
+            ci_docs.append(ci_doc)
+            tree_docs.extend(new_tree_docs)
+            children.extend((p, ci_doc['_id']) for p in ci_doc['parent_ids'])
+            ref, link0, link1 = _commit_ref_docs(repo, ci_doc['_id'])
+            refs.append(ref)
+            links.extend([link0, link1])
+        # trees first, so a commit is never stored without its trees
+        if lazy:
+            utils.bulk_write(db[TreeDoc.m.collection_name],
+                             inserts=tree_docs, ignore_duplicates=True)
+            utils.bulk_write(db[CommitDoc.m.collection_name],
+                             inserts=ci_docs, ignore_duplicates=True)
+        else:
+            # rewrite existing documents too, repairing any stale ones
+            utils.bulk_write(db[TreeDoc.m.collection_name], saves=tree_docs)
+            utils.bulk_write(db[CommitDoc.m.collection_name], upsert=True, updates=[
+                ({'_id': doc['_id']},
+                 {'$set': dict((k, v) for k, v in doc.iteritems()
+                               if k not in ('_id', 'child_ids', 'repo_ids')),
+                  '$addToSet': {'repo_ids': repo._id}})
+                for doc in ci_docs])
+        utils.bulk_write(db[ArtifactReferenceDoc.m.collection_name], saves=refs)
+        utils.bulk_write(db[ShortlinkDoc.m.collection_name], inserts=links)
+        if repo._refresh_precompute:
+            for doc in tree_docs:
+                tree_cache[doc['_id']] = [o['id'] for o in doc['tree_ids']]
+            trees_docs = [
+                dict(_id=doc['_id'], tree_ids=list(trees(doc['tree_id'], tree_cache)))
+                for doc in ci_docs if doc['tree_id'] is not None]
+            utils.bulk_write(db[TreesDoc.m.collection_name], saves=trees_docs)
+            # only keep the trees of the latest commit around, like
+            # refresh_commit_trees does
+            if trees_docs:
+                tree_cache = dict((oid, tree_cache[oid])
+                                  for oid in trees_docs[-1]['tree_ids'])
+        count += len(ci_docs)
+        log.info('Refresh commit info %d: %s', count,
+                 ci_docs[-1]['_id'] if ci_docs else None)
+    for chunk in utils.chunked_list(children, batch_size):
+        utils.bulk_write(db[CommitDoc.m.collection_name], updates=[
+            ({'_id': parent_id}, {'$addToSet': dict(child_ids=child_id)})
+            for parent_id, child_id in chunk])
+    return count
+
+
+# Commits changing more paths than this aren't indexed by
+# refresh_path_history; lookups through them fall back to the SCM
+PATH_HISTORY_MAX_PATHS = 20000
+
+
+def refresh_path_history(repo, commit_ids):
+    '''Add the paths changed by each commit to the PathHistory index, in
+    batches of ``scm.refresh.batch_size`` commits.'''
+    batch_size = asint(tg.config.get('scm.refresh.batch_size', 500))
+    db = main_doc_session.db
+    for chunk in utils.chunked_list(commit_ids, batch_size):
+        parent_ids = dict(
+            (ci._id, ci.parent_ids) for ci in CommitDoc.m.find(
+                dict(_id={'$in': chunk}), fields=['parent_ids'], validate=False))
+        docs = []
+        for oid, files in repo._impl.path_changes(
+                (oid, parent_ids.get(oid, [])) for oid in chunk):
+            paths = set()
+            for path in files:
+                node = h.really_unicode(path).strip('/')
+                while node and node not in paths:
+                    paths.add(node)
+                    node = os.path.dirname(node)
+            if paths:
+                paths.add(u'')
+            if len(paths) > PATH_HISTORY_MAX_PATHS:
+                docs.append(dict(_id=oid, paths=[], truncated=True))
+            else:
+                docs.append(dict(_id=oid, paths=sorted(paths), truncated=False))
+        utils.bulk_write(db[PathHistoryDoc.m.collection_name], saves=docs)
+        log.info('Refresh path history %d: %s', len(docs),
+                 chunk[-1] if chunk else None)
+
+
 def refresh_commit_repos(all_commit_ids, repo):
     '''Refresh the list of repositories within which a set of commits are
     contained'''
+    db = main_doc_session.db
     for oids in utils.chunked_iter(all_commit_ids, QSIZE):
+        refs, links, updates = [], [], []
         for ci in CommitDoc.m.find(dict(
                 _id={'$in': list(oids)},
-                repo_ids={'$ne': repo._id})):
+                repo_ids={'$ne': repo._id}), fields=['_id'], validate=False):
             oid = ci._id
-            ci.repo_ids.append(repo._id)
-            index_id = 'allura.model.repository.Commit#' + oid
-            ref = ArtifactReferenceDoc(dict(
-                _id=index_id,
-                artifact_reference=dict(
-                    cls=bson.Binary(dumps(Commit)),
-                    project_id=repo.app.config.project_id,
-                    app_config_id=repo.app.config._id,
-                    artifact_id=oid),
-                references=[]))
-            link0 = ShortlinkDoc(dict(
-                _id=bson.ObjectId(),
-                ref_id=index_id,
-                project_id=repo.app.config.project_id,
-                app_config_id=repo.app.config._id,
-                link=repo.shorthand_for_commit(oid)[1:-1],
-                url=repo.url_for_commit(oid)))
-            # Always create a link for the full commit ID
-            link1 = ShortlinkDoc(dict(
-                _id=bson.ObjectId(),
-                ref_id=index_id,
-                project_id=repo.app.config.project_id,
-                app_config_id=repo.app.config._id,
-                link=oid,
-                url=repo.url_for_commit(oid)))
-            ci.m.save(safe=False, validate=False)
-            ref.m.save(safe=False, validate=False)
-            link0.m.save(safe=False, validate=False)
-            link1.m.save(safe=False, validate=False)
+            updates.append(
+                ({'_id': oid}, {'$addToSet': dict(repo_ids=repo._id)}))
+            ref, link0, link1 = _commit_ref_docs(repo, oid)
+            refs.append(ref)
+            links.extend([link0, link1])
+        utils.bulk_write(db[CommitDoc.m.collection_name], updates=updates)
+        utils.bulk_write(db[ArtifactReferenceDoc.m.collection_name], saves=refs)
+        utils.bulk_write(db[ShortlinkDoc.m.collection_name], inserts=links)
+
+
+def _commit_ref_docs(repo, oid):
+    '''Return the artifact reference and the two shortlinks for a commit'''
+    index_id = 'allura.model.repository.Commit#' + oid
+    ref = dict(
+        _id=index_id,
+        artifact_reference=dict(
+            cls=bson.Binary(dumps(Commit)),
+            project_id=repo.app.config.project_id,
+            app_config_id=repo.app.config._id,
+            artifact_id=oid),
+        references=[])
+    link0 = dict(
+        _id=bson.ObjectId(),
+        ref_id=index_id,
+        project_id=repo.app.config.project_id,
+        app_config_id=repo.app.config._id,
+        link=repo.shorthand_for_commit(oid)[1:-1],
+        url=repo.url_for_commit(oid))
+    # Always create a link for the full commit ID
+    link1 = dict(
+        _id=bson.ObjectId(),
+        ref_id=index_id,
+        project_id=repo.app.config.project_id,
+        app_config_id=repo.app.config._id,
+        link=oid,
+        url=repo.url_for_commit(oid))
+    return ref, link0, link1
 
 
 def refresh_children(ci):
@@ -244,6 +375,68 @@ def __init__(self, commit_ids):
 
     def run(self):
         '''Build up the runs'''
+        self._build()
+        for run in self.runs.itervalues():
+            run.m.save()
+        return self.runs
+
+    def extend(self):
+        '''Add this builder's commits, which must not be in any run yet, to
+        the existing runs.
+
+        The new commits are built into runs in memory, then each new run is
+        joined with the stored run headed by its parent commit and with the
+        stored run whose parent is its head commit, if any.  Unlike
+        :meth:`run` and :meth:`cleanup`, the existing runs are never walked,
+        so the number of queries only depends on the number of new commits.
+        '''
+        self._build()
+        if not self.runs:
+            return self.runs
+        heads = list(self.runs)
+        parent_ids = [run.parent_commit_ids[0]
+                      for run in self.runs.itervalues()
+                      if len(run.parent_commit_ids) == 1]
+        stored = {}
+        for oids in utils.chunked_list(heads + parent_ids, QSIZE):
+            for run in CommitRunDoc.m.find(dict(_id={'$in': oids})):
+                stored[run._id] = run
+        children = {}
+        for oids in utils.chunked_list(heads, QSIZE):
+            for run in CommitRunDoc.m.find(dict(parent_commit_ids={'$in': oids})):
+                if len(run.parent_commit_ids) == 1:
+                    children.setdefault(run.parent_commit_ids[0], run)
+        saves, deletes, joined = [], [], set()
+        for run_id, run in sorted(self.runs.items()):
+            if run_id in stored:
+                continue  # already has a run
+            p_cis = run.parent_commit_ids
+            parent_run = stored.get(p_cis[0]) if len(p_cis) == 1 else None
+            if parent_run is not None and parent_run._id not in joined:
+                joined.add(parent_run._id)
+                run.commit_ids += parent_run.commit_ids
+                run.commit_times += parent_run.commit_times
+                run.parent_commit_ids = parent_run.parent_commit_ids
+                deletes.append(parent_run._id)
+            child_run = children.get(run_id)
+            if child_run is not None and child_run._id not in joined:
+                joined.add(child_run._id)
+                child_run.commit_ids += run.commit_ids
+                child_run.commit_times += run.commit_times
+                child_run.parent_commit_ids = run.parent_commit_ids
+                run = child_run
+            saves.append(run)
+        # save before deleting, so no commit is ever left without a run
+        utils.bulk_write(
+            main_doc_session.db[CommitRunDoc.m.collection_name], saves=saves)
+        if deletes:
+            CommitRunDoc.m.remove(dict(_id={'$in': deletes}))
+        log.info('%d new runs, %d joined with existing runs',
+                 len(saves), len(joined))
+        return self.runs
+
+    def _build(self):
+        '''Build up the runs in memory'''
         for oids in utils.chunked_iter(self.commit_ids, QSIZE):
             oids = list(oids)
             for ci in CommitDoc.m.find(dict(_id={'$in': oids})):
@@ -259,9 +452,6 @@ def run(self):
         log.info('%d runs', len(self.runs))
         for rid, run in sorted(self.runs.items()):
             log.info('%32s: %r', self.reasons.get(rid, 'none'), run._id)
-        for run in self.runs.itervalues():
-            run.m.save()
-        return self.runs
 
     def _all_runs(self):
         '''Find all runs containing this builder's commit IDs'''
@@ -348,6 +538,55 @@ def merge_runs(self):
             del self.runs[p_run_id]
 
 
+def check_commit_runs(commit_ids):
+    '''Check the runs covering ``commit_ids``.
+
+    Returns a list of ``(run_id, problem)`` pairs, with a run_id of None for
+    problems that aren't about a single run (e.g. a commit in no run).  This
+    reads every run and commit involved, so it is meant to be run offline by
+    :mod:`allura.scripts.repair_commit_runs`.
+    '''
+    problems = []
+    runs = {}
+    for oids in utils.chunked_list(commit_ids, QSIZE):
+        for run in CommitRunDoc.m.find(dict(commit_ids={'$in': oids})):
+            runs[run._id] = run
+    run_counts = defaultdict(int)
+    for run in runs.itervalues():
+        for oid in run.commit_ids:
+            run_counts[oid] += 1
+    for oid in commit_ids:
+        if not run_counts[oid]:
+            problems.append((None, 'commit %s is in no run' % oid))
+        elif run_counts[oid] > 1:
+            problems.append((None, 'commit %s is in %d runs' % (oid, run_counts[oid])))
+    for run_id, run in sorted(runs.items()):
+        if not run.commit_ids or run.commit_ids[0] != run_id:
+            problems.append((run_id, 'run does not start with its own id'))
+            continue
+        if len(run.commit_ids) != len(run.commit_times):
+            problems.append((run_id, '%d commits but %d commit times' % (
+                len(run.commit_ids), len(run.commit_times))))
+        parents = {}
+        for oids in utils.chunked_list(run.commit_ids, QSIZE):
+            for ci in CommitDoc.m.find(dict(_id={'$in': oids}),
+                                       fields=['parent_ids'], validate=False):
+                parents[ci._id] = ci.parent_ids
+        expected = run.commit_ids[1:] + [None]
+        for oid, next_oid in zip(run.commit_ids, expected):
+            if oid not in parents:
+                problems.append((run_id, 'commit %s not found' % oid))
+                break
+            if next_oid is None:
+                if parents[oid] != run.parent_commit_ids:
+                    problems.append((run_id, 'wrong parent_commit_ids'))
+            elif parents[oid] != [next_oid]:
+                problems.append((run_id, 'commit %s is not the parent of %s' % (
+                    next_oid, oid)))
+                break
+    return problems
+
+
 def trees(id, cache):
     '''Recursively generate the list of trees contained within a given tree ID'''
     yield id
@@ -513,26 +752,11 @@ def get_commit_info(commit):
     )
 
 
-def last_known_commit_id(all_commit_ids, new_commit_ids):
-    """
-    Return the newest "known" (cached in mongo) commit id.
-
-    Params:
-        all_commit_ids: Every commit id from the repo on disk, sorted oldest to
-                        newest.
-        new_commit_ids: Commit ids that are not yet cached in mongo, sorted
-                        oldest to newest.
-    """
-    if not all_commit_ids:
-        return None
-    if not new_commit_ids:
-        return all_commit_ids[-1]
-    return all_commit_ids[all_commit_ids.index(new_commit_ids[0]) - 1]
-
-
-def compute_lcds(commit, model_cache, lcid_cache):
+def compute_lcds(commit, model_cache, lcid_cache, built=None):
     '''
     Compute LastCommit data for every Tree node under this tree.
+
+    If ``built`` is given, each newly built LastCommit is appended to it.
     '''
     trees = model_cache.get(TreesDoc, dict(_id=commit._id))
     if not trees:
@@ -541,20 +765,112 @@ def compute_lcds(commit, model_cache, lcid_cache):
     with h.push_config(c, model_cache=model_cache, lcid_cache=lcid_cache):
         _update_tree_cache(trees.tree_ids, model_cache)
         tree = _pull_tree(model_cache, commit.tree_id, commit)
-        _compute_lcds(tree, model_cache)
+        _compute_lcds(tree, model_cache, built)
         for changed_path in tree.commit.changed_paths:
             lcid_cache[changed_path] = tree.commit._id
 
 
-def _compute_lcds(tree, cache):
+def _compute_lcds(tree, cache, built=None):
     path = tree.path().strip('/')
     if path not in tree.commit.changed_paths:
         return
     if not cache.get(LastCommit, dict(commit_id=tree.commit._id, path=path)):
         lcd = LastCommit._build(tree)
+        if built is not None:
+            built.append(lcd)
     for x in tree.tree_ids:
         sub_tree = _pull_tree(cache, x.id, tree, x.name)
-        _compute_lcds(sub_tree, cache)
+        _compute_lcds(sub_tree, cache, built)
+
+
+# Upper bound on the number of trees preloaded into the cache shared by the
+# compute_lcds_parallel workers
+LCD_TREE_CACHE_SIZE = 20000
+
+# State inherited by the compute_lcds_parallel worker processes
+_lcd_worker_state = {}
+
+
+def compute_lcds_parallel(repo, commit_ids, workers):
+    '''Compute LastCommit data for ``commit_ids`` (newest first, as for
+    :func:`refresh_repo`) in a pool of ``workers`` processes.
+
+    The commits are split into contiguous chunks, one per worker, and each
+    chunk is walked oldest first exactly like the serial loop in
+    :func:`refresh_repo`.  Chunks don't depend on each other: the first
+    commits of a chunk just fall back to asking the SCM for entries they
+    can't take from an earlier LastCommit.  The trees of the range are
+    loaded once, before the workers are forked, so they share that cache.
+
+    Workers only compute; the LastCommit documents are written by this
+    process, in commit order, so the result doesn't depend on which worker
+    finishes first.  Returns the number of documents written.
+    '''
+    import multiprocessing
+    commit_ids = list(reversed(commit_ids))
+    chunk_size = -(-len(commit_ids) // workers)
+    chunks = [commit_ids[i:i + chunk_size]
+              for i in xrange(0, len(commit_ids), chunk_size)]
+    model_cache = ModelCache(max_instances={Tree: LCD_TREE_CACHE_SIZE},
+                             max_queries={Tree: LCD_TREE_CACHE_SIZE})
+    tree_ids = []
+    for oids in utils.chunked_list(commit_ids, QSIZE):
+        for trees_doc in TreesDoc.m.find(dict(_id={'$in': oids})):
+            tree_ids.extend(trees_doc.tree_ids)
+    tree_ids = list(OrderedDict.fromkeys(tree_ids))[:LCD_TREE_CACHE_SIZE]
+    for ids in utils.chunked_list(tree_ids, QSIZE):
+        _update_tree_cache(ids, model_cache)
+    ThreadLocalORMSession.flush_all()
+    _lcd_worker_state.update(repo=repo, model_cache=model_cache)
+    pool = multiprocessing.Pool(len(chunks), initializer=_lcd_worker_init)
+    try:
+        results = pool.map(_compute_lcds_chunk, chunks)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _lcd_worker_state.clear()
+    db = main_doc_session.db
+    count = 0
+    for docs in results:
+        for batch in utils.chunked_list(docs, QSIZE):
+            utils.bulk_write(db[LastCommitDoc.m.collection_name], inserts=batch)
+        count += len(docs)
+    log.info('Computed %d last commit docs for %d commits in %d processes',
+             count, len(commit_ids), len(chunks))
+    return count
+
+
+def _lcd_worker_init():
+    # don't share the parent's git handles (and their cat-file processes)
+    _lcd_worker_state['repo'].__dict__.pop('_impl', None)
+
+
+def _compute_lcds_chunk(commit_ids):
+    '''Compute LastCommit data for a chunk of commits, oldest first, in a
+    pool worker, returning the new documents without saving them.'''
+    repo = _lcd_worker_state['repo']
+    model_cache = _lcd_worker_state['model_cache']
+    lcid_cache = {}
+    docs = []
+    for oid in commit_ids:
+        ci = model_cache.get(Commit, dict(_id=oid))
+        ci.set_context(repo)
+        built = []
+        compute_lcds(ci, model_cache, lcid_cache, built)
+        for lcd in built:
+            # keep the instance usable as a previous LCD, but make sure the
+            # model cache never flushes it from this process
+            session(lcd).expunge(lcd)
+            state(lcd).status = state(lcd).clean
+            docs.append(dict(
+                commit_id=lcd.commit_id,
+                path=lcd.path,
+                entries=[dict(name=e.name, commit_id=e.commit_id)
+                         for e in lcd.entries]))
+    return docs
 
 
 def _pull_tree(cache, tree_id, *context):
@@ -131,6 +131,32 @@ def refresh_commit_info(self, oid, lazy=True):  # pragma no cover
         '''Refresh the data in the commit with id oid'''
         raise NotImplementedError('refresh_commit_info')
 
+    def refresh_commit_docs(self, commit_ids, seen):  # pragma no cover
+        '''Generate ``(commit_doc, tree_docs)`` for each commit id, without
+        saving anything.  Only needed if the Repository sets
+        ``_refresh_bulk``; see
+        :func:`allura.model.repo_refresh.refresh_commits_bulk`.'''
+        raise NotImplementedError('refresh_commit_docs')
+
+    def path_changes(self, commits):  # pragma no cover
+        '''Generate ``(commit_id, changed_files)`` for each of the given
+        ``(commit_id, parent_ids)`` pairs, comparing each commit with its
+        first parent.  Only needed if the Repository sets ``_path_history``;
+        see :func:`allura.model.repo_refresh.refresh_path_history`.'''
+        raise NotImplementedError('path_changes')
+
+    def ref_tips(self):
+        '''Return a sorted list of the commit ids at the tips of the repo's
+        refs, or None if commits_between isn't supported.'''
+        return None
+
+    def commits_between(self, old_tips, new_tips):
+        '''Return the ids of the commits reachable from ``new_tips`` but not
+        from ``old_tips`` (both as returned by :meth:`ref_tips`), heads first
+        like :meth:`all_commit_ids`.  Returns None if they can't be worked out
+        incrementally, e.g. because an old tip no longer exists.'''
+        return None
+
     def _setup_hooks(self, source_path=None):  # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -349,6 +375,11 @@ class __mongometa__:
     repo_id = 'repo'
     type_s = 'Repository'
     _refresh_precompute = True
+    # use repo_refresh.refresh_commits_bulk (requires _impl.refresh_commit_docs)
+    _refresh_bulk = False
+    # keep a PathHistory index for last commit lookups (requires commit runs,
+    # i.e. _refresh_precompute, and _impl.path_changes)
+    _path_history = False
 
     name = FieldProperty(str)
     tool = FieldProperty(str)
@@ -364,6 +395,8 @@ class __mongometa__:
     default_branch_name = FieldProperty(str)
     cached_branches = FieldProperty([dict(name=str, object_id=str)])
     cached_tags = FieldProperty([dict(name=str, object_id=str)])
+    # ref tips as of the last refresh, see RepositoryImplementation.ref_tips
+    refresh_tips = FieldProperty([str])
 
     def __init__(self, **kw):
         if 'name' in kw and 'tool' in kw:
@@ -442,6 +475,12 @@ def commit(self, rev):
     def all_commit_ids(self):
         return self._impl.all_commit_ids()
 
+    def ref_tips(self):
+        return self._impl.ref_tips()
+
+    def commits_between(self, old_tips, new_tips):
+        return self._impl.commits_between(old_tips, new_tips)
+
     def refresh_commit_info(self, oid, seen, lazy=True):
         return self._impl.refresh_commit_info(oid, seen, lazy)
 
@@ -464,7 +503,13 @@ def compute_tree_new(self, commit, path='/'):
         return self._impl.compute_tree_new(commit, path)
 
     def last_commit_ids(self, commit, paths):
-        return self._impl.last_commit_ids(commit, paths)
+        if not self._path_history:
+            return self._impl.last_commit_ids(commit, paths)
+        result = PathHistory.last_commit_ids(commit._id, paths)
+        paths = [p for p in paths if p not in result]
+        if paths:
+            result.update(self._impl.last_commit_ids(commit, paths) or {})
+        return result
 
     def get_changes(self, commit_id):
         return self._impl.get_changes(commit_id)
@@ -954,6 +999,15 @@ def add_meta_post(self, changes):
         name=str,
         commit_id=str)]))
 
+# Paths changed by a commit (relative to its first parent), including all
+# their parent directories and '' for the root; see PathHistory.
+# PathHistoryDoc._id = CommitDoc._id
+PathHistoryDoc = collection(
+    'repo_path_history', main_doc_session,
+    Field('_id', str),
+    Field('paths', [str]),
+    Field('truncated', bool, if_missing=False))
+
 # List of all trees contained within a commit
 # TreesDoc._id = CommitDoc._id
 # TreesDoc.tree_ids = [ TreeDoc._id, ... ]
@@ -1533,6 +1587,10 @@ def __repr__(self):
 
     @classmethod
     def _last_commit_id(cls, commit, path):
+        if commit.repo._path_history:
+            last_commit_id = PathHistory.last_commit_id(commit._id, path)
+            if last_commit_id:
+                return last_commit_id
         try:
             rev = commit.repo.log(commit._id, path, id_only=True).next()
             return commit.repo.rev_to_commit_id(rev)
@@ -1548,6 +1606,10 @@ def _prev_commit_id(cls, commit, path):
         lcid_cache = getattr(c, 'lcid_cache', '')
         if lcid_cache != '' and path in lcid_cache:
             return lcid_cache[path]
+        if commit.repo._path_history:
+            prev_commit_id = PathHistory.prev_commit_id(commit, path)
+            if prev_commit_id is not False:
+                return prev_commit_id
         try:
             log_iter = commit.repo.log(commit._id, path, id_only=True)
             log_iter.next()
@@ -1622,6 +1684,95 @@ def by_name(self):
         return {n.name: n.commit_id for n in self.entries}
 
 
+class PathHistory(object):
+
+    '''
+    Find the last commit to touch a path, at or before a given commit, from
+    the PathHistoryDoc index and the commit runs instead of the SCM.
+
+    History is followed through the runs like ``git log -- path`` does: a
+    merge commit that doesn't change a path relative to its first parent
+    is followed through that parent.  Merges that do change a path, commits
+    with too many changes to index and commits not indexed yet are left to
+    the SCM, by leaving those paths out of the result.
+    '''
+
+    # commit ids checked per query
+    chunk_size = 1000
+    # give up on paths not found after walking this many runs
+    max_runs = 100
+
+    @classmethod
+    def last_commit_ids(cls, commit_id, paths):
+        '''
+        Return a mapping {path: commit_id} of the last commit to touch each
+        path, at or before the given commit, for the paths that can be
+        answered from the index.
+        '''
+        pending = set(paths)
+        result = {}
+        for i in xrange(cls.max_runs):
+            if not pending or commit_id is None:
+                break
+            run = CommitRunDoc.m.find(dict(commit_ids=commit_id)).first()
+            if run is None:
+                break
+            commit_ids = run.commit_ids[run.commit_ids.index(commit_id):]
+            merge_id = commit_ids[-1] if len(run.parent_commit_ids) > 1 else None
+            for chunk in utils.chunked_list(commit_ids, cls.chunk_size):
+                if PathHistoryDoc.m.find(dict(_id={'$in': chunk})).count() < len(chunk):
+                    return result  # not indexed
+                touched = {}
+                for doc in PathHistoryDoc.m.find({
+                        '_id': {'$in': chunk},
+                        '$or': [{'paths': {'$in': list(pending)}},
+                                {'truncated': True}]}):
+                    touched[doc._id] = doc
+                for oid in chunk:
+                    doc = touched.get(oid)
+                    if doc is None:
+                        continue
+                    if doc.truncated:
+                        return result
+                    changed = pending.intersection(doc.paths)
+                    if oid != merge_id:
+                        for path in changed:
+                            result[path] = oid
+                    pending -= changed
+                if not pending:
+                    return result
+            parent_ids = run.parent_commit_ids
+            commit_id = parent_ids[0] if parent_ids else None
+        return result
+
+    @classmethod
+    def last_commit_id(cls, commit_id, path):
+        '''The last commit to touch path at or before commit_id, or None if
+        the index can't tell.'''
+        return cls.last_commit_ids(commit_id, [path]).get(path)
+
+    @classmethod
+    def prev_commit_id(cls, commit, path):
+        '''
+        The commit that touched path before the last commit to touch it at
+        or before the given commit; None if there isn't one, or False if the
+        index can't tell.
+        '''
+        last_commit_id = cls.last_commit_id(commit._id, path)
+        if last_commit_id is None:
+            return False
+        if last_commit_id == commit._id:
+            parent_ids = commit.parent_ids
+        else:
+            ci = CommitDoc.m.get(_id=last_commit_id)
+            if ci is None:
+                return False
+            parent_ids = ci.parent_ids
+        if not parent_ids:
+            return None
+        return cls.last_commit_id(parent_ids[0], path) or False
+
+
 class ModelCache(object):
 
     '''
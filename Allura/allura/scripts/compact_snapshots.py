@@ -0,0 +1,142 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+import argparse
+import logging
+
+import pymongo
+from ming.orm import Mapper, mapper
+
+from allura import model as M
+from allura.lib import deltas
+from allura.lib.utils import bulk_write
+from allura.scripts import ScriptTask
+
+log = logging.getLogger(__name__)
+
+
+class CompactSnapshots(ScriptTask):
+
+    @classmethod
+    def execute(cls, options):
+        for HC in cls.history_classes():
+            name = mapper(HC).collection.m.collection_name
+            if options.collections and name not in options.collections:
+                continue
+            log.info('Compacting %s', name)
+            converted, saved = cls.compact(HC, options.dry_run)
+            log.info('%s: %d snapshots %sstored as deltas, %d bytes saved',
+                     name, converted, 'would be ' if options.dry_run else '', saved)
+
+    @classmethod
+    def history_classes(cls):
+        '''One Snapshot class for each snapshot collection'''
+        classes = {}
+        for m in Mapper.all_mappers():
+            name = m.collection.m.collection_name
+            if name and issubclass(m.mapped_class, M.Snapshot):
+                classes.setdefault(name, m.mapped_class)
+        return classes.values()
+
+    @classmethod
+    def compact(cls, HC, dry_run=False):
+        '''Store the full snapshots in the collection of ``HC`` as deltas,
+        where :meth:`Snapshot.compact` would have done so when they were
+        committed.  Snapshots are converted one artifact at a time, with
+        conditional updates, so this can run while the site is up: keyframes
+        which a snapshot committed meanwhile was stored against are left
+        alone (and would still be readable otherwise, see
+        :meth:`Snapshot.keyframe_data`).  Returns the number of snapshots
+        converted and the bytes saved.'''
+        collection = mapper(HC).collection.m.collection
+        converted = saved = 0
+        artifact_id = None
+        while True:
+            query = {} if artifact_id is None else {'artifact_id': {'$gt': artifact_id}}
+            docs = list(collection.find(query, {'artifact_id': 1}).sort(
+                'artifact_id', pymongo.ASCENDING).limit(1))
+            if not docs:
+                break
+            doc = docs[0]
+            artifact_id = doc['artifact_id']
+            updates = cls.compact_artifact(HC, collection, artifact_id)
+            if updates:
+                # snapshots committed since may be deltas from these
+                referenced = cls.referenced_keyframes(collection, artifact_id)
+                updates = [(update, size) for update, size in updates
+                           if update[0]['version'] not in referenced]
+            converted += len(updates)
+            saved += sum(size for update, size in updates)
+            if updates and not dry_run:
+                bulk_write(collection, updates=[update for update, size in updates])
+        return converted, saved
+
+    @classmethod
+    def compact_artifact(cls, HC, collection, artifact_id):
+        '''Return the updates converting the full snapshots of an artifact,
+        with the bytes each one saves'''
+        # keyframes of existing deltas stay keyframes
+        referenced = cls.referenced_keyframes(collection, artifact_id)
+        updates = []
+        keyframe = None
+        for doc in collection.find(
+                {'artifact_id': artifact_id, 'delta': None},
+                {'version': 1, 'data': 1}).sort('version', pymongo.ASCENDING):
+            version = doc['version']
+            if doc.get('data') is None:
+                continue
+            if keyframe is None or version in referenced:
+                keyframe = (version, doc['data'])
+                continue
+            fields = HC.compact(dict(version=version, data=doc['data']), keyframe)
+            if fields.get('delta') is None:
+                keyframe = (version, doc['data'])
+                continue
+            updates.append((
+                ({'_id': doc['_id'], 'version': version, 'delta': None},
+                 {'$set': {'data': None,
+                           'keyframe': fields['keyframe'],
+                           'delta': fields['delta']}}),
+                deltas.size(doc['data']) - len(fields['delta'])))
+        return updates
+
+    @classmethod
+    def referenced_keyframes(cls, collection, artifact_id):
+        '''The versions of an artifact which its deltas are stored against'''
+        return set(doc['keyframe'] for doc in collection.find(
+            {'artifact_id': artifact_id, 'delta': {'$ne': None}}, {'keyframe': 1}))
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description='Store the history of '
+                                         'versioned artifacts as keyframes and compressed deltas, like new '
+                                         'snapshots are stored.  Safe to run while the site is up, and to '
+                                         'run again.')
+        parser.add_argument('--collections', nargs='+', metavar='NAME',
+                            help='Restrict to these snapshot collections, '
+                            'e.g. page_history ticket_history.')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            default=False, help='Only log how many snapshots '
+                            'would be converted, do not convert them.')
+        return parser
+
+
+def get_parser():
+    return CompactSnapshots.parser()
+
+
+if __name__ == '__main__':
+    CompactSnapshots.main()
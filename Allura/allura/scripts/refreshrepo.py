@@ -118,6 +118,13 @@ def execute(cls, options):
                                 M.repository.LastCommitDoc.m.remove(
                                     dict(commit_ids={'$in': ci_ids_chunk}))
 
+                            i = M.repository.PathHistoryDoc.m.find(
+                                {"_id": {"$in": ci_ids_chunk}}).count()
+                            if i:
+                                log.info("Deleting %i PathHistoryDoc docs...", i)
+                                M.repository.PathHistoryDoc.m.remove(
+                                    {"_id": {"$in": ci_ids_chunk}})
+
                             i = M.repository.CommitRunDoc.m.find(
                                 {"commit_ids": {"$in": ci_ids_chunk}}).count()
                             if i:
@@ -125,6 +132,8 @@ def execute(cls, options):
                                 M.repository.CommitRunDoc.m.remove(
                                     {"commit_ids": {"$in": ci_ids_chunk}})
                         del ci_ids
+                        # the next refresh has to walk every commit again
+                        c.app.repo.refresh_tips = []
 
                     try:
                         if options.all:
@@ -75,7 +75,7 @@ def _post_add_projects(cls, chunk):
         mongo document is too large.
         """
         try:
-            add_projects.post(chunk)
+            add_projects.post(chunk, coalesce=False)
         except InvalidDocument as e:
             # there are many types of InvalidDocument, only recurse if its
             # expected to help
@@ -61,7 +61,7 @@ def _post_add_users(cls, chunk):
         mongo document is too large.
         """
         try:
-            add_users.post(chunk)
+            add_users.post(chunk, coalesce=False)
         except InvalidDocument as e:
             # there are many types of InvalidDocument, only recurse if its
             # expected to help
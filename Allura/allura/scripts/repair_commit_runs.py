@@ -0,0 +1,115 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+import argparse
+import logging
+
+from pylons import tmpl_context as c
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib.utils import chunked_find
+from allura.model.repo_refresh import CommitRunBuilder, check_commit_runs
+from allura.scripts import ScriptTask
+
+log = logging.getLogger(__name__)
+
+
+class RepairCommitRuns(ScriptTask):
+
+    @classmethod
+    def execute(cls, options):
+        q_project = {}
+        if options.nbhd:
+            nbhd = M.Neighborhood.query.get(url_prefix=options.nbhd)
+            if not nbhd:
+                return "Invalid neighborhood url prefix."
+            q_project['neighborhood_id'] = nbhd._id
+        if options.project:
+            q_project['shortname'] = options.project
+        elif options.project_regex:
+            q_project['shortname'] = {'$regex': options.project_regex}
+
+        for chunk in chunked_find(M.Project, q_project):
+            for p in chunk:
+                c.project = p
+                if options.mount_point:
+                    mount_points = [options.mount_point]
+                else:
+                    mount_points = [ac.options.mount_point for ac in
+                                    M.AppConfig.query.find(dict(project_id=p._id))]
+                for app in (p.app_instance(mp) for mp in mount_points):
+                    c.app = app
+                    if not hasattr(app, 'repo') or not app.repo._refresh_precompute:
+                        continue
+                    try:
+                        cls.repair(app.repo, options.dry_run)
+                    except:
+                        log.exception('Error checking commit runs of %r', app.repo)
+            ThreadLocalORMSession.flush_all()
+
+    @classmethod
+    def repair(cls, repo, dry_run=False):
+        '''Check the commit runs of a repo, and rebuild them if they're
+        broken.  Returns the list of problems found.'''
+        commit_ids = list(repo.all_commit_ids())
+        problems = check_commit_runs(commit_ids)
+        if not problems:
+            log.info('Commit runs of %s are fine', repo.full_fs_path)
+            return problems
+        for run_id, problem in problems:
+            log.info('%s: run %s: %s', repo.full_fs_path, run_id, problem)
+        if dry_run:
+            return problems
+        broken = list(set(run_id for run_id, problem in problems if run_id))
+        if broken:
+            log.info('Deleting %d broken runs', len(broken))
+            M.repository.CommitRunDoc.m.remove(dict(_id={'$in': broken}))
+        log.info('Rebuilding commit runs of %s', repo.full_fs_path)
+        rb = CommitRunBuilder(commit_ids)
+        rb.run()
+        rb.cleanup()
+        return problems
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description='Check the commit runs of '
+                                         'repos, and rebuild any that are broken. Run for all repos (no args), '
+                                         'or restrict by neighborhood, project, or code tool mount point.')
+        parser.add_argument('--nbhd', action='store', default='', dest='nbhd',
+                            help='Restrict to a particular neighborhood, e.g. /p/.')
+        parser.add_argument(
+            '--project', action='store', default='', dest='project',
+            help='Restrict to a particular project. To specify a '
+            'subproject, use a slash: project/subproject.')
+        parser.add_argument('--project-regex', action='store', default='',
+                            dest='project_regex',
+                            help='Restrict to projects for which the shortname matches '
+                            'the provided regex.')
+        parser.add_argument('--mount-point', default='', dest='mount_point',
+                            help='Restrict to repos at the given tool mount point. ')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            default=False, help='Only log the problems found, '
+                            'do not repair them.')
+        return parser
+
+
+def get_parser():
+    return RepairCommitRuns.parser()
+
+
+if __name__ == '__main__':
+    RepairCommitRuns.main()
@@ -17,20 +17,39 @@
 
 import sys
 import logging
+import traceback
+import multiprocessing
 from contextlib import contextmanager
+from collections import OrderedDict
+from cPickle import loads
 
 from pylons import app_globals as g
+from tg import config
+from paste.deploy.converters import asint
 
+from allura.lib import helpers as h
 from allura.lib.decorators import task
-from allura.lib.exceptions import CompoundError
-from allura.lib.solr import make_solr_from_config
+from allura.lib.exceptions import CompoundError, ForgeError
+from allura.lib.solr import make_solr_from_config, SolrPusher
+from allura.lib.utils import union_first_arg, chunked_list
 
 
 log = logging.getLogger(__name__)
 
 
+# Solr instances for explicitly given hosts, by hosts, kept for later tasks
+# like g.solr is, with their thread pools and connections
+_solr_by_hosts = {}
+
+
 def __get_solr(solr_hosts=None):
-    return make_solr_from_config(solr_hosts) if solr_hosts else g.solr
+    if not solr_hosts:
+        return g.solr
+    key = tuple(solr_hosts)
+    solr = _solr_by_hosts.get(key)
+    if solr is None:
+        solr = _solr_by_hosts[key] = make_solr_from_config(list(solr_hosts))
+    return solr
 
 
 def __add_objects(objects, solr_hosts=None):
@@ -44,7 +63,7 @@ def __del_objects(object_solr_ids):
     solr_instance.delete(q=solr_query)
 
 
-@task
+@task(coalesce=union_first_arg)
 def add_projects(project_ids):
     from allura.model.project import Project
     projects = Project.query.find(dict(_id={'$in': project_ids})).all()
@@ -56,7 +75,7 @@ def del_projects(project_solr_ids):
     __del_objects(project_solr_ids)
 
 
-@task
+@task(coalesce=union_first_arg)
 def add_users(user_ids):
     from allura.model import User
     users = User.query.find(dict(_id={'$in': user_ids})).all()
@@ -68,42 +87,61 @@ def del_users(user_solr_ids):
     __del_objects(user_solr_ids)
 
 
-@task
+@task(coalesce=union_first_arg,
+      coalesce_barriers=['allura.tasks.index_tasks.del_artifacts'])
 def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     '''
     Add the referenced artifacts to SOLR and shortlinks.
 
+    The references are handled a chunk at a time.  The artifacts of a chunk
+    are fetched with one query per artifact class and rendered, in a pool of
+    `solr.index.workers` processes if there is more than one batch of them,
+    and their documents are pushed to solr in batches of
+    `solr.index.batch_size` from a background thread (see
+    :class:`allura.lib.solr.SolrPusher`) while the next chunk is rendered.
+
     :param solr_hosts: a list of solr hosts to use instead of the defaults
     :type solr_hosts: [str]
     '''
     from allura import model as M
-    from allura.lib.search import find_shortlinks
 
+    batch_size = asint(config.get('solr.index.batch_size', 500))
+    workers = asint(config.get('solr.index.workers', 1))
     exceptions = []
-    solr_updates = []
-    with _indexing_disabled(M.session.artifact_orm_session._get()):
-        for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
-            try:
-                artifact = ref.artifact
-                if artifact is None:
-                    continue
-                s = artifact.solarize()
-                if s is None:
-                    continue
-                if update_solr:
-                    solr_updates.append(s)
-                if update_refs:
-                    if isinstance(artifact, M.Snapshot):
-                        continue
-                    # Find shortlinks in the raw text, not the escaped html
-                    # created by the `solarize()`.
-                    link_text = artifact.index().get('text') or ''
-                    shortlinks = find_shortlinks(link_text)
-                    ref.references = [link.ref_id for link in shortlinks]
-            except Exception:
-                log.error('Error indexing artifact %s', ref._id)
-                exceptions.append(sys.exc_info())
-        __get_solr(solr_hosts).add(solr_updates)
+    pusher = None
+    if update_solr:
+        pusher = SolrPusher(
+            __get_solr(solr_hosts), batch_size,
+            retries=asint(config.get('solr.index.retries', 3)))
+    pool = None
+    if workers > 1 and len(ref_ids) > batch_size:
+        pool = multiprocessing.Pool(workers)
+    try:
+        with _indexing_disabled(M.session.artifact_orm_session._get()):
+            for chunk in chunked_list(ref_ids, batch_size * max(1, workers)):
+                refs = M.ArtifactReference.query.find(
+                    dict(_id={'$in': chunk})).all()
+                jobs = _render_jobs(refs, batch_size, update_solr, update_refs)
+                if pool:
+                    rendered = pool.map(_render_artifacts_in_worker, jobs)
+                else:
+                    rendered = map(_render_artifacts, jobs)
+                refs = dict((ref._id, ref) for ref in refs)
+                for results, errors in rendered:
+                    exceptions.extend(errors)
+                    for ref_id, doc, references in results:
+                        if doc is not None:
+                            pusher.add([doc])
+                        if references is not None:
+                            refs[ref_id].references = references
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        if pusher:
+            exceptions.extend(pusher.close())
 
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
@@ -111,6 +149,72 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
         raise CompoundError(*exceptions)
 
 
+def _render_jobs(refs, batch_size, update_solr, update_refs):
+    '''Group `refs` by artifact class and project into jobs for
+    :func:`_render_artifacts` of up to `batch_size` artifacts each'''
+    groups = OrderedDict()
+    for ref in refs:
+        aref = ref.artifact_reference
+        key = (str(aref.cls), aref.project_id)
+        groups.setdefault(key, []).append((ref._id, aref.artifact_id))
+    return [(cls, project_id, ids, update_solr, update_refs)
+            for (cls, project_id), group in groups.iteritems()
+            for ids in chunked_list(group, batch_size)]
+
+
+def _render_artifacts(job):
+    '''Fetch the artifacts of one class for a job from :func:`_render_jobs`
+    and build their solr documents and shortlink references.
+
+    Returns a list of `(ref_id, solr_doc, referenced_ref_ids)`, where either
+    of the last two is None if it wasn't asked for (or doesn't apply), and
+    a list of the `sys.exc_info()` of each artifact which failed.
+    '''
+    from allura import model as M
+
+    cls, project_id, ids, update_solr, update_refs = job
+    results = []
+    exceptions = []
+    try:
+        cls = loads(cls)
+        with h.push_context(project_id):
+            artifacts = dict(
+                (a._id, a) for a in
+                cls.query.find(dict(_id={'$in': [aid for ref_id, aid in ids]})))
+    except Exception:
+        log.error('Error loading artifacts for %s',
+                  ', '.join(ref_id for ref_id, aid in ids))
+        exceptions.append(sys.exc_info())
+        return results, exceptions
+    for ref_id, artifact_id in ids:
+        try:
+            artifact = artifacts.get(artifact_id)
+            if artifact is None:
+                continue
+            # one markdown render gives both the solr text and shortlinks
+            s, shortlinks = artifact.solarize_with_shortlinks(
+                shortlinks=update_refs and not isinstance(artifact, M.Snapshot))
+            if s is None:
+                continue
+            references = None
+            if shortlinks is not None:
+                references = [link.ref_id for link in shortlinks]
+            results.append((ref_id, s if update_solr else None, references))
+        except Exception:
+            log.error('Error indexing artifact %s', ref_id)
+            exceptions.append(sys.exc_info())
+    return results, exceptions
+
+
+def _render_artifacts_in_worker(job):
+    ''':func:`_render_artifacts` for a process pool: tracebacks can't be
+    sent back to the parent, so errors are returned formatted'''
+    results, exceptions = _render_artifacts(job)
+    return results, [
+        (ForgeError, ForgeError(''.join(traceback.format_exception(*e))), None)
+        for e in exceptions]
+
+
 @task
 def del_artifacts(ref_ids):
     from allura import model as M
@@ -134,6 +238,15 @@ def commit():
 def solr_del_tool(project_id, mount_point_s):
     g.solr.delete(q='project_id_s:"%s" AND mount_point_s:"%s"' % (project_id, mount_point_s))
 
+
+@task
+def solr_push_retry(server, method, args, kwargs):
+    '''Repeat an update which failed on one solr server (see the ``queue``
+    failure policy of :class:`allura.lib.solr.Solr`).  This fails, rather
+    than queueing another retry, if the server is still failing.'''
+    solr = make_solr_from_config([server], failure_policy='fail')
+    getattr(solr, method)(*args, **kwargs)
+
 @contextmanager
 def _indexing_disabled(session):
     session.disable_index = session.skip_mod_date = True
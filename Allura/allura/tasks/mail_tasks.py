@@ -93,6 +93,23 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
 
     :param fromaddr: ObjectId or str(ObjectId) of user, or email address str
 
+    '''
+    smtp_client.send_batch(prepare_sendmail(
+        fromaddr, destinations, text, reply_to, subject, message_id,
+        in_reply_to=in_reply_to, sender=sender, references=references))
+
+
+def prepare_sendmail(fromaddr, destinations, text, reply_to, subject,
+                     message_id, in_reply_to=None, sender=None,
+                     references=None, html_text=None):
+    '''
+    Build the messages :func:`sendmail` sends: one per email format, each
+    with the destinations that prefer it.  Returns a list of keyword dicts
+    for :meth:`allura.lib.mail_util.SMTPClient.sendmail`.
+
+    :param html_text: the already rendered html version of `text`, so callers
+        sending the same text many times only convert it once
+
     '''
     from allura import model as M
     addrs_plain = []
@@ -140,18 +157,19 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
                 addrs_multi.append(addr)
     htmlparser = HTMLParser.HTMLParser()
     plain_msg = mail_util.encode_email_part(htmlparser.unescape(text), 'plain')
-    html_text = g.forge_markdown(email=True).convert(text)
+    if html_text is None:
+        html_text = g.forge_markdown(email=True).convert(text)
     html_msg = mail_util.encode_email_part(html_text, 'html')
     multi_msg = mail_util.make_multipart_message(plain_msg, html_msg)
-    smtp_client.sendmail(
-        addrs_multi, fromaddr, reply_to, subject, message_id,
-        in_reply_to, multi_msg, sender=sender, references=references)
-    smtp_client.sendmail(
-        addrs_plain, fromaddr, reply_to, subject, message_id,
-        in_reply_to, plain_msg, sender=sender, references=references)
-    smtp_client.sendmail(
-        addrs_html, fromaddr, reply_to, subject, message_id,
-        in_reply_to, html_msg, sender=sender, references=references)
+    # the multipart message embeds the other two, so it has to go out before
+    # their headers are set
+    return [dict(addrs=addrs, fromaddr=fromaddr, reply_to=reply_to,
+                 subject=subject, message_id=message_id,
+                 in_reply_to=in_reply_to, message=message, sender=sender,
+                 references=references)
+            for addrs, message in [(addrs_multi, multi_msg),
+                                   (addrs_plain, plain_msg),
+                                   (addrs_html, html_msg)]]
 
 
 @task
@@ -170,6 +170,36 @@ def test_task_doc(self):
             task_name='allura.tests.functional.test_site_admin.test_task'))
         assert json.loads(r.body)['doc'] == 'test_task doc string'
 
+    @patch.object(M.MonQTask, 'backlog')
+    def test_task_metrics(self, backlog):
+        r = self.app.get('/nf/admin/task_manager/metrics',
+                         extra_environ=dict(username='*anonymous'), status=302)
+        backlog.return_value = []
+        r = self.app.get('/nf/admin/task_manager/metrics')
+        assert 'No task metrics found' in r, r
+        now = dt.datetime.utcnow()
+        M.MonQTaskMetrics(task_name='math.ceil', period=now,
+                          count=4, errors=1,
+                          wait_total=2.0, wait_max=1.0, run_total=0.4, run_max=0.2,
+                          wait_hist={'3': 3, '4': 1}, run_hist={'2': 4})
+        M.MonQTaskMetrics(task_name='math.floor', period=now - dt.timedelta(hours=48),
+                          count=1)
+        ThreadLocalORMSession.flush_all()
+        backlog.return_value = [
+            {'_id': {'task_name': 'math.ceil', 'state': 'ready'},
+             'count': 7, 'oldest': now}]
+        r = self.app.get('/nf/admin/task_manager/metrics')
+        row = r.html.find('a', text='math.ceil').findParent('tr')
+        cells = [cell.text for cell in row.findAll('td')]
+        assert_equal(cells[1], '7')
+        assert_equal(cells[4], '4')
+        assert_equal(cells[5], '25.0%')
+        assert_equal(cells[6], '0.50s')
+        assert_equal(cells[13], '0.20s')
+        assert 'math.floor' not in r
+        r = self.app.get('/nf/admin/task_manager/metrics?hours=72')
+        assert 'math.floor' in r
+
     def test_site_notifications_access(self):
         self.app.get('/nf/admin/site_notifications', extra_environ=dict(
             username='test_user'), status=403)
@@ -24,11 +24,12 @@
 from datetime import datetime
 
 from pylons import tmpl_context as c
+from tg import config
 from nose.tools import assert_raises, assert_equal
 from nose import with_setup
 from mock import patch
 from ming.orm.ormsession import ThreadLocalORMSession
-from ming.orm import Mapper
+from ming.orm import Mapper, mapper, state
 from bson import ObjectId
 from webob import Request
 
@@ -190,6 +191,139 @@ def test_versioning():
     assert pg.history().count() == 3
 
 
+@with_setup(setUp, tearDown)
+def test_commit_many():
+    pages = [WM.Page(title='BulkPage%d' % i) for i in range(3)]
+    M.Artifact.insert_many(pages)
+    for pg in pages:
+        assert_equal(state(pg).status, state(pg).clean)
+    assert_equal(M.Shortlink.query.find(
+        dict(ref_id={'$in': [pg.index_id() for pg in pages]})).count(), 3)
+
+    snapshots = M.VersionedArtifact.commit_many(pages)
+    assert_equal([pg.version for pg in pages], [1, 1, 1])
+    assert_equal([ss.version for ss in snapshots], [1, 1, 1])
+    for pg in pages:
+        pg.text = 'changed'
+    snapshots = M.VersionedArtifact.commit_many(pages)
+    assert_equal([ss.version for ss in snapshots], [2, 2, 2])
+    assert_equal(snapshots[1].data.text, 'changed')
+
+    M.Artifact.update_many(pages)
+    for pg in pages:
+        assert_equal(state(pg).status, state(pg).clean)
+    ThreadLocalORMSession.close_all()
+    for pg in WM.Page.query.find(dict(title={'$in': ['BulkPage0', 'BulkPage1']})):
+        assert_equal(pg.text, 'changed')
+    assert_equal(WM.PageHistory.query.find(
+        dict(artifact_id=pages[1]._id)).count(), 2)
+
+
+def _commit_page_versions(title, count):
+    text = ''.join('Line %d of the page\n' % i for i in range(1000))
+    texts = []
+    pg = WM.Page(title=title)
+    for i in range(count):
+        pg.text = text.replace('Line %d ' % i, 'Edited line %d ' % i)
+        texts.append(pg.text)
+        pg.commit()
+        ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    return texts
+
+
+@with_setup(setUp, tearDown)
+def test_snapshot_deltas():
+    with h.push_config(config, **{'snapshot.keyframe_interval': '3'}):
+        texts = _commit_page_versions('DeltaPage', 5)
+    pg = WM.Page.query.get(title='DeltaPage')
+    history = pg.history().all()
+    assert_equal([ss.version for ss in history], [5, 4, 3, 2, 1])
+    assert_equal([ss.keyframe for ss in history], [4, None, 1, 1, None])
+    assert_equal([ss.text for ss in history], texts[::-1])
+    assert_equal(pg.get_version(3).data.text, texts[2])
+    assert_equal(pg.get_version(2).title, 'DeltaPage')
+    pg.revert(2)
+    assert_equal(pg.text, texts[1])
+
+    ThreadLocalORMSession.close_all()
+    ss = WM.PageHistory.query.get(artifact_id=pg._id, version=2)
+    assert_equal(ss.data.text, texts[1])
+    assert_equal(state(ss).document['data'], None)
+    assert len(ss.delta) < 1000
+
+    # deltas from the same keyframe share one query for it
+    ThreadLocalORMSession.close_all()
+    WM.PageHistory._keyframe_cache.clear()
+    with patch.object(WM.PageHistory, 'keyframe_data',
+                      wraps=WM.PageHistory.keyframe_data) as keyframe_data:
+        history = pg.history().all()
+        assert_equal([snapshot.text for snapshot in history], texts[::-1])
+    assert_equal(keyframe_data.call_count, 3)
+    assert_equal(len(WM.PageHistory._keyframe_cache), 2)
+
+
+@with_setup(setUp, tearDown)
+def test_compact_snapshots():
+    from allura.scripts.compact_snapshots import CompactSnapshots
+    with h.push_config(config, **{'snapshot.keyframe_interval': '1'}):
+        texts = _commit_page_versions('CompactPage', 4)
+    pg = WM.Page.query.get(title='CompactPage')
+    assert_equal([ss.keyframe for ss in pg.history()], [None] * 4)
+
+    converted, saved = CompactSnapshots.compact(WM.PageHistory, dry_run=True)
+    assert_equal(converted, 3)
+    assert_equal([ss.keyframe for ss in pg.history()], [None] * 4)
+    CompactSnapshots.compact(WM.PageHistory)
+    ThreadLocalORMSession.close_all()
+    history = pg.history().all()
+    assert_equal([ss.keyframe for ss in history], [1, 1, 1, None])
+    assert_equal([ss.text for ss in history], texts[::-1])
+    assert_equal(CompactSnapshots.compact(WM.PageHistory), (0, 0))
+
+
+@with_setup(setUp, tearDown)
+def test_compact_snapshots_concurrent_commit():
+    from allura.scripts.compact_snapshots import CompactSnapshots
+    with h.push_config(config, **{'snapshot.keyframe_interval': '1'}):
+        texts = _commit_page_versions('RacePage', 4)
+    pg = WM.Page.query.get(title='RacePage')
+    collection = mapper(WM.PageHistory).collection.m.collection
+    compact_artifact = CompactSnapshots.compact_artifact
+    computed = []
+
+    def commit_meanwhile(HC, collection, artifact_id):
+        # version 5 is stored as a delta from version 4, which is about to be
+        # converted to a delta itself
+        updates = compact_artifact(HC, collection, artifact_id)
+        computed.extend(updates)
+        page = WM.Page.query.get(_id=artifact_id)
+        page.text = texts[-1] + 'Version 5\n'
+        page.commit()
+        ThreadLocalORMSession.flush_all()
+        texts.append(page.text)
+        return updates
+    with patch.object(CompactSnapshots, 'compact_artifact', staticmethod(commit_meanwhile)):
+        converted, saved = CompactSnapshots.compact(WM.PageHistory)
+    assert_equal(converted, 2)
+    ThreadLocalORMSession.close_all()
+    WM.PageHistory._keyframe_cache.clear()
+    history = pg.history().all()
+    assert_equal([ss.keyframe for ss in history], [4, None, 1, 1, None])
+    assert_equal([ss.text for ss in history], texts[::-1])
+
+    # had version 4 been converted anyway, version 5 still reads
+    for (spec, update), size in computed:
+        if spec['version'] == 4:
+            collection.update(spec, update)
+    ThreadLocalORMSession.close_all()
+    WM.PageHistory._keyframe_cache.clear()
+    ss = WM.PageHistory.query.get(artifact_id=pg._id, version=4)
+    assert_equal(ss.keyframe, 1)
+    ss = WM.PageHistory.query.get(artifact_id=pg._id, version=5)
+    assert_equal(ss.data.text, texts[-1])
+
+
 @with_setup(setUp, tearDown)
 def test_messages_unknown_lookup():
     from bson import ObjectId
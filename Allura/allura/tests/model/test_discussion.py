@@ -141,6 +141,28 @@ def test_thread_new():
         assert_equals(t2_2.subject, 'Test Thread Two')
 
 
+@with_setup(setUp, tearDown)
+def test_post_many():
+    d = M.Discussion(shortname='test', name='test')
+    t1 = M.Thread.new(discussion_id=d._id, subject='Test Thread One')
+    t2 = M.Thread.new(discussion_id=d._id, subject='Test Thread Two')
+    ThreadLocalORMSession.flush_all()
+    posts, written = M.Thread.post_many(
+        [(t1, 'first'), (t2, 'second'), (t1, 'third')])
+    assert_equal([p.text for p in posts], ['first', 'second', 'third'])
+    assert_equal(len(written), 3 + 3 + 2)  # posts, snapshots, threads
+    for p in posts:
+        assert_equal(p.status, 'ok')
+        assert_equal(p.version, 1)
+    assert_equal((t1.num_replies, t2.num_replies), (2, 1))
+    ThreadLocalORMSession.close_all()
+    t1 = M.Thread.query.get(_id=t1._id)
+    assert_equal(t1.num_replies, 2)
+    assert_equal(sorted(p.text for p in t1.posts), ['first', 'third'])
+    assert_equal(M.PostHistory.query.find(
+        dict(artifact_id={'$in': [p._id for p in posts]})).count(), 3)
+
+
 @with_setup(setUp, tearDown)
 def test_post_methods():
     d = M.Discussion(shortname='test', name='test')
@@ -16,12 +16,16 @@
 #       under the License.
 
 import pprint
-from nose.tools import with_setup
+from datetime import datetime, timedelta
+from nose.tools import with_setup, assert_raises
+from tg import config
+import mock
 
 from ming.orm import ThreadLocalORMSession
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
+from allura.model.monq_model import TaskWakeup
 
 
 def setUp():
@@ -40,3 +44,141 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+def test_post_signals_wakeup():
+    with mock.patch('allura.model.monq_model.TaskWakeup.notify') as notify:
+        M.MonQTask.post(pprint.pformat, ([5, 6],))
+        notify.assert_called_once_with('pprint.pformat')
+        notify.reset_mock()
+        M.MonQTask.post(pprint.pformat, ([5, 6],), delay=60)
+        assert not notify.called
+
+
+@mock.patch('allura.model.monq_model.TaskWakeup._collection', None)
+@mock.patch('allura.model.monq_model.task_doc_session')
+def test_wakeup_collection_cached(session):
+    db = session.db
+    db.collection_names.return_value = []
+    collection = TaskWakeup.collection()
+    assert collection is db.__getitem__.return_value
+    assert TaskWakeup.collection() is collection
+    assert db.collection_names.call_count == 1
+    assert db.create_collection.call_count == 1
+    session.db = other_db = mock.MagicMock()
+    other_db.collection_names.return_value = ['monq_task_signal']
+    assert TaskWakeup.collection() is other_db.__getitem__.return_value
+    assert not other_db.create_collection.called
+
+
+@with_setup(setUp)
+def test_batch():
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],), priority=10 - i)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='batch worker', limit=2)
+    assert [t.args[0] for t in tasks] == [[0], [1]], tasks
+    assert M.MonQTask.query.find(dict(state='busy')).count() == 2
+    results = M.MonQTask.run_batch(tasks)
+    assert len(results) == 2 and results[1].endswith('[1]'), results
+    ThreadLocalORMSession.close_all()
+    done = M.MonQTask.query.find(dict(state='complete')).all()
+    assert sorted(t.args[0] for t in done) == [[0], [1]]
+    assert all(t.time_stop for t in done)
+    assert len(M.MonQTask.get_batch(process='batch worker', limit=2)) == 1
+    assert M.MonQTask.get_batch(process='batch worker', limit=2) == []
+
+
+@with_setup(setUp)
+def test_batch_raise_errors():
+    M.MonQTask.post(pprint.pformat, ([0],), priority=10)
+    M.MonQTask.post(int, ('not a number',), priority=9)
+    M.MonQTask.post(pprint.pformat, ([2],), priority=8)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='batch worker', limit=3)
+    with mock.patch.dict(config, {'monq.raise_errors': 'true'}):
+        assert_raises(ValueError, M.MonQTask.run_batch, tasks)
+    ThreadLocalORMSession.close_all()
+    error = M.MonQTask.query.get(state='error')
+    assert 'ValueError' in error.result, error.result
+    assert M.MonQTask.query.get(state='complete').args == [[0]]
+    assert M.MonQTask.query.get(state='ready').args == [[2]]
+
+
+@with_setup(setUp)
+def test_coalesce():
+    def merge(old_args, old_kwargs, args, kwargs):
+        return [old_args[0] + args[0]], old_kwargs
+    first = M.MonQTask.post(pprint.pformat, ([1],), coalesce_key='k', merge=merge)
+    second = M.MonQTask.post(pprint.pformat, ([2],), coalesce_key='k', merge=merge)
+    assert second._id == first._id
+    assert second.args == [[1, 2]], second.args
+    assert second.coalesced == 1
+    other = M.MonQTask.post(pprint.pformat, ([3],), coalesce_key='other', merge=merge)
+    assert other._id != first._id
+    # started tasks are left alone
+    M.MonQTask.query.update({'_id': first._id}, {'$set': {'state': 'busy'}})
+    third = M.MonQTask.post(pprint.pformat, ([4],), coalesce_key='k', merge=merge)
+    assert third._id != first._id
+    assert third.args == [[4]]
+
+
+@with_setup(setUp)
+def test_coalesce_barriers():
+    def merge(old_args, old_kwargs, args, kwargs):
+        return [old_args[0] + args[0]], old_kwargs
+    kw = dict(coalesce_key='k', merge=merge, barriers=['pprint.pprint'])
+    first = M.MonQTask.post(pprint.pformat, (['a'],), **kw)
+    M.MonQTask.post(pprint.pprint, (['b'],))
+    # the barrier doesn't touch 'c'
+    second = M.MonQTask.post(pprint.pformat, (['c'],), **kw)
+    assert second._id == first._id
+    # but it does 'b', which is re-added after it
+    third = M.MonQTask.post(pprint.pformat, (['b'],), **kw)
+    assert third._id != first._id
+    assert third.args == [['b']]
+    # later posts go to the latest task
+    fourth = M.MonQTask.post(pprint.pformat, (['d'],), **kw)
+    assert fourth._id == third._id
+    assert fourth.args == [['b', 'd']]
+    assert M.MonQTask.query.get(_id=first._id).args == [['a', 'c']]
+
+
+def test_task_name_pattern():
+    pattern = M.MonQTask.task_name_pattern
+    assert pattern('allura.tasks.index_tasks.add_artifacts') == 'allura.tasks.index_tasks.add_artifacts'
+    assert pattern('index_tasks.*').search('allura.tasks.index_tasks.add_artifacts')
+    assert pattern('*.add_artifacts').search('allura.tasks.index_tasks.add_artifacts')
+    assert not pattern('index_tasks.*').search('allura.tasks.repo_tasks.refresh')
+    assert not pattern('tasks.*').search('allura.mytasks.foo')
+    assert M.MonQTask.task_name_spec() is None
+    spec = M.MonQTask.task_name_spec(only=['a.b'], exclude=['repo_tasks.*'])
+    assert spec['$in'] == ['a.b']
+    assert spec['$nin'][0].search('allura.tasks.repo_tasks.refresh')
+
+
+def test_metrics_update():
+    now = datetime(2015, 10, 1, 12, 30)
+    task = mock.Mock(task_name='a.b', state='error',
+                     time_queue=now - timedelta(seconds=2),
+                     time_start=now, time_stop=now + timedelta(seconds=0.07))
+    spec, update = M.MonQTaskMetrics._update(task)
+    assert spec == dict(task_name='a.b', period=datetime(2015, 10, 1, 12)), spec
+    assert update['$inc']['count'] == 1
+    assert update['$inc']['errors'] == 1
+    assert update['$inc']['wait_hist.5'] == 1, update
+    assert update['$inc']['run_hist.2'] == 1, update
+    assert update['$max'] == dict(wait_max=2.0, run_max=0.07)
+
+
+def test_metrics_percentile():
+    percentile = M.MonQTaskMetrics.percentile
+    hist = {'0': 90, '4': 9, '12': 1}
+    assert percentile(hist, 100, 0.5, 5000) == 0.01
+    assert percentile(hist, 100, 0.99, 5000) == 1
+    assert percentile(hist, 100, 1, 5000) == 5000
+    assert percentile(hist, 100, 0.99, 0.5) == 0.5
+    assert percentile({}, 0, 0.5, 0) is None
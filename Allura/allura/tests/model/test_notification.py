@@ -20,10 +20,12 @@
 import collections
 
 from pylons import tmpl_context as c, app_globals as g
-from nose.tools import assert_equal, assert_in
+from tg import config
+from nose.tools import assert_equal, assert_in, assert_raises
 from ming.orm import ThreadLocalORMSession
 import mock
 import bson
+import pymongo.errors
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
@@ -213,6 +215,48 @@ def test_delivery(self):
         assert len(mbox.queue) == 1
         assert not mbox.queue_empty
 
+    def test_delivery_many(self):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe(user=user2)
+        M.Mailbox.deliver('nid', self.pg.index_id(), 'metadata')
+        mboxes = M.Mailbox.query.find().all()
+        assert_equal(len(mboxes), 2)
+        for mbox in mboxes:
+            assert_equal(mbox.queue, ['nid'])
+            assert not mbox.queue_empty
+
+    @mock.patch('allura.model.notification.log')
+    @mock.patch('allura.model.notification.bulk_write')
+    def test_delivery_error(self, bulk_write, log):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe(user=user2)
+        bulk_write.side_effect = pymongo.errors.BulkWriteError(
+            {'writeErrors': [{'index': 1, 'errmsg': 'failed'}]})
+        M.Mailbox.deliver('nid', self.pg.index_id(), 'metadata')
+        updates = bulk_write.call_args[1]['updates']
+        assert_equal(len(updates), 2)
+        mbox = M.Mailbox.query.get(_id=updates[1][0]['_id'])
+        assert_equal(log.error.call_count, 1)
+        assert_equal(log.error.call_args[0][4], mbox.user_id)
+
+    @mock.patch('allura.model.notification.bulk_write')
+    def test_delivery_bulk_failure(self, bulk_write):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe(user=user2)
+        mbox = M.Mailbox.query.get(user_id=user2._id)
+        M.Mailbox.query.update({'_id': mbox._id}, {'$push': {'queue': 'nid'}})
+        bulk_write.side_effect = pymongo.errors.AutoReconnect('connection lost')
+        M.Mailbox.deliver('nid', self.pg.index_id(), 'metadata')
+        ThreadLocalORMSession.close_all()
+        # delivered one by one, once to each mailbox
+        mboxes = M.Mailbox.query.find().all()
+        assert_equal(len(mboxes), 2)
+        for mbox in mboxes:
+            assert_equal(mbox.queue, ['nid'])
+
     def test_email(self):
         self._subscribe()  # as current user: test-admin
         user2 = M.User.query.get(username='test-user-2')
@@ -368,6 +412,61 @@ def _test_message(self):
         u = M.User.by_username('test-admin')
         assert str(u._id) in msg.kwargs['fromaddr'], msg.kwargs['fromaddr']
 
+    def test_fire_ready_batches(self):
+        self._subscribe()
+        self._post_notification(text='A')
+        self._post_notification(text='B')
+        ThreadLocalORMSession.flush_all()
+        with h.push_config(config, **{'mailbox.fire.batch_size': '1'}):
+            M.MonQTask.run_ready()
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        mboxes = M.Mailbox.query.find(dict(type='direct')).all()
+        assert_equal(len(mboxes), 1)
+        assert_equal(mboxes[0].queue, [])
+        assert_equal(mboxes[0].queue_empty, True)
+        assert_equal(mboxes[0].fire_claim, None)
+        assert M.MonQTask.query.get(
+            task_name='allura.tasks.mail_tasks.sendmail')
+
+    @mock.patch('allura.lib.mail_util.SMTPSenderPool')
+    def test_fire_ready_sender_pool(self, SMTPSenderPool):
+        self._subscribe()
+        self._post_notification(text='Fanned out')
+        ThreadLocalORMSession.flush_all()
+        sendmail = dict(task_name='allura.tasks.mail_tasks.sendmail')
+        sendmail_tasks = M.MonQTask.query.find(sendmail).count()
+        with h.push_config(config, **{'mailbox.fire.concurrency': '2'}):
+            M.MonQTask.run_ready()
+        SMTPSenderPool.assert_called_with(2)
+        pool = SMTPSenderPool.return_value
+        assert_equal(pool.submit.call_count, 1)
+        messages = pool.submit.call_args[0][0]
+        assert_equal(len(messages), 3)
+        assert_equal(sum(len(m['addrs']) for m in messages), 1)
+        assert_in('Fanned out', messages[0]['message'].as_string())
+        assert pool.join.called
+        assert_equal(M.MonQTask.query.find(sendmail).count(), sendmail_tasks)
+
+    def test_fire_ready_error(self):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self.pg.subscribe(type='direct', user=user2)
+        ThreadLocalORMSession.flush_all()
+        for i, mbox in enumerate(M.Mailbox.query.find().all()):
+            M.Mailbox.query.update({'_id': mbox._id}, {'$set': dict(
+                queue=['n%s' % i], queue_empty=False)})
+        with mock.patch.object(M.Mailbox, 'fire') as fire:
+            fire.side_effect = [None, ValueError('cannot fire')]
+            assert_raises(ValueError, M.Mailbox.fire_ready)
+        ThreadLocalORMSession.close_all()
+        # the queue of the mailbox which raised isn't lost
+        queues = sorted(mbox.queue for mbox in M.Mailbox.query.find())
+        assert_equal(len(queues), 2)
+        assert_equal(queues[0], [])
+        assert_in(queues[1], [['n0'], ['n1']])
+        assert_equal(M.Mailbox.query.find(dict(queue_empty=False)).count(), 1)
+
     def _clear_subscriptions(self):
         M.Mailbox.query.remove({})
         ThreadLocalORMSession.flush_all()
@@ -96,6 +96,43 @@ def test_repair_commit_run(self):
         self.assertEqual(len(run.commit_ids), len(run.commit_times))
         self.assertEqual(run.parent_commit_ids, [])
 
+    def test_extend_commit_run(self):
+        commit_ids = list(self.repo.all_commit_ids())
+        # simulate pushes in both directions
+        for order in (reversed(commit_ids), commit_ids):
+            M.repository.CommitRunDoc.m.remove()
+            for c_id in order:
+                M.repo_refresh.CommitRunBuilder([c_id]).extend()
+            runs = M.repository.CommitRunDoc.m.find().all()
+            self.assertEqual(len(runs), 1)
+            run = runs[0]
+            self.assertEqual(run.commit_ids, commit_ids)
+            self.assertEqual(len(run.commit_ids), len(run.commit_times))
+            self.assertEqual(run.parent_commit_ids, [])
+        self.assertEqual(M.repo_refresh.check_commit_runs(commit_ids), [])
+
+    def test_check_and_repair_commit_runs(self):
+        from allura.scripts.repair_commit_runs import RepairCommitRuns
+        M.repository.CommitRunDoc.m.remove()
+        commit_ids = list(self.repo.all_commit_ids())
+        # leave the oldest commit out of the runs, and break the run
+        crb = M.repo_refresh.CommitRunBuilder(commit_ids[:-1])
+        crb.run()
+        run = M.repository.CommitRunDoc.m.get(_id=commit_ids[0])
+        run.commit_times = []
+        run.m.save()
+        problems = M.repo_refresh.check_commit_runs(commit_ids)
+        self.assertIn((None, 'commit %s is in no run' % commit_ids[-1]),
+                      problems)
+        self.assertIn(commit_ids[0], [run_id for run_id, p in problems])
+        RepairCommitRuns.repair(self.repo, dry_run=True)
+        self.assertEqual(M.repo_refresh.check_commit_runs(commit_ids), problems)
+        RepairCommitRuns.repair(self.repo)
+        self.assertEqual(M.repo_refresh.check_commit_runs(commit_ids), [])
+        runs = M.repository.CommitRunDoc.m.find().all()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0].commit_ids, commit_ids)
+
 
 class RepoTestBase(unittest.TestCase):
     def setUp(self):
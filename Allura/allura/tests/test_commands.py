@@ -26,7 +26,7 @@
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-    create_neighborhood, show_models, taskd_cleanup
+    create_neighborhood, show_models, taskd_cleanup, taskd
 from allura import model as M
 from allura.lib.exceptions import InvalidNBFeatureValueError
 from allura.tests import decorators as td
@@ -262,6 +262,21 @@ def test_update_indexes_unique_changes(self):
         ])
 
 
+def test_taskd_parse_pools():
+    pools = taskd.parse_pools('index_tasks.*=8, repo_tasks.*=2,mail_tasks.*|notification_tasks.*=3,*=4')
+    assert_equal(pools, [
+        (['index_tasks.*'], 8),
+        (['repo_tasks.*'], 2),
+        (['mail_tasks.*', 'notification_tasks.*'], 3),
+        (['*'], 4),
+    ])
+    assert_equal(taskd.pool_task_names(pools, 0), (['index_tasks.*'], None))
+    assert_equal(taskd.pool_task_names(pools, 3), (
+        None, ['index_tasks.*', 'repo_tasks.*', 'mail_tasks.*', 'notification_tasks.*']))
+    assert_equal(taskd.pool_task_names([(['*'], 4)], 0), (None, None))
+    assert_raises(ValueError, taskd.parse_pools, '8')
+
+
 class TestTaskdCleanupCommand(object):
 
     def setUp(self):
@@ -417,7 +432,7 @@ def test_skip_solr_delete(self, g):
         cmd.run([test_config, '-p', 'test', '--solr', '--skip-solr-delete'])
         assert not g.solr.delete.called, 'solr.delete() must not be called'
 
-    @patch('pysolr.Solr')
+    @patch('allura.lib.solr.PersistentSolr')
     def test_solr_hosts_1(self, Solr):
         cmd = show_models.ReindexCommand('reindex')
         cmd.options, args = cmd.parser.parse_args([
@@ -425,7 +440,7 @@ def test_solr_hosts_1(self, Solr):
         cmd._chunked_add_artifacts(list(range(10)))
         assert_equal(Solr.call_args[0][0], 'http://blah.com/solr/forge')
 
-    @patch('pysolr.Solr')
+    @patch('allura.lib.solr.PersistentSolr')
     def test_solr_hosts_list(self, Solr):
         cmd = show_models.ReindexCommand('reindex')
         cmd.options, args = cmd.parser.parse_args([
@@ -471,7 +486,8 @@ def on_post(chunk, **kw):
         cmd = show_models.ReindexCommand('reindex')
         cmd.options, args = cmd.parser.parse_args([])
         cmd._post_add_artifacts(range(5))
-        kw = {'update_solr': cmd.options.solr, 'update_refs': cmd.options.refs}
+        kw = {'update_solr': cmd.options.solr, 'update_refs': cmd.options.refs,
+              'coalesce': False}
         expected = [
             call([0, 1, 2, 3, 4], **kw),
             call([0, 1], **kw),
@@ -54,3 +54,20 @@ def mock_post(f, args, kw, delay=None):
         c.project.notifications_disabled = False
         MonQTask.post.side_effect = mock_post
         func.post('test', foo=2, delay=1)
+
+    @patch('allura.lib.decorators.c')
+    @patch('allura.model.MonQTask')
+    def test_post_coalesce(self, MonQTask, c):
+        merge = lambda *a: None
+
+        @task(coalesce=merge)
+        def func(ids):
+            pass
+
+        func.post([1])
+        self.assertEqual(MonQTask.post.call_args[1]['merge'], merge)
+        self.assertEqual(MonQTask.post.call_args[1]['coalesce_key'], '[]')
+        func.post([2], coalesce=False)
+        self.assertEqual(MonQTask.post.call_args[1]['merge'], None)
+        self.assertEqual(MonQTask.post.call_args[1]['coalesce_key'], None)
+        self.assertEqual(MonQTask.post.call_args[0][2], {})
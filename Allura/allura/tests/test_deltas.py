@@ -0,0 +1,63 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import unittest
+from datetime import datetime
+
+from bson import ObjectId
+
+from allura.lib import deltas
+
+
+class TestDeltas(unittest.TestCase):
+
+    def setUp(self):
+        self.text = u''.join(u'Line %d of the text\n' % i for i in range(1000))
+        self.base = dict(
+            _id=ObjectId(),
+            title=u'Title',
+            text=self.text,
+            labels=[u'one', u'two'],
+            mod_date=datetime(2015, 1, 1),
+            removed=u'value')
+
+    def test_round_trip(self):
+        doc = dict(self.base,
+                   title=u'New title',
+                   text=self.text.replace(u'Line 10 ', u'Line ten\nLine 10 ') + u'end',
+                   labels=[u'two'],
+                   added={u'key': u'value'})
+        del doc['removed']
+        delta = deltas.encode(self.base, doc)
+        self.assertEqual(deltas.apply(self.base, delta), doc)
+        self.assertTrue(len(delta) < 200)
+        self.assertTrue(deltas.size(doc) > 10000)
+        self.assertEqual(self.base['removed'], u'value')
+
+    def test_no_changes(self):
+        delta = deltas.encode(self.base, self.base)
+        self.assertEqual(deltas.apply(self.base, delta), self.base)
+
+    def test_short_and_non_text_values(self):
+        base = dict(text=u'short', n=1)
+        doc = dict(text=u'x' * 300 + u'short', n=u'a' * 300)
+        self.assertEqual(deltas.apply(base, deltas.encode(base, doc)), doc)
+
+    def test_unicode(self):
+        base = dict(text='caf\xc3\xa9\n' * 100)
+        doc = dict(text=u'caf\xe9\n' * 100 + u'na\xefve\n')
+        self.assertEqual(deltas.apply(base, deltas.encode(base, doc)), doc)
@@ -43,6 +43,7 @@
 from allura import model as M
 from allura.lib import helpers as h
 from allura.lib.app_globals import ForgeMarkdown, NeighborhoodCache
+from allura.lib.markdown_cache import MarkdownRenderCache, MacroOutputCache
 from allura.tests import decorators as td
 
 from forgewiki import model as WM
@@ -751,6 +752,146 @@ def test_all_expected_keys_exist_in_cache(self):
         self.assertEqual(required_keys, keys)
 
 
+class TestMarkdownRenderCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = MarkdownRenderCache(size=2)
+        cache.set('a', u'A')
+        cache.set('b', u'B')
+        self.assertEqual(cache.get('a'), u'A')
+        cache.set('c', u'C')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), u'A')
+        self.assertEqual(cache.get('c'), u'C')
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_store(self):
+        store = Mock()
+        store.get.return_value = u'<p>x</p>'
+        cache = MarkdownRenderCache(size=10, store=store)
+        self.assertEqual(cache.get('k'), u'<p>x</p>')
+        self.assertEqual(cache.get('k'), u'<p>x</p>')
+        store.get.assert_called_once_with('k')
+        cache.set('j', u'J')
+        store.set.assert_called_once_with('j', u'J')
+        store.get.side_effect = Exception
+        self.assertIsNone(cache.get('missing'))
+
+    def test_from_config(self):
+        self.assertIsNone(MarkdownRenderCache.from_config(
+            {'markdown_render_cache.size': '0'}, {}))
+        store = Mock()
+        cache = MarkdownRenderCache.from_config(
+            {'markdown_render_cache.store': 'mongo'}, {'mongo': store})
+        self.assertEqual(cache.size, 1000)
+        self.assertEqual(cache.store, store.return_value)
+
+    def test_key(self):
+        key = MarkdownRenderCache.key(u'å', 'conf', 3)
+        self.assertEqual(key, MarkdownRenderCache.key(u'å', 'conf', 3))
+        self.assertNotEqual(key, MarkdownRenderCache.key(u'b', 'conf', 3))
+        self.assertNotEqual(key, MarkdownRenderCache.key(u'å', 'other', 3))
+        self.assertNotEqual(key, MarkdownRenderCache.key(u'å', 'conf', 4))
+
+    def _markdown(self, cache, **kw):
+        md = g.forge_markdown(**kw)
+        md._render_cache = lambda: cache
+        return md
+
+    def test_shared_by_instances(self):
+        cache = MarkdownRenderCache(size=10)
+        html = self._markdown(cache).convert(u'**bold**')
+        with patch('markdown.Markdown.convert') as convert:
+            self.assertEqual(self._markdown(cache).convert(u'**bold**'), html)
+            self.assertFalse(convert.called)
+            # differently configured markdown isn't served the same html
+            self._markdown(cache, email=True).convert(u'**bold**')
+            self.assertTrue(convert.called)
+
+    def test_context_dependent_not_cached(self):
+        cache = MarkdownRenderCache(size=10)
+        for text in [u'[[projects]]', u'[NoSuchPage]', u'**bold**']:
+            self._markdown(cache).convert(text)
+        # the [[projects]] skeleton and **bold**, but not the link
+        self.assertEqual(len(cache._data), 2)
+
+    def test_macros_evaluated_per_convert(self):
+        cache = MarkdownRenderCache(size=10)
+        text = u'Members:\n\n[[members]]\n\nand **more**'
+        plain = g.forge_markdown()
+        plain._render_cache = lambda: None
+        self.assertEqual(self._markdown(cache).convert(text), plain.convert(text))
+        members = Mock(return_value=u'<div>Someone</div>', macro_cache=None)
+        with patch('markdown.Markdown.convert') as convert, \
+                patch.dict('allura.lib.macro._macros', members=(members, None)):
+            html = self._markdown(cache).convert(text)
+        self.assertFalse(convert.called)
+        members.assert_called_once_with()
+        assert_in(u'<div>Someone</div>', html)
+        assert_in(u'<strong>more</strong>', html)
+
+    def test_macro_placeholders_in_text(self):
+        cache = MarkdownRenderCache(size=10)
+        text = u'[[members]] ALLURAMACRO6d656d62657273ENDMACRO'
+        html = self._markdown(cache).convert(text)
+        assert_in(u'ALLURAMACRO6d656d62657273ENDMACRO', html)
+        self.assertEqual(len(cache._data), 0)
+
+    def test_uncacheable_extensions(self):
+        self.assertEqual(
+            ForgeMarkdown._render_cache_key(['tables', 'nl2br'], 'html4'),
+            'html4:tables,nl2br')
+        self.assertIsNone(
+            ForgeMarkdown._render_cache_key(['tables', object()], 'html4'))
+
+
+class TestMacroOutputCache(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def my_macro(arg=None):
+            self.calls.append(arg)
+            macro_g.resource_manager.register('resource-%s' % arg)
+            return u'<b>%s</b>' % arg
+        my_macro.macro_cache = 'user'
+        my_macro.macro_cache_ttl = 60
+        self.my_macro = my_macro
+        patcher = patch('allura.lib.macro.g')
+        macro_g = patcher.start()
+        self.addCleanup(patcher.stop)
+        macro_g.macro_cache = MacroOutputCache(10)
+        self.g = macro_g
+
+    def _call(self, user_id=1, **args):
+        from allura.lib.macro import call_macro
+        with h.push_config(c, project=Mock(_id=1), user=Mock(_id=user_id)):
+            return call_macro(self.my_macro, args)
+
+    def test_cached(self):
+        self.assertEqual(self._call(arg='a'), u'<b>a</b>')
+        self.assertEqual(self._call(arg='a'), u'<b>a</b>')
+        self.assertEqual(self.calls, ['a'])
+        # resources are registered again from the cache
+        self.assertEqual(self.g.resource_manager.register.call_args_list,
+                         [((u'resource-a',),)] * 2)
+        self._call(arg='b')
+        self._call(user_id=2, arg='a')
+        self.assertEqual(self.calls, ['a', 'b', 'a'])
+
+    def test_not_cached(self):
+        self.my_macro.macro_cache = None
+        self._call(arg='a')
+        self._call(arg='a')
+        self.assertEqual(self.calls, ['a', 'a'])
+
+    def test_expired(self):
+        self.my_macro.macro_cache_ttl = -1
+        self._call(arg='a')
+        self._call(arg='a')
+        self.assertEqual(self.calls, ['a', 'a'])
+
+
 class TestHandlePaging(unittest.TestCase):
 
     def setUp(self):
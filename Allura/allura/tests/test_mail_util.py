@@ -18,12 +18,14 @@
 #       under the License.
 
 import unittest
+import smtplib
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
 
 import mock
 from nose.tools import raises, assert_equal, assert_false, assert_true
 from ming.orm import ThreadLocalORMSession
+from tg import config as tg_config
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.lib.utils import ConfigProxy
@@ -35,7 +37,9 @@
     is_autoreply,
     identify_sender,
     _parse_message_id,
+    SMTPClient,
 )
+from allura.lib import helpers as h
 from allura.lib.exceptions import AddressException
 from allura.tests import decorators as td
 
@@ -227,6 +231,76 @@ def test_no_match(self, EA, User):
                      [mock.call(email='arg', confirmed=True), mock.call(email='from')])
 
 
+class TestSMTPClient(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        self.client = SMTPClient()
+
+    def _send(self, subject=u'Test'):
+        self.client.sendmail(
+            [u'foo@example.com'], u'bar@example.com', u'bar@example.com',
+            subject, u'msg@example.com', None, MIMEText('Test'))
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_session_reused(self, SMTP):
+        self._send()
+        self._send()
+        assert_equal(SMTP.call_count, 1)
+        assert_equal(SMTP.return_value.sendmail.call_count, 2)
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_send_batch(self, SMTP):
+        self.client.send_batch([
+            dict(addrs=[u'foo@example.com'], fromaddr=u'bar@example.com',
+                 reply_to=u'bar@example.com', subject=u'Test %s' % i,
+                 message_id=u'msg%s@example.com' % i, in_reply_to=None,
+                 message=MIMEText('Test'))
+            for i in range(3)])
+        assert_equal(SMTP.call_count, 1)
+        assert_equal(SMTP.return_value.sendmail.call_count, 3)
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_reconnect_on_failure(self, SMTP):
+        first, second = mock.Mock(), mock.Mock()
+        first.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        SMTP.side_effect = [first, second]
+        self._send()
+        assert_equal(SMTP.call_count, 2)
+        assert_equal(second.sendmail.call_count, 1)
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    @raises(smtplib.SMTPRecipientsRefused)
+    def test_refused_not_retried(self, SMTP):
+        SMTP.return_value.sendmail.side_effect = smtplib.SMTPRecipientsRefused({})
+        try:
+            self._send()
+        finally:
+            assert_equal(SMTP.call_count, 1)
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_keepalive(self, SMTP):
+        first, second = mock.Mock(), mock.Mock()
+        first.noop.side_effect = smtplib.SMTPServerDisconnected()
+        SMTP.side_effect = [first, second]
+        self._send()
+        # still fresh: no check
+        self._send()
+        assert_equal(first.noop.call_count, 0)
+        self.client._last_used -= 3600
+        self._send()
+        assert_equal(first.noop.call_count, 1)
+        assert_equal(SMTP.call_count, 2)
+        assert_equal(second.sendmail.call_count, 1)
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_max_messages(self, SMTP):
+        with h.push_config(tg_config, smtp_max_messages='2'):
+            for i in range(5):
+                self._send()
+        assert_equal(SMTP.call_count, 3)
+
+
 def test_parse_message_id():
     assert_equal(_parse_message_id('<de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net>, </p/libjpeg-turbo/patches/54/de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net>'), [
         'de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net',
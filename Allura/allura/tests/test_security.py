@@ -15,14 +15,17 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+from bson import ObjectId
 from pylons import tmpl_context as c
 from nose.tools import assert_equal
+from mock import patch
 
 from ming.odm import ThreadLocalODMSession
 from allura.tests import decorators as td
 from allura.tests import TestController
 
-from allura.lib.security import Credentials, all_allowed, has_access
+from allura.lib.security import Credentials, DecisionCache, AccessFilter
+from allura.lib.security import all_allowed, has_access
 from allura import model as M
 from forgewiki import model as WM
 
@@ -190,3 +193,140 @@ def test_deny_access_for_single_user(self):
             M.ACE.deny(M.ProjectRole.by_user(user, upsert=True)._id, 'read', 'Spammer'))
         Credentials.get().clear()
         assert not has_access(wiki, 'read', user)()
+
+    @td.with_wiki
+    def test_decision_cache(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        auth_role = M.ProjectRole.by_name('*authenticated')
+        test_user = M.User.by_username('test-user')
+        cred = Credentials.get()
+        cred.clear()
+        assert has_access(page, 'read', test_user)()
+        misses = cred.decision_misses
+        assert has_access(page, 'read', test_user)()
+        assert_equal(cred.decision_misses, misses)
+        assert cred.decision_hits > 0
+
+        # changing the object's ACL changes the decision key
+        page.acl.insert(0, M.ACE.deny(auth_role._id, 'read'))
+        assert not has_access(page, 'read', test_user)()
+        page.acl.pop(0)
+        # and so do the ACLs of its parents
+        wiki.config.acl.insert(0, M.ACE.deny(auth_role._id, 'read'))
+        assert not has_access(page, 'read', test_user)()
+        wiki.config.acl.pop(0)
+        assert has_access(page, 'read', test_user)()
+        # shared decisions expire
+        cred.clear()
+        misses = cred.decision_cache.misses
+        with patch('allura.lib.security.time') as time:
+            time.time.return_value = 2 ** 40
+            assert has_access(page, 'read', test_user)()
+        assert cred.decision_cache.misses > misses
+
+    @td.with_wiki
+    def test_decision_cache_admin(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        test_user = M.User.by_username('test-user')
+        user_role = M.ProjectRole.by_user(test_user, upsert=True)
+        ThreadLocalODMSession.flush_all()
+        Credentials.get().clear()
+        page.acl = wiki.config.acl = []
+        assert not has_access(page, 'read', test_user)()
+        # the project admin check is part of the decision
+        page.project.acl.append(M.ACE.allow(user_role._id, 'admin'))
+        assert has_access(page, 'read', test_user)()
+
+    @td.with_wiki
+    def test_decision_cache_role_change(self):
+        wiki = c.project.app_instance('wiki')
+        member_role = M.ProjectRole.by_name('Member')
+        test_user = M.User.by_username('test-user')
+        assert not has_access(wiki, 'create', test_user)()
+        # saving the role clears the cached roles of the project
+        M.ProjectRole.by_user(
+            test_user, upsert=True).roles.append(member_role._id)
+        ThreadLocalODMSession.flush_all()
+        assert has_access(wiki, 'create', test_user)()
+
+
+class TestDecisionCache(object):
+
+    def test_lru(self):
+        cache = DecisionCache(2)
+        assert_equal(cache.get('a'), None)
+        cache.set('a', True)
+        cache.set('b', False)
+        assert_equal(cache.get('a'), True)
+        cache.set('c', True)
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('a'), True)
+        assert_equal(cache.get('c'), True)
+        assert_equal((cache.hits, cache.misses), (3, 2))
+
+    @patch('allura.lib.security.time')
+    def test_max_age(self, time):
+        cache = DecisionCache(2, max_age=60)
+        time.time.return_value = 1000
+        cache.set('a', True)
+        time.time.return_value = 1060
+        assert_equal(cache.get('a'), True)
+        time.time.return_value = 1061
+        assert_equal(cache.get('a'), None)
+
+    def test_from_config(self):
+        assert_equal(DecisionCache.from_config({}), None)
+        cache = DecisionCache.from_config(
+            {'security.decision_cache.size': '5',
+             'security.decision_cache.max_age': '10'})
+        assert_equal((cache.size, cache.max_age), (5, 10))
+
+
+class TestAccessFilter(object):
+
+    def _filter(self, inherited, role_ids):
+        access = AccessFilter.__new__(AccessFilter)
+        access.permission = 'read'
+        access.inherited = inherited
+        access.role_ids = role_ids
+        return access
+
+    def test_admin(self):
+        access = self._filter(True, None)
+        assert_equal(access.mongo_query({'a': 1}), {'a': 1})
+        assert_equal(access.solr_filter(), [])
+        access = self._filter(False, None)
+        assert_equal(access.mongo_query({'a': 1}),
+                     {'a': 1, 'acl': {'$ne': []}})
+        assert_equal(access.solr_filter(), ['private_b:True'])
+
+    def test_roles(self):
+        rid = ObjectId()
+        access = self._filter(True, [rid])
+        allowed = {'acl': {'$elemMatch': {
+            'access': M.ACE.ALLOW,
+            'role_id': {'$in': [rid, M.EVERYONE]},
+            'permission': {'$in': ['read', M.ALL_PERMISSIONS]}}}}
+        assert_equal(access.mongo_query({'a': 1}),
+                     {'a': 1, '$or': [{'acl': []}, allowed]})
+        assert_equal(access.mongo_query({'$or': [{'a': 1}]}),
+                     {'$and': [{'$or': [{'a': 1}]},
+                               {'$or': [{'acl': []}, allowed]}]})
+        assert_equal(access.solr_filter(), [
+            'private_b:False OR read_roles_ws:%s OR read_roles_ws:everyone' % rid])
+        access = self._filter(False, [rid])
+        assert_equal(access.mongo_query(), allowed)
+
+    def test_nothing(self):
+        access = self._filter(False, [])
+        assert_equal(access.mongo_query(), {'_id': {'$in': []}})
+        assert_equal(access.solr_filter(), ['-*:*'])
+
+    def test_index_roles(self):
+        rid = ObjectId()
+        acl = [M.ACE.allow(rid, 'read'), M.ACE.allow(rid, 'post'),
+               M.ACE.allow(M.EVERYONE, M.ALL_PERMISSIONS), M.DENY_ALL]
+        assert_equal(AccessFilter.index_roles(acl, 'read'),
+                     '%s everyone' % rid)
@@ -38,7 +38,7 @@
 from allura import model as M
 from allura.lib import helpers as h
 from allura.lib import search
-from allura.lib.exceptions import CompoundError
+from allura.lib.exceptions import CompoundError, ForgeError
 from allura.tasks import event_tasks
 from allura.tasks import index_tasks
 from allura.tasks import mail_tasks
@@ -143,10 +143,10 @@ def test_del_projects(self):
 
     @td.with_wiki
     def test_add_artifacts(self):
-        from allura.lib.search import find_shortlinks
-        with mock.patch('allura.lib.search.find_shortlinks') as find_slinks:
-            find_slinks.side_effect = lambda s: find_shortlinks(s)
-
+        from allura.lib.app_globals import Globals
+        with mock.patch.object(Globals, 'pooled_markdown', autospec=True,
+                               side_effect=Globals.pooled_markdown) as pooled_markdown, \
+                mock.patch('allura.lib.search.find_shortlinks') as find_slinks:
             old_shortlinks = M.Shortlink.query.find().count()
             old_solr_size = len(g.solr.db)
             artifacts = [_TestArtifact() for x in range(5)]
@@ -167,8 +167,105 @@ def test_add_artifacts(self):
             M.main_orm_session.clear()
             t3 = _TestArtifact.query.get(_shorthand_id='t3')
             assert len(t3.backrefs) == 5, t3.backrefs
-            assert_equal(find_slinks.call_args_list,
-                         [mock.call(a.index().get('text')) for a in artifacts])
+            # one markdown render per artifact gives text and shortlinks
+            assert_equal(pooled_markdown.call_count, 5)
+            assert_equal(find_slinks.call_count, 0)
+
+    def test_add_artifacts_coalesced_around_del(self):
+        M.MonQTask.query.remove()
+        index_tasks.add_artifacts.post(['ref1'])
+        index_tasks.add_artifacts.post(['ref2'])
+        index_tasks.del_artifacts.post(['ref1'])
+        # re-adding a deleted artifact must run after the delete
+        index_tasks.add_artifacts.post(['ref1'])
+        tasks = M.MonQTask.query.find().sort('_id').all()
+        assert_equal([(t.task_name.split('.')[-1], t.args) for t in tasks], [
+            ('add_artifacts', [['ref1', 'ref2']]),
+            ('del_artifacts', [['ref1']]),
+            ('add_artifacts', [['ref1']]),
+        ])
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_add_artifacts_batched(self, solr):
+        artifacts = [_TestArtifact(_shorthand_id='tb_%s' % x)
+                     for x in range(5)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        with h.push_config(tg.config, **{'solr.index.batch_size': '2'}):
+            with mock.patch.object(_TestArtifact, 'query') as query:
+                query.find.side_effect = lambda q: [
+                    a for a in artifacts if a._id in q['_id']['$in']]
+                index_tasks.add_artifacts(ref_ids)
+        # one query per batch of artifacts of the same class
+        assert_equal(query.find.call_count, 3)
+        assert_equal([len(c[0][0]) for c in solr.add.call_args_list],
+                     [2, 2, 1])
+        assert_equal(
+            sorted(d['id'] for c in solr.add.call_args_list for d in c[0][0]),
+            sorted(ref_ids))
+
+    @td.with_wiki
+    @mock.patch.dict('allura.tasks.index_tasks._solr_by_hosts')
+    @mock.patch('allura.tasks.index_tasks.make_solr_from_config')
+    def test_add_artifacts_solr_hosts(self, make_solr):
+        artifact = _TestArtifact(_shorthand_id='th_1')
+        M.artifact_orm_session.flush()
+        ref_id = M.ArtifactReference.from_artifact(artifact)._id
+        M.artifact_orm_session.flush()
+        for i in range(2):
+            index_tasks.add_artifacts([ref_id], solr_hosts=['host1', 'host2'])
+        # one solr instance for the same hosts
+        make_solr.assert_called_once_with(['host1', 'host2'])
+        assert_equal(make_solr.return_value.add.call_count, 2)
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_add_artifacts_pool(self, solr):
+        artifacts = [_TestArtifact(_shorthand_id='tp_%s' % x)
+                     for x in range(5)]
+        M.artifact_orm_session.flush()
+        ref_ids = [M.ArtifactReference.from_artifact(a)._id for a in artifacts]
+        M.artifact_orm_session.flush()
+        solarize = _TestArtifact.solarize_with_shortlinks
+
+        def solarize_with_shortlinks(self, **kw):
+            if self._shorthand_id == 'tp_3':
+                raise ValueError('cannot render tp_3')
+            return solarize(self, **kw)
+        config = {'solr.index.batch_size': '2', 'solr.index.workers': '2'}
+        with h.push_config(tg.config, **config), \
+                mock.patch.object(_TestArtifact, 'solarize_with_shortlinks',
+                                  solarize_with_shortlinks), \
+                mock.patch('allura.tasks.index_tasks.multiprocessing.Pool') as Pool:
+            # render in this process, as the workers would
+            Pool.return_value.map.side_effect = map
+            with self.assertRaises(ForgeError) as cm:
+                index_tasks.add_artifacts(ref_ids)
+        Pool.assert_called_once_with(2)
+        # chunks of batch_size * workers, in jobs of batch_size
+        assert_equal([len(call[0][1]) for call in Pool.return_value.map.call_args_list],
+                     [2, 1])
+        assert Pool.return_value.terminate.called
+        # the worker's traceback is raised, the other artifacts are indexed
+        assert_in('cannot render tp_3', str(cm.exception))
+        ref_ids.remove(artifacts[3].index_id())
+        assert_equal(
+            sorted(d['id'] for c in solr.add.call_args_list for d in c[0][0]),
+            sorted(ref_ids))
+
+    @td.with_wiki
+    def test_add_artifacts_load_error(self):
+        artifact = _TestArtifact(_shorthand_id='tl_1')
+        M.artifact_orm_session.flush()
+        ref_id = M.ArtifactReference.from_artifact(artifact)._id
+        M.artifact_orm_session.flush()
+        with mock.patch.object(_TestArtifact, 'query') as query:
+            query.find.side_effect = ValueError('cannot load')
+            with self.assertRaises(ValueError):
+                index_tasks.add_artifacts([ref_id])
 
     @td.with_wiki
     @mock.patch('allura.tasks.index_tasks.g.solr')
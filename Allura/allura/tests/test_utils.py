@@ -21,6 +21,7 @@
 import time
 import unittest
 import datetime as dt
+from ming import mim
 from ming.odm import session
 from os import path
 
@@ -102,6 +103,51 @@ def test_chunked_list(self):
         self.assertEqual([el for sublist in chunks for el in sublist], l)
 
 
+class TestUnionFirstArg(unittest.TestCase):
+
+    def test_union(self):
+        args, kwargs = utils.union_first_arg(
+            ([1, 2], 'x'), {'a': 1}, ([2, 3], 'x'), {'a': 1})
+        self.assertEqual(args, [[1, 2, 3], 'x'])
+        self.assertEqual(kwargs, {'a': 1})
+
+    def test_other_args_differ(self):
+        self.assertIsNone(utils.union_first_arg(
+            ([1, 2], 'x'), {}, ([3], 'y'), {}))
+
+    def test_too_big(self):
+        self.assertIsNone(utils.union_first_arg(
+            ([1, 2],), {}, ([3],), {}, max_size=2))
+
+
+class TestBulkWrite(unittest.TestCase):
+
+    def test_mim(self):
+        coll = mim.Connection.get()['test_bulk_write']['docs']
+        coll.remove({})
+        utils.bulk_write(coll, inserts=[{'_id': 1, 'a': 1}, {'_id': 2, 'a': 2}])
+        utils.bulk_write(coll,
+                         inserts=[{'_id': 1, 'a': 3}],
+                         updates=[({'_id': 2}, {'$set': {'b': 2}})],
+                         saves=[{'_id': 3, 'a': 3}],
+                         ignore_duplicates=True)
+        self.assertEqual(sorted(coll.find(), key=lambda d: d['_id']), [
+            {'_id': 1, 'a': 1}, {'_id': 2, 'a': 2, 'b': 2}, {'_id': 3, 'a': 3}])
+
+    def test_bulk(self):
+        coll = Mock()
+        utils.bulk_write(coll, updates=[({'_id': 1}, {'$set': {'b': 2}})], upsert=True)
+        bulk = coll.initialize_unordered_bulk_op.return_value
+        bulk.find.assert_called_once_with({'_id': 1})
+        bulk.find.return_value.upsert.return_value.update_one.assert_called_once_with({'$set': {'b': 2}})
+        bulk.execute.assert_called_once_with()
+
+    def test_nothing(self):
+        coll = Mock()
+        utils.bulk_write(coll)
+        assert not coll.initialize_unordered_bulk_op.called
+
+
 class TestAntispam(unittest.TestCase):
 
     def setUp(self):
@@ -18,6 +18,8 @@
 import datetime
 import unittest
 from mock import patch, Mock, MagicMock
+import bson
+import tg
 from nose.tools import assert_equal
 from datadiff import tools as dd
 
@@ -26,10 +28,13 @@
 from allura import model as M
 from allura.controllers.repository import topo_sort
 from allura.model.repository import zipdir, prefix_paths_union
+from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
 from allura.model.repo_refresh import (
     CommitRunDoc,
     CommitRunBuilder,
     _group_commits,
+    compute_lcds_parallel,
+    refresh_commits_bulk,
 )
 from alluratest.controller import setup_unit_test
 
@@ -81,6 +86,97 @@ def test_reversed(self):
         self.assertEqual(CommitRunDoc.m.count(), 1)
 
 
+class TestRefreshCommitsBulk(unittest.TestCase):
+
+    def setUp(self):
+        setup_unit_test()
+        # other tests leave commits '0' to '9' behind
+        for doc_cls in (M.repository.CommitDoc, M.repository.TreeDoc,
+                        M.repository.TreesDoc):
+            doc_cls.m.remove({})
+        self.repo = Mock(_id=bson.ObjectId(), _refresh_precompute=True)
+        self.repo.app.config.project_id = bson.ObjectId()
+        self.repo.app.config._id = bson.ObjectId()
+        self.repo.shorthand_for_commit = lambda oid: '[%s]' % oid[:6]
+        self.repo.url_for_commit = lambda oid: '/ci/%s/' % oid
+        self.repo._impl.refresh_commit_docs = self.refresh_commit_docs
+
+    def refresh_commit_docs(self, commit_ids, seen):
+        user = dict(name=u'Test', email=u'test@example.com',
+                    date=datetime.datetime(2015, 1, 1))
+        for oid in commit_ids:
+            tree = dict(_id='t' + oid, tree_ids=[], blob_ids=[], other_ids=[])
+            parent_ids = [str(int(oid) - 1)] if int(oid) else []
+            yield dict(_id=oid, tree_id=tree['_id'], committed=user,
+                       authored=user, message=u'', parent_ids=parent_ids,
+                       child_ids=[]), [tree]
+
+    def test_refresh(self):
+        with patch.dict(tg.config, {'scm.refresh.batch_size': '2'}):
+            count = refresh_commits_bulk(self.repo, ['0', '1', '2'])
+        self.assertEqual(count, 3)
+        ci = M.repository.CommitDoc.m.get(_id='1')
+        self.assertEqual(ci.parent_ids, ['0'])
+        self.assertEqual(ci.child_ids, ['2'])
+        self.assertEqual(ci.repo_ids, [self.repo._id])
+        self.assertEqual(M.repository.CommitDoc.m.get(_id='0').child_ids, ['1'])
+        self.assertEqual(M.repository.TreeDoc.m.find().count(), 3)
+        self.assertEqual(M.repository.TreesDoc.m.get(_id='2').tree_ids, ['t2'])
+        app_config_id = self.repo.app.config._id
+        self.assertEqual(ArtifactReferenceDoc.m.find(
+            {'artifact_reference.app_config_id': app_config_id}).count(), 3)
+        self.assertEqual(ShortlinkDoc.m.find(
+            {'app_config_id': app_config_id}).count(), 6)
+
+    def test_refresh_not_lazy(self):
+        M.repository.TreeDoc.m.collection.insert(dict(
+            _id='t1', tree_ids=[], blob_ids=[dict(name=u'stale', id='b')],
+            other_ids=[]))
+        refresh_commits_bulk(self.repo, ['0', '1'])
+        self.assertEqual(len(M.repository.TreeDoc.m.get(_id='t1').blob_ids), 1)
+        refresh_commits_bulk(self.repo, ['0', '1'], lazy=False)
+        self.assertEqual(M.repository.TreeDoc.m.get(_id='t1').blob_ids, [])
+        self.assertEqual(M.repository.TreeDoc.m.find().count(), 2)
+
+
+class FakePool(object):
+
+    def __init__(self, processes, initializer=None):
+        self.processes = processes
+        if initializer:
+            initializer()
+
+    def map(self, func, iterable):
+        return map(func, iterable)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class TestComputeLcdsParallel(unittest.TestCase):
+
+    def setUp(self):
+        setup_unit_test()
+
+    def compute_chunk(self, commit_ids):
+        return [dict(commit_id=oid, path='', entries=[]) for oid in commit_ids]
+
+    @patch('multiprocessing.Pool', FakePool)
+    @patch('allura.model.repo_refresh._compute_lcds_chunk')
+    def test_chunks_merged_in_order(self, compute_chunk):
+        compute_chunk.side_effect = self.compute_chunk
+        count = compute_lcds_parallel(Mock(), ['4', '3', '2', '1', '0'], 2)
+        self.assertEqual(count, 5)
+        self.assertEqual([call[0][0] for call in compute_chunk.call_args_list],
+                         [['0', '1', '2'], ['3', '4']])
+        lcds = M.repository.LastCommitDoc.m.find().sort('_id').all()
+        self.assertEqual([lcd.commit_id for lcd in lcds],
+                         ['0', '1', '2', '3', '4'])
+
+
 class TestTopoSort(unittest.TestCase):
 
     def test_commit_dates_out_of_order(self):
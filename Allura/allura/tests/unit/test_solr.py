@@ -15,6 +15,7 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import hashlib
 import unittest
 
 import mock
@@ -24,73 +25,97 @@
 from allura.lib import helpers as h
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
-from allura.lib.solr import Solr, escape_solr_arg
+from allura.lib.solr import Solr, SolrPusher, PersistentSolr, escape_solr_arg
 from allura.lib.search import search_app, SearchIndexable
 
 
 class TestSolr(unittest.TestCase):
 
-    @mock.patch('allura.lib.solr.pysolr')
-    def test_init(self, pysolr):
+    @mock.patch('allura.lib.solr.PersistentSolr')
+    def test_init(self, PersistentSolr):
         servers = ['server1', 'server2']
         solr = Solr(servers, commit=False, commitWithin='10000')
         calls = [mock.call('server1'), mock.call('server2')]
-        pysolr.Solr.assert_has_calls(calls)
+        PersistentSolr.assert_has_calls(calls)
         assert_equal(len(solr.push_pool), 2)
 
-        pysolr.reset_mock()
+        PersistentSolr.reset_mock()
         solr = Solr(servers, 'server3', commit=False, commitWithin='10000')
         calls = [mock.call('server1'), mock.call('server2'),
                  mock.call('server3')]
-        pysolr.Solr.assert_has_calls(calls)
+        PersistentSolr.assert_has_calls(calls)
         assert_equal(len(solr.push_pool), 2)
 
-    @mock.patch('allura.lib.solr.pysolr')
-    def test_add(self, pysolr):
+    @mock.patch('allura.lib.solr.PersistentSolr')
+    def test_add(self, PersistentSolr):
         servers = ['server1', 'server2']
         solr = Solr(servers, commit=False, commitWithin='10000')
         solr.add('foo', commit=True, commitWithin=None)
         calls = [mock.call('foo', commit=True, commitWithin=None)] * 2
-        pysolr.Solr().add.assert_has_calls(calls)
-        pysolr.reset_mock()
+        PersistentSolr().add.assert_has_calls(calls)
+        PersistentSolr.reset_mock()
         solr.add('bar', somekw='value')
         calls = [mock.call('bar', commit=False,
                            commitWithin='10000', somekw='value')] * 2
-        pysolr.Solr().add.assert_has_calls(calls)
+        PersistentSolr().add.assert_has_calls(calls)
 
-    @mock.patch('allura.lib.solr.pysolr')
-    def test_delete(self, pysolr):
+    @mock.patch('allura.lib.solr.PersistentSolr')
+    def test_delete(self, PersistentSolr):
         servers = ['server1', 'server2']
         solr = Solr(servers, commit=False, commitWithin='10000')
         solr.delete('foo', commit=True)
         calls = [mock.call('foo', commit=True)] * 2
-        pysolr.Solr().delete.assert_has_calls(calls)
-        pysolr.reset_mock()
+        PersistentSolr().delete.assert_has_calls(calls)
+        PersistentSolr.reset_mock()
         solr.delete('bar', somekw='value')
         calls = [mock.call('bar', commit=False, somekw='value')] * 2
-        pysolr.Solr().delete.assert_has_calls(calls)
+        PersistentSolr().delete.assert_has_calls(calls)
 
-    @mock.patch('allura.lib.solr.pysolr')
-    def test_commit(self, pysolr):
+    @mock.patch('allura.lib.solr.PersistentSolr')
+    def test_commit(self, PersistentSolr):
         servers = ['server1', 'server2']
         solr = Solr(servers, commit=False, commitWithin='10000')
         solr.commit('arg')
-        pysolr.Solr().commit.assert_has_calls([mock.call('arg')] * 2)
-        pysolr.reset_mock()
+        PersistentSolr().commit.assert_has_calls([mock.call('arg')] * 2)
+        PersistentSolr.reset_mock()
         solr.commit('arg', kw='kw')
         calls = [mock.call('arg', kw='kw')] * 2
-        pysolr.Solr().commit.assert_has_calls(calls)
+        PersistentSolr().commit.assert_has_calls(calls)
 
-    @mock.patch('allura.lib.solr.pysolr')
-    def test_search(self, pysolr):
+    @mock.patch('allura.lib.solr.PersistentSolr')
+    def test_search(self, PersistentSolr):
         servers = ['server1', 'server2']
         solr = Solr(servers, commit=False, commitWithin='10000')
         solr.search('foo')
         solr.query_server.search.assert_called_once_with('foo')
-        pysolr.reset_mock()
+        PersistentSolr.reset_mock()
         solr.search('bar', kw='kw')
         solr.query_server.search.assert_called_once_with('bar', kw='kw')
 
+    @mock.patch('allura.lib.solr.PersistentSolr')
+    def test_push_failure(self, PersistentSolr):
+        good, bad = mock.Mock(), mock.Mock()
+        bad.add.side_effect = ValueError('down')
+        PersistentSolr.side_effect = [good, bad]
+        solr = Solr(['server1', 'server2'], commit=False)
+        with td.raises(ValueError):
+            solr.add('foo')
+        # the other server is still updated
+        good.add.assert_called_once_with('foo', commit=False)
+
+    @mock.patch('allura.tasks.index_tasks.solr_push_retry')
+    @mock.patch('allura.lib.solr.PersistentSolr')
+    def test_push_failure_queue(self, PersistentSolr, solr_push_retry):
+        good, bad = mock.Mock(), mock.Mock()
+        good.add.return_value = 'ok'
+        bad.add.side_effect = ValueError('down')
+        PersistentSolr.side_effect = [good, bad]
+        solr = Solr(['server1', 'server2'], commit=False,
+                    failure_policy='queue')
+        assert_equal(solr.add('foo'), ['ok', None])
+        solr_push_retry.post.assert_called_once_with(
+            'server2', 'add', ['foo'], {'commit': False})
+
     @mock.patch('allura.lib.search.search')
     def test_site_admin_search(self, search):
         from allura.lib.search import site_admin_search
@@ -117,6 +142,56 @@ def test_site_admin_search(self, search):
             'username_s:admin1 || username_s:root', fq=fq, ignore_errors=False)
 
 
+class TestPersistentSolr(unittest.TestCase):
+
+    @mock.patch('allura.lib.solr.requests.Session')
+    def test_send_request(self, Session):
+        solr = PersistentSolr('http://localhost:8983/solr/allura', timeout=5)
+        Session.return_value.request.return_value = mock.Mock(
+            status_code=200, content='response')
+        assert_equal(solr._send_request('GET', '/solr/allura/select/'), 'response')
+        assert_equal(solr._send_request('GET', '/solr/allura/select/'), 'response')
+        # one session for all the requests
+        assert_equal(Session.call_count, 1)
+        Session.return_value.request.assert_called_with(
+            'GET', 'http://localhost:8983/solr/allura/select/',
+            data=None, headers=None, timeout=5)
+
+
+class TestSolrPusher(unittest.TestCase):
+
+    def test_batches(self):
+        solr = mock.Mock()
+        pusher = SolrPusher(solr, batch_size=2)
+        pusher.add([1, 2, 3])
+        pusher.add([4, 5])
+        assert_equal(pusher.close(), [])
+        assert_equal(solr.add.call_args_list,
+                     [mock.call([1, 2]), mock.call([3, 4]), mock.call([5])])
+
+    @mock.patch('allura.lib.solr.time.sleep')
+    def test_retry(self, sleep):
+        solr = mock.Mock()
+        solr.add.side_effect = [ValueError(), None]
+        pusher = SolrPusher(solr, batch_size=2, retries=1, backoff=3)
+        pusher.add([1])
+        assert_equal(pusher.close(), [])
+        assert_equal(solr.add.call_args_list, [mock.call([1])] * 2)
+        sleep.assert_called_once_with(3)
+
+    @mock.patch('allura.lib.solr.time.sleep')
+    def test_gives_up(self, sleep):
+        solr = mock.Mock()
+        solr.add.side_effect = ValueError()
+        pusher = SolrPusher(solr, batch_size=2, retries=2, backoff=1)
+        pusher.add([1, 2, 3])
+        errors = pusher.close()
+        assert_equal(len(errors), 2)
+        assert_equal(errors[0][0], ValueError)
+        assert_equal(solr.add.call_count, 6)
+        assert_equal(sleep.call_args_list, [mock.call(1), mock.call(2)] * 2)
+
+
 class TestSearchIndexable(unittest.TestCase):
 
     def setUp(self):
@@ -140,6 +215,41 @@ def test_solarize_html_in_text(self):
         self.obj.index = lambda: dict(text='&lt;script&gt;a(1)&lt;/script&gt;')
         assert_equal(self.obj.solarize(), dict(text='<script>a(1)</script>'))
 
+    @mock.patch('allura.lib.markdown_extensions.M.Shortlink.lookup')
+    def test_solarize_with_shortlinks(self, lookup):
+        shortlink = mock.Mock(url='/p/test/wiki/Home/', ref=mock.Mock())
+        shortlink.ref.artifact = mock.Mock(deleted=False, is_closed=False)
+        lookup.side_effect = lambda link: shortlink if link == 'Home' else None
+        self.obj.index = lambda: dict(text='# Header\n\nSee [Home] and [Missing]')
+        doc, shortlinks = self.obj.solarize_with_shortlinks()
+        assert_equal(doc, dict(text='Header See [Home] and [Missing]'))
+        assert_equal(shortlinks, [shortlink])
+        # the pooled markdown is reset between artifacts
+        self.obj.index = lambda: dict(text='No links')
+        assert_equal(self.obj.solarize_with_shortlinks(),
+                     (dict(text='No links'), []))
+        assert_equal(self.obj.solarize_with_shortlinks(shortlinks=False),
+                     (dict(text='No links'), None))
+
+    @mock.patch('allura.lib.search.g')
+    def test_solarize_uses_fresh_cache(self, g):
+        from allura.lib.app_globals import ForgeMarkdown
+
+        class Cached(SearchIndexable):
+            text_cache = None
+        obj = Cached()
+        obj.index = lambda: dict(text='# Header')
+        obj.text_cache = dict(md5=hashlib.md5('# Header').hexdigest(),
+                              fix7528=ForgeMarkdown.bugfix_rev,
+                              html='<h1>Cached</h1>')
+        assert_equal(obj.solarize(), dict(text='Cached'))
+        assert_equal(g.pooled_markdown.call_count, 0)
+        # stale caches are ignored
+        obj.text_cache['fix7528'] = ForgeMarkdown.bugfix_rev - 1
+        g.pooled_markdown.return_value.convert.return_value = Markup('<h1>Header</h1>')
+        assert_equal(obj.solarize(), dict(text='Header'))
+        assert_equal(g.pooled_markdown.call_count, 1)
+
 
 class TestSearch_app(unittest.TestCase):
 
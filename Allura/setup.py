@@ -140,6 +140,9 @@
     [allura.webhooks]
     repo-push = allura.webhooks:RepoPushWebhookSender
 
+    [allura.markdown_render_cache]
+    mongo = allura.lib.markdown_cache:MongoMarkdownRenderStore
+
     [paste.paster_command]
     taskd = allura.command.taskd:TaskdCommand
     taskd_cleanup = allura.command.taskd_cleanup:TaskdCleanupCommand
@@ -16,10 +16,13 @@
 #       under the License.
 
 import os
+import re
 import shutil
 import string
 import logging
 import tempfile
+import binascii
+import subprocess
 from datetime import datetime
 from contextlib import contextmanager
 from time import time
@@ -57,10 +60,112 @@ def log(self, *args, **kwargs):
         return self.client.log(*args, **kwargs)
 
 
+class GitCatFile(object):
+
+    '''A single long-lived ``git cat-file --batch`` process, used to read
+    many raw objects from a repo without spawning a process (or building
+    GitPython objects) for each one.
+
+    Use as a context manager so the process is always reaped::
+
+        with GitCatFile(repo_path) as cat:
+            ci = parse_commit(cat.read(oid, 'commit'))
+    '''
+
+    def __init__(self, git_dir):
+        self.proc = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            cwd=git_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, oid, expected_type=None):
+        '''Return the raw content of object ``oid``'''
+        self.proc.stdin.write(oid + '\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(oid)
+        obj_id, obj_type, size = header
+        if expected_type and obj_type != expected_type:
+            raise ValueError('%s is a %s, not a %s' % (
+                obj_id, obj_type, expected_type))
+        data = self.proc.stdout.read(int(size))
+        self.proc.stdout.read(1)  # trailing newline
+        return data
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+
+
+RE_ACTOR = re.compile(r'^(.*?) ?<(.*)> (\d+)(?: [+-]\d+)?$')
+
+
+def parse_actor(value):
+    '''Parse an ``author``/``committer`` header value into
+    ``(name, email, timestamp)``'''
+    m = RE_ACTOR.match(value)
+    if m is None:
+        return value, '', 0
+    name, email, timestamp = m.groups()
+    return name, email, int(timestamp)
+
+
+def parse_commit(data):
+    '''Parse a raw commit object into a dict of ``tree``, ``parents``,
+    ``author``, ``committer``, ``encoding`` and ``message``'''
+    headers, _, message = data.partition('\n\n')
+    result = dict(tree=None, parents=[], author=None, committer=None,
+                  encoding='UTF-8', message=message)
+    for line in headers.split('\n'):
+        if line.startswith(' '):
+            continue  # continuation of a multi-line header, e.g. gpgsig
+        key, _, value = line.partition(' ')
+        if key == 'tree':
+            result['tree'] = value
+        elif key == 'parent':
+            result['parents'].append(value)
+        elif key in ('author', 'committer'):
+            result[key] = parse_actor(value)
+        elif key == 'encoding':
+            result['encoding'] = value
+    return result
+
+
+def decode_commit_text(value, encoding):
+    '''Decode a commit's message or actor name with the commit's encoding,
+    as GitPython does, guessing it if that fails'''
+    try:
+        return value.decode(encoding)
+    except (LookupError, UnicodeDecodeError):
+        return h.really_unicode(value)
+
+
+def parse_tree(data):
+    '''Generate ``(mode, name, binsha)`` for each entry of a raw tree object'''
+    pos = 0
+    while pos < len(data):
+        space = data.index(' ', pos)
+        nul = data.index('\0', space)
+        yield data[pos:space], data[space + 1:nul], data[nul + 1:nul + 21]
+        pos = nul + 21
+
+
 class Repository(M.Repository):
     tool_name = 'Git'
     repo_id = 'git'
     type_s = 'Git Repository'
+    _refresh_bulk = True
+    _path_history = True
 
     class __mongometa__:
         name = 'git-repository'
@@ -252,6 +357,57 @@ def all_commit_ids(self):
             seen.add(ci.binsha)
             yield ci.hexsha
 
+    def ref_tips(self):
+        if self.is_empty():
+            return []
+        tips = self._git.git.rev_parse('--all').split()
+        return sorted(set(tips))
+
+    def commits_between(self, old_tips, new_tips):
+        proc = subprocess.Popen(
+            ['git', 'rev-list', '--topo-order', '--stdin'],
+            cwd=self._repo.full_fs_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        revs = list(new_tips) + ['^' + tip for tip in old_tips]
+        stdout, stderr = proc.communicate('\n'.join(revs) + '\n')
+        if proc.returncode != 0:
+            # e.g. an old tip was force-pushed away and garbage collected
+            log.info('Falling back to a full commit walk: %s', stderr.strip())
+            return None
+        return stdout.split()
+
+    def path_changes(self, commits):
+        commits = list(commits)
+        if not commits:
+            return
+        proc = subprocess.Popen(
+            ['git', 'diff-tree', '--stdin', '--always', '--root', '-r',
+             '--name-only', '-z'],
+            cwd=self._repo.full_fs_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        # compare merges with their first parent only
+        stdout, _ = proc.communicate(''.join(
+            '%s %s\n' % (oid, parent_ids[0]) if parent_ids else oid + '\n'
+            for oid, parent_ids in commits))
+        # each commit's id (always shown, even without changes) is followed
+        # by its changed files
+        commit_ids = iter([oid for oid, parent_ids in commits] + [None])
+        next_id = next(commit_ids)
+        oid, files = None, []
+        for token in stdout.split('\0'):
+            if token == next_id:
+                if oid is not None:
+                    yield oid, files
+                oid, files = token, []
+                next_id = next(commit_ids)
+            elif token:
+                files.append(token)
+        if oid is not None:
+            yield oid, files
+
     def new_commits(self, all_commits=False):
         graph = {}
 
@@ -275,19 +431,8 @@ def refresh_commit_info(self, oid, seen, lazy=True):
         if ci_doc and lazy:
             return False
         ci = self._git.rev_parse(oid)
-        args = dict(
-            tree_id=ci.tree.hexsha,
-            committed=Object(
-                name=h.really_unicode(ci.committer.name),
-                email=h.really_unicode(ci.committer.email),
-                date=datetime.utcfromtimestamp(ci.committed_date)),
-            authored=Object(
-                name=h.really_unicode(ci.author.name),
-                email=h.really_unicode(ci.author.email),
-                date=datetime.utcfromtimestamp(ci.authored_date)),
-            message=h.really_unicode(ci.message or ''),
-            child_ids=[],
-            parent_ids=[p.hexsha for p in ci.parents])
+        args = self._commit_doc(ci)
+        del args['_id']
         if ci_doc:
             ci_doc.update(**args)
             ci_doc.m.save()
@@ -301,16 +446,81 @@ def refresh_commit_info(self, oid, seen, lazy=True):
         self.refresh_tree_info(ci.tree, seen, lazy)
         return True
 
+    def refresh_commit_docs(self, commit_ids, seen):
+        '''Generate ``(commit_doc, tree_docs)`` for each of the given commit
+        ids, where ``commit_doc`` holds the CommitDoc fields for the commit and
+        ``tree_docs`` the TreeDoc fields for each of its trees not yet in
+        ``seen``.  Nothing is saved; see
+        :func:`allura.model.repo_refresh.refresh_commits_bulk`.
+
+        Objects are read through a single ``git cat-file --batch`` process
+        unless ``scm.git.refresh_backend`` is set to ``gitpython``.
+        '''
+        if tg.config.get('scm.git.refresh_backend', 'cat-file') == 'gitpython':
+            for oid in commit_ids:
+                ci = self._git.rev_parse(oid)
+                yield self._commit_doc(ci), list(self._tree_docs(ci.tree, seen))
+            return
+        with GitCatFile(self._repo.full_fs_path) as cat:
+            for oid in commit_ids:
+                ci = parse_commit(cat.read(oid, 'commit'))
+                yield (self._raw_commit_doc(oid, ci),
+                       list(self._raw_tree_docs(cat, ci['tree'], seen)))
+
+    def _commit_doc(self, ci):
+        return dict(
+            _id=ci.hexsha,
+            tree_id=ci.tree.hexsha,
+            committed=Object(
+                name=h.really_unicode(ci.committer.name),
+                email=h.really_unicode(ci.committer.email),
+                date=datetime.utcfromtimestamp(ci.committed_date)),
+            authored=Object(
+                name=h.really_unicode(ci.author.name),
+                email=h.really_unicode(ci.author.email),
+                date=datetime.utcfromtimestamp(ci.authored_date)),
+            message=h.really_unicode(ci.message or ''),
+            child_ids=[],
+            parent_ids=[p.hexsha for p in ci.parents])
+
+    def _raw_commit_doc(self, oid, ci):
+        author_name, author_email, authored_date = ci['author']
+        committer_name, committer_email, committed_date = ci['committer']
+        encoding = ci['encoding']
+        return dict(
+            _id=oid,
+            tree_id=ci['tree'],
+            committed=Object(
+                name=decode_commit_text(committer_name, encoding),
+                email=h.really_unicode(committer_email),
+                date=datetime.utcfromtimestamp(committed_date)),
+            authored=Object(
+                name=decode_commit_text(author_name, encoding),
+                email=h.really_unicode(author_email),
+                date=datetime.utcfromtimestamp(authored_date)),
+            message=decode_commit_text(ci['message'], encoding),
+            child_ids=[],
+            parent_ids=ci['parents'])
+
     def refresh_tree_info(self, tree, seen, lazy=True):
         from allura.model.repository import TreeDoc
+        doc = None
+        for tree_doc in self._tree_docs(tree, seen, lazy):
+            doc = TreeDoc(tree_doc)
+            doc.m.save(safe=False)
+        return doc
+
+    def _tree_docs(self, tree, seen, lazy=True):
+        '''Generate TreeDoc fields for a tree and all its subtrees not in
+        ``seen``, subtrees first'''
         if lazy and tree.binsha in seen:
             return
         seen.add(tree.binsha)
-        doc = TreeDoc(dict(
+        doc = dict(
             _id=tree.hexsha,
             tree_ids=[],
             blob_ids=[],
-            other_ids=[]))
+            other_ids=[])
         for o in tree:
             if o.type == 'submodule':
                 continue
@@ -318,15 +528,41 @@ def refresh_tree_info(self, tree, seen, lazy=True):
                 name=h.really_unicode(o.name),
                 id=o.hexsha)
             if o.type == 'tree':
-                self.refresh_tree_info(o, seen, lazy)
-                doc.tree_ids.append(obj)
+                for sub_doc in self._tree_docs(o, seen, lazy):
+                    yield sub_doc
+                doc['tree_ids'].append(obj)
             elif o.type == 'blob':
-                doc.blob_ids.append(obj)
+                doc['blob_ids'].append(obj)
             else:
                 obj.type = o.type
-                doc.other_ids.append(obj)
-        doc.m.save(safe=False)
-        return doc
+                doc['other_ids'].append(obj)
+        yield doc
+
+    def _raw_tree_docs(self, cat, tree_id, seen):
+        '''Like :meth:`_tree_docs`, but reading raw trees from a
+        :class:`GitCatFile`'''
+        binsha = binascii.unhexlify(tree_id)
+        if binsha in seen:
+            return
+        seen.add(binsha)
+        doc = dict(
+            _id=tree_id,
+            tree_ids=[],
+            blob_ids=[],
+            other_ids=[])
+        for mode, name, sha in parse_tree(cat.read(tree_id, 'tree')):
+            if mode == '160000':  # submodule
+                continue
+            obj = Object(
+                name=h.really_unicode(name),
+                id=binascii.hexlify(sha))
+            if mode == '40000':
+                for sub_doc in self._raw_tree_docs(cat, obj.id, seen):
+                    yield sub_doc
+                doc['tree_ids'].append(obj)
+            else:
+                doc['blob_ids'].append(obj)
+        yield doc
 
     def log(self, revs=None, path=None, exclude=None, id_only=True, **kw):
         """
@@ -644,11 +880,12 @@ def _get_last_commit(self, commit_id, paths):
             return None, set()
 
     def get_changes(self, commit_id):
-        return self._git.git.log(
+        # older versions of git start the output with an empty line
+        return [path for path in self._git.git.log(
             commit_id,
             name_only=True,
             pretty='format:',
-            max_count=1).splitlines()[1:]
+            max_count=1).splitlines() if path]
 
     def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
         result = {'added': [], 'removed': [], 'changed': [], 'copied': [], 'renamed': []}
@@ -38,7 +38,9 @@
 from allura.tasks.repo_tasks import tarball
 from allura.tests import decorators as td
 from allura.tests.model.test_repo import RepoImplTestBase
+from allura.tests.unit.test_repo import FakePool
 from allura import model as M
+from allura.model import repo_refresh
 from allura.model.repo_refresh import send_notifications
 from allura.webhooks import RepoPushWebhookSender
 from forgegit import model as GM
@@ -411,6 +413,87 @@ def test_all_commit_ids(self):
         # repo root comes last
         self.assertEqual(cids[-1], '9a7df788cf800241e3bb5a849c8870f2f8259d98')
 
+    def test_commits_between(self):
+        tips = self.repo.ref_tips()
+        self.assertEqual(tips, [
+            '1e146e67985dcd71c74de79613719bef7bddca4a',  # master, tag foo
+            '5c47243c8e424136fd5cdd18cd94d34c66d1955c',  # zz
+        ])
+        self.assertEqual(sorted(self.repo.commits_between([], tips)),
+                         sorted(self.repo.all_commit_ids()))
+        self.assertEqual(self.repo.commits_between(
+            ['df30427c488aeab84b2352bdf88a3b19223f9d7a'],
+            ['1e146e67985dcd71c74de79613719bef7bddca4a']),
+            ['1e146e67985dcd71c74de79613719bef7bddca4a'])
+        self.assertEqual(self.repo.commits_between(tips, tips), [])
+        # unknown old tip
+        self.assertEqual(self.repo.commits_between(['f' * 40], tips), None)
+
+    def test_path_history(self):
+        PathHistory = M.repository.PathHistory
+        master = '1e146e67985dcd71c74de79613719bef7bddca4a'
+        self.assertEqual(PathHistory.last_commit_ids(
+            master, ['', 'README', 'a', 'a/b/c/hello.txt', 'missing']), {
+            '': master,
+            'README': master,
+            'a': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+            'a/b/c/hello.txt': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+        })
+        self.assertEqual(
+            PathHistory.last_commit_id('5c47243c8e424136fd5cdd18cd94d34c66d1955c', 'README'),
+            master)
+        # same answers as git
+        for path in ['README', 'a/b/c/hello.txt']:
+            self.assertEqual(PathHistory.last_commit_id(master, path),
+                             self.repo.log(master, path, id_only=True).next())
+        ci = self.repo.commit(master)
+        self.assertEqual(PathHistory.prev_commit_id(ci, 'README'),
+                         'df30427c488aeab84b2352bdf88a3b19223f9d7a')
+        with mock.patch.object(self.repo._impl, 'last_commit_ids') as impl_lcids:
+            self.assertEqual(self.repo.last_commit_ids(ci, ['README', 'a']), {
+                'README': master,
+                'a': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+            })
+        assert not impl_lcids.called
+
+    def test_refresh_incremental(self):
+        repo = GM.Repository.query.get(_id=self.repo._id)
+        self.assertEqual(repo.refresh_tips, repo.ref_tips())
+        with mock.patch.object(repo._impl, 'all_commit_ids') as all_commit_ids, \
+                mock.patch('allura.model.repo_refresh.unknown_commit_ids',
+                           wraps=repo_refresh.unknown_commit_ids) as unknown:
+            repo.refresh()
+            unknown.assert_called_once_with([])
+            # only the commits since the stored tips are walked
+            repo.refresh_tips = ['1e146e67985dcd71c74de79613719bef7bddca4a']
+            unknown.reset_mock()
+            repo.refresh()
+            unknown.assert_called_once_with(
+                ['5c47243c8e424136fd5cdd18cd94d34c66d1955c'])
+        assert not all_commit_ids.called
+        self.assertEqual(repo.refresh_tips, repo.ref_tips())
+
+    @mock.patch('multiprocessing.Pool', FakePool)
+    def test_compute_lcds_parallel(self):
+        def lcds():
+            return sorted(
+                (lcd.commit_id, lcd.path,
+                 sorted((e.name, e.commit_id) for e in lcd.entries))
+                for lcd in M.repository.LastCommitDoc.m.find())
+        # as computed serially by the refresh in setUp
+        expected = lcds()
+        M.repository.LastCommitDoc.m.remove({})
+        repo = GM.Repository.query.get(_id=self.repo._id)
+        count = repo_refresh.compute_lcds_parallel(
+            repo, list(repo.all_commit_ids()), 1)
+        self.assertEqual(count, len(expected))
+        self.assertEqual(lcds(), expected)
+        self.assertIn(
+            ('1e146e67985dcd71c74de79613719bef7bddca4a', '',
+             [('README', '1e146e67985dcd71c74de79613719bef7bddca4a'),
+              ('a', '9a7df788cf800241e3bb5a849c8870f2f8259d98')]),
+            expected)
+
     def test_ls(self):
         c.lcid_cache = {}  # else it'll be a mock
         lcd_map = self.repo.commit('HEAD').tree.ls()
@@ -898,6 +981,84 @@ def test_last_commit_ids_threaded_error(self, _git):
                 mock.Mock(_id='13951944969cf45a701bf90f83647b309815e6d5'), ['f2.txt', 'f3.txt'])
             self.assertEqual(lcds, {})
 
+    def test_refresh_commit_docs_backends(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        commit_ids = list(impl.all_commit_ids())
+        with h.push_config(tg.config, **{'scm.git.refresh_backend': 'gitpython'}):
+            expected = list(impl.refresh_commit_docs(commit_ids, set()))
+        with h.push_config(tg.config, **{'scm.git.refresh_backend': 'cat-file'}):
+            docs = list(impl.refresh_commit_docs(commit_ids, set()))
+        self.assertEqual(len(docs), 5)
+        self.assertEqual(docs, expected)
+
+    def test_path_changes(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        changes = list(impl.path_changes([
+            ('1e146e67985dcd71c74de79613719bef7bddca4a',
+             ['df30427c488aeab84b2352bdf88a3b19223f9d7a']),
+            # compared with the given parent, not its own
+            ('5c47243c8e424136fd5cdd18cd94d34c66d1955c',
+             ['5c47243c8e424136fd5cdd18cd94d34c66d1955c']),
+            ('9a7df788cf800241e3bb5a849c8870f2f8259d98', []),
+        ]))
+        self.assertEqual(changes, [
+            ('1e146e67985dcd71c74de79613719bef7bddca4a', ['README']),
+            ('5c47243c8e424136fd5cdd18cd94d34c66d1955c', []),
+            ('9a7df788cf800241e3bb5a849c8870f2f8259d98', ['a/b/c/hello.txt']),
+        ])
+
+    def test_parse_commit(self):
+        ci = GM.git_repo.parse_commit(
+            'tree d7c40db3ffe2b87e96b94c280a67265c8de7a4ad\n'
+            'parent df30427c488aeab84b2352bdf88a3b19223f9d7a\n'
+            'parent 6a45885ae7347f1cac5103b0050cc1be6a1496c8\n'
+            'author Rick Copeland <rcopeland@geek.net> 1286477051 -0400\n'
+            'committer Rick <rick@example.com> 1286477052 +0000\n'
+            'gpgsig -----BEGIN PGP SIGNATURE-----\n'
+            ' \n'
+            ' -----END PGP SIGNATURE-----\n'
+            '\n'
+            'Change README\n\nMore details\n')
+        self.assertEqual(ci, dict(
+            tree='d7c40db3ffe2b87e96b94c280a67265c8de7a4ad',
+            parents=['df30427c488aeab84b2352bdf88a3b19223f9d7a',
+                     '6a45885ae7347f1cac5103b0050cc1be6a1496c8'],
+            author=('Rick Copeland', 'rcopeland@geek.net', 1286477051),
+            committer=('Rick', 'rick@example.com', 1286477052),
+            encoding='UTF-8',
+            message='Change README\n\nMore details\n'))
+
+    def test_raw_commit_doc_encoding(self):
+        impl = GM.git_repo.GitImplementation(mock.Mock())
+        ci = GM.git_repo.parse_commit(
+            'tree d7c40db3ffe2b87e96b94c280a67265c8de7a4ad\n'
+            'author Ren\xc3\xa9 <rene@example.com> 1286477051 -0400\n'
+            'committer Ren\xc3\xa9 <rene@example.com> 1286477051 -0400\n'
+            'encoding ISO-8859-1\n'
+            '\n'
+            'Caf\xc3\xa9\n')
+        doc = impl._raw_commit_doc('1e146e67985dcd71c74de79613719bef7bddca4a', ci)
+        # not guessed as UTF-8
+        self.assertEqual(doc['authored'].name, u'Ren\xc3\xa9')
+        self.assertEqual(doc['committed'].name, u'Ren\xc3\xa9')
+        self.assertEqual(doc['message'], u'Caf\xc3\xa9\n')
+
+    def test_parse_tree(self):
+        sha1 = '\x01' * 20
+        sha2 = '\x02' * 20
+        entries = list(GM.git_repo.parse_tree(
+            '100644 README\0' + sha1 + '40000 a dir\0' + sha2))
+        self.assertEqual(entries, [
+            ('100644', 'README', sha1),
+            ('40000', 'a dir', sha2),
+        ])
+
 
 class TestGitCommit(unittest.TestCase):
 
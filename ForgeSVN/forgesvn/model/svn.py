@@ -340,6 +340,18 @@ def all_commit_ids(self):
         head_revno = self.head
         return map(self._oid, range(head_revno, 0, -1))
 
+    def ref_tips(self):
+        head_revno = self.head
+        return [self._oid(head_revno)] if head_revno else []
+
+    def commits_between(self, old_tips, new_tips):
+        old_revno = self._revno(old_tips[0]) if old_tips else 0
+        new_revno = self._revno(new_tips[0]) if new_tips else 0
+        if old_revno > new_revno:
+            # the repo was replaced by an older one
+            return None
+        return map(self._oid, range(new_revno, old_revno, -1))
+
     def new_commits(self, all_commits=False):
         head_revno = self.head
         oids = [self._oid(revno) for revno in range(1, head_revno + 1)]
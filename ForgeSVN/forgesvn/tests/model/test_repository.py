@@ -558,6 +558,16 @@ def test_tarball_aware_of_trunk(self):
                       ignore_errors=True)
         shutil.rmtree(tarball_path, ignore_errors=True)
 
+    def test_commits_between(self):
+        oid = self.repo._impl._oid
+        head = self.repo._impl.head
+        self.assertEqual(self.repo.ref_tips(), [oid(head)])
+        self.assertEqual(self.repo.commits_between([oid(2)], [oid(4)]),
+                         [oid(4), oid(3)])
+        self.assertEqual(self.repo.commits_between([], [oid(2)]),
+                         [oid(2), oid(1)])
+        self.assertEqual(self.repo.commits_between([oid(4)], [oid(2)]), None)
+
     def test_is_empty(self):
         assert not self.repo.is_empty()
         with TempDirectory() as d:
@@ -866,6 +876,8 @@ def test_refresh(self):
             return_value=['foo%d' % i for i in range(100)])
         self.repo.symbolics_for_commit = mock.Mock(
             return_value=[['master', 'branch'], []])
+        # walk all_commit_ids, like the first refresh of a repo
+        self.repo.refresh_tips = []
 
         def refresh_commit_info(oid, seen, lazy=False):
             M.repository.CommitDoc(dict(
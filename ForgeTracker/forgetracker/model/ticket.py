@@ -22,6 +22,8 @@
 from datetime import datetime, timedelta
 from bson import ObjectId
 import os
+from collections import defaultdict, OrderedDict
+from threading import Lock
 
 import pymongo
 from pymongo.errors import OperationFailure
@@ -32,7 +34,7 @@
 
 from ming import schema
 from ming.utils import LazyProperty
-from ming.orm import Mapper, session
+from ming.orm import Mapper, session, state
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -58,6 +60,7 @@
     VotableArtifact,
 
     artifact_orm_session,
+    project_doc_session,
     project_orm_session,
     AlluraUserProperty,
 )
@@ -70,7 +73,7 @@
 from allura.lib import utils
 from allura.lib import helpers as h
 from allura.lib.plugin import ImportIdConverter
-from allura.tasks import mail_tasks
+from allura.tasks import mail_tasks, index_tasks
 from forgetracker import search as tsearch
 
 
@@ -113,6 +116,7 @@ class __mongometa__:
     # [dict(name=str,hits=int,closed=int)])
     _milestone_counts = FieldProperty(schema.Deprecated)
     _milestone_counts_expire = FieldProperty(schema.Deprecated)  # datetime)
+    _counts_invalidated = FieldProperty(datetime, if_missing=None)
     show_in_search = FieldProperty({str: bool}, if_missing={'ticket_num': True,
                                                             'summary': True,
                                                             '_milestone': True,
@@ -132,6 +136,31 @@ def next_ticket_num(self):
         session(gbl).expunge(gbl)
         return gbl.last_ticket_num
 
+    def reserve_ticket_nums(self, count):
+        '''Return ``count`` unused ticket numbers, reserved with one update
+        for a block of numbers, like :meth:`next_ticket_num` does for one.
+        Numbers of the block which are taken already (e.g. by imported
+        tickets) are skipped, and another block is reserved for them.'''
+        ticket_nums = []
+        while len(ticket_nums) < count:
+            needed = count - len(ticket_nums)
+            gbl = Globals.query.find_and_modify(
+                query=dict(app_config_id=self.app_config_id),
+                update={'$inc': {'last_ticket_num': needed}},
+                new=True)
+            if gbl is not self:
+                # self was refreshed, and stays in the session for updates
+                session(gbl).expunge(gbl)
+            block = range(gbl.last_ticket_num - needed + 1,
+                          gbl.last_ticket_num + 1)
+            tickets = project_doc_session.db[Ticket.__mongometa__.name]
+            taken = set(t['ticket_num'] for t in tickets.find(
+                dict(app_config_id=self.app_config_id,
+                     ticket_num={'$in': block}),
+                fields=['ticket_num']))
+            ticket_nums.extend(n for n in block if n not in taken)
+        return ticket_nums
+
     @property
     def all_status_names(self):
         return ' '.join([self.open_status_names, self.closed_status_names])
@@ -186,17 +215,28 @@ def get_custom_field_solr_type(self, field_name):
         return None
 
     def update_bin_counts(self):
-        # Refresh bin counts
-        self._bin_counts_data = []
-        for b in Bin.query.find(dict(
-                app_config_id=self.app_config_id)):
-            if b.terms and '$USER' in b.terms:
+        # Refresh bin counts, all from a single solr request with a facet
+        # query per bin
+        bins = [b for b in Bin.query.find(dict(app_config_id=self.app_config_id))
                 # skip queries with $USER variable, hits will be inconsistent
                 # for them
-                continue
-            r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False)
-            hits = r is not None and r.hits or 0
-            self._bin_counts_data.append(dict(summary=b.summary, hits=hits))
+                if not (b.terms and '$USER' in b.terms)]
+        queries = [None] * len(bins)
+        sample = Ticket.query.find().first()
+        if sample is not None:
+            fields = sample.index()
+            queries = [b.terms and Ticket.translate_query(b.terms, fields)
+                       for b in bins]
+        facet_counts = {}
+        if any(queries):
+            r = search_artifact(
+                Ticket, '*:*', rows=0, short_timeout=False, facet='true',
+                **{'facet.query': [q for q in queries if q]})
+            if r is not None:
+                facet_counts = r.facets.get('facet_queries', {})
+        self._bin_counts_data = [
+            dict(summary=b.summary, hits=facet_counts.get(q, 0) if q else 0)
+            for b, q in zip(bins, queries)]
         self._bin_counts_expire = \
             datetime.utcnow() + timedelta(minutes=60)
         self._bin_counts_invalidated = None
@@ -216,22 +256,32 @@ def milestone_count(self, name):
         d = dict(name=name, hits=0, closed=0)
         if not (fld_name and m_name):
             return d
-        mongo_query = {
-            'custom_fields.%s' % fld_name: m_name,
-            'app_config_id': self.app_config_id,
-            'deleted': False
-        }
-        d['hits'] = Ticket.query.find(dict(mongo_query, acl=[])).count()
-        d['closed'] = Ticket.query.find(dict(mongo_query, acl=[],
-                                             status={'$in': list(self.set_of_closed_status_names)})).count()
-
-        secured_tickets = Ticket.query.find(dict(mongo_query, acl={"$ne": []}))
-        if secured_tickets.count():
-            tickets = [t for t in secured_tickets if security.has_access(t, 'read')]
-            d['hits'] += len(tickets)
-            d['closed'] += sum(1 for t in tickets if t.status in self.set_of_closed_status_names)
+        d.update(self.ticket_counts().milestone(fld_name, m_name))
         return d
 
+    def ticket_counts(self, user=None):
+        '''Return the :class:`TicketCounts` of this tracker, as seen by user
+        (the current user by default).'''
+        if user is None:
+            user = c.user
+        by_user = self.__dict__.setdefault('_ticket_counts', {})
+        if user._id not in by_user:
+            access = security.AccessFilter(self.app_config, 'read', user)
+            by_user[user._id] = TicketCounts.get(self, access)
+        return by_user[user._id]
+
+    def invalidate_counts(self):
+        '''Expire the cached :class:`TicketCounts` of this tracker, in all
+        processes.
+
+        The marker is written with its own update, leaving this object clean,
+        so that saving it can't overwrite ``last_ticket_num``.'''
+        now = datetime.utcnow()
+        Globals.query.update({'_id': self._id},
+                             {'$set': {'_counts_invalidated': now}})
+        state(self).set('_counts_invalidated', now)
+        self.__dict__.pop('_ticket_counts', None)
+
     def invalidate_bin_counts(self):
         '''Force expiry of bin counts and queue them to be updated.'''
         # To prevent multiple calls to this method from piling on redundant
@@ -239,6 +289,7 @@ def invalidate_bin_counts(self):
         # the task clears it when it's done.  However, in the off chance
         # that the task fails or is interrupted, we ignore the flag if it's
         # older than 5 minutes.
+        self.invalidate_counts()
         invalidation_expiry = datetime.utcnow() - timedelta(minutes=5)
         if self._bin_counts_invalidated is not None and \
            self._bin_counts_invalidated > invalidation_expiry:
@@ -273,12 +324,23 @@ def move_tickets(self, ticket_ids, destination_tracker_id):
             _id={'$in': [ObjectId(id) for id in ticket_ids]},
             app_config_id=self.app_config_id)).sort('ticket_num').all()
         filtered = self.filtered_by_subscription({t._id: t for t in tickets})
-        original_ticket_nums = {t._id: t.ticket_num for t in tickets}
         users = User.query.find({'_id': {'$in': filtered.keys()}}).all()
-        moved_tickets = {}
-        for ticket in tickets:
-            moved = ticket.move(tracker, notify=False)
-            moved_tickets[moved._id] = moved
+        report = OrderedDict()
+        for original_num, moved in Ticket.move_many(tickets, tracker):
+            report[moved._id] = {
+                'original_num': original_num,
+                'destination_num': moved.ticket_num,
+                'summary': moved.summary,
+                'private': moved.private,
+            }
+        moved_from = '%s/%s' % (c.project.shortname,
+                                self.app_config.options.mount_point)
+        moved_to = '%s/%s' % (tracker.project.shortname,
+                              tracker.options.mount_point)
+        log.info('Moved %d tickets from %s to %s: %s', len(report),
+                 moved_from, moved_to, ', '.join(
+                     '%(original_num)s -> %(destination_num)s' % r
+                     for r in report.itervalues()))
         mail = dict(
             sender=c.project.app_instance(self.app_config).email_address,
             fromaddr=str(c.user.email_address_header()),
@@ -297,11 +359,8 @@ def move_tickets(self, ticket_ids, destination_tracker_id):
             'tickets': [],
         }
         for user in users:
-            tmpl_context['tickets'] = ({
-                'original_num': original_ticket_nums[_id],
-                'destination_num': moved_tickets[_id].ticket_num,
-                'summary': moved_tickets[_id].summary
-            } for _id in filtered.get(user._id, []))
+            tmpl_context['tickets'] = (
+                report[_id] for _id in filtered.get(user._id, []))
             mail.update(dict(
                 message_id=h.gen_message_id(),
                 text=tmpl.render(tmpl_context),
@@ -312,12 +371,9 @@ def move_tickets(self, ticket_ids, destination_tracker_id):
                 'AllTicketChanges', 'AllPublicTicketChanges'):
             monitoring_email = self.app_config.options.get(
                 'TicketMonitoringEmail')
-            tmpl_context['tickets'] = [{
-                'original_num': original_ticket_nums[_id],
-                'destination_num': moved_tickets[_id].ticket_num,
-                'summary': moved_tickets[_id].summary
-            } for _id, t in moved_tickets.iteritems()
-                if (not t.private or
+            tmpl_context['tickets'] = [
+                r for r in report.itervalues()
+                if (not r['private'] or
                     self.app_config.options.get('TicketMonitoringType') ==
                     'AllTicketChanges')]
             if len(tmpl_context['tickets']) > 0:
@@ -327,10 +383,6 @@ def move_tickets(self, ticket_ids, destination_tracker_id):
                     destinations=[monitoring_email]))
                 mail_tasks.sendmail.post(**mail)
 
-        moved_from = '%s/%s' % (c.project.shortname,
-                                self.app_config.options.mount_point)
-        moved_to = '%s/%s' % (tracker.project.shortname,
-                              tracker.options.mount_point)
         text = 'Tickets moved from %s to %s' % (moved_from, moved_to)
         Notification.post_user(c.user, None, 'flash', text=text)
 
@@ -373,17 +425,34 @@ def update_tickets(self, **post_data):
                 custom_values[cf.name] = v
                 custom_fields[cf.name] = cf
 
+        # resolve the users the changes mention once, not per ticket
+        user_ids = set(t.assigned_to_id for t in tickets)
+        user_ids.add(values.get('assigned_to_id'))
+        users = dict((u._id, u) for u in User.query.find(
+            {'_id': {'$in': list(user_ids)}}))
+        project_users = {}
+
+        def project_user(username):
+            # like Ticket.get_custom_user
+            if username not in project_users:
+                user = self.app_config.project.user_in_project(username)
+                project_users[username] = \
+                    None if user == User.anonymous() else user
+            return project_users[username]
+
         changes = {}
         changed_tickets = {}
+        old_data = {}
         for ticket in tickets:
             message = ''
+            old = state(ticket).clone()
             if labels:
                 values['labels'] = self.append_new_labels(
                     ticket.labels, labels.split(','))
             for k, v in sorted(values.iteritems()):
                 if k == 'assigned_to_id':
-                    new_user = User.query.get(_id=v)
-                    old_user = User.query.get(_id=getattr(ticket, k))
+                    new_user = users.get(v)
+                    old_user = users.get(getattr(ticket, k))
                     if new_user:
                         message += get_change_text(
                             get_label(k),
@@ -408,9 +477,10 @@ def _text(val):
                 setattr(ticket, k, v)
             for k, v in sorted(custom_values.iteritems()):
                 def cf_val(cf):
-                    return ticket.get_custom_user(cf.name) \
-                        if cf.type == 'user' \
-                        else ticket.custom_fields.get(cf.name)
+                    if cf.type != 'user':
+                        return ticket.custom_fields.get(cf.name)
+                    username = ticket.custom_fields.get(cf.name)
+                    return project_user(username) if username else None
                 cf = custom_fields[k]
                 old_value = cf_val(cf)
                 if cf.type == 'boolean':
@@ -424,8 +494,10 @@ def cf_val(cf):
             if message != '':
                 changes[ticket._id] = message
                 changed_tickets[ticket._id] = ticket
-                ticket.discussion_thread.post(message, notify=False)
-                ticket.commit()
+                old_data[ticket._id] = old
+        self._commit_changed_tickets(
+            [t for t in tickets if t._id in changed_tickets],
+            changes, old_data, users)
 
         filtered_changes = self.filtered_by_subscription(changed_tickets)
         users = User.query.find(
@@ -496,6 +568,37 @@ def changes_iter(user):
             count, 's' if count != 1 else '', app)
         Notification.post_user(c.user, None, 'flash', text=text)
 
+    def _commit_changed_tickets(self, tickets, changes, old_data, users):
+        '''Post the change comments of mass edited ``tickets`` and commit
+        them with bulk writes, then index all that was written with one
+        task'''
+        if not tickets:
+            return
+        threads = defaultdict(list)
+        for thread in Thread.query.find(
+                {'ref_id': {'$in': [t.index_id() for t in tickets]}}):
+            threads[thread.ref_id].append(thread)
+        thread_texts = []
+        for ticket in tickets:
+            found = threads[ticket.index_id()]
+            # let discussion_thread create or merge threads when needed
+            thread = found[0] if len(found) == 1 else ticket.discussion_thread
+            thread_texts.append((thread, changes[ticket._id]))
+        posts, written = Thread.post_many(thread_texts)
+        written += Ticket.commit_many(tickets)
+        for ticket in tickets:
+            old = old_data[ticket._id]
+            description = ticket._record_changes(
+                old,
+                old.assigned_to_id and users.get(old.assigned_to_id),
+                ticket.assigned_to_id and users.get(ticket.assigned_to_id))
+            ticket._post_to_feed(description)
+        Artifact.update_many(tickets)
+        written += tickets
+        self.invalidate_counts()
+        for chunk in utils.chunked_list([a.index_id() for a in written], 100 * 1000):
+            index_tasks.add_artifacts.post(chunk)
+
     def filtered_by_subscription(self, tickets, project_id=None, app_config_id=None):
         p_id = project_id if project_id else c.project._id
         ac_id = app_config_id if app_config_id else self.app_config_id
@@ -522,6 +625,94 @@ def append_new_labels(self, old_labels, new_labels):
         return list(old_labels | new_labels)
 
 
+class TicketCounts(object):
+
+    '''
+    Counts of the undeleted tickets of a tracker by status and milestone, as
+    seen by the users of one :class:`~allura.lib.security.AccessFilter`.
+
+    All counts come from a single query, and are cached in each process until
+    a ticket of the tracker changes (see :meth:`Globals.invalidate_counts`)
+    or for ``max_age`` at most.
+    '''
+    cache_size = 1000
+    max_age = timedelta(minutes=60)
+    _cache = OrderedDict()
+    _lock = Lock()
+
+    def __init__(self, globals, access):
+        self.closed_status_names = globals.set_of_closed_status_names
+        self.open_status_names = globals.set_of_open_status_names
+        self.by_status = defaultdict(int)
+        # {(field name, milestone name): {status: count}}
+        self.by_milestone = defaultdict(lambda: defaultdict(int))
+        milestone_fields = [fld.name for fld in globals.milestone_fields]
+        tickets = project_doc_session.db[Ticket.__mongometa__.name]
+        query = access.mongo_query(
+            dict(app_config_id=globals.app_config_id, deleted=False))
+        for group, count in self._groups(tickets, query, milestone_fields):
+            status = group.get('status')
+            self.by_status[status] += count
+            for i, fld_name in enumerate(milestone_fields):
+                m_name = group.get('m%d' % i)
+                if m_name:
+                    self.by_milestone[fld_name, m_name][status] += count
+
+    @staticmethod
+    def _groups(tickets, query, milestone_fields):
+        '''Count the tickets matching query by status and milestones, as
+        ``(dict(status=..., m0=..., m1=...), count)`` pairs, ``mN`` being the
+        value of the Nth of milestone_fields.'''
+        group = dict(status='$status')
+        for i, fld_name in enumerate(milestone_fields):
+            group['m%d' % i] = '$custom_fields.%s' % fld_name
+        result = tickets.aggregate([
+            {'$match': query},
+            {'$group': {'_id': group, 'count': {'$sum': 1}}},
+        ])
+        return [(r['_id'], r['count']) for r in result.get('result', [])]
+
+    @classmethod
+    def get(cls, globals, access):
+        '''Return the cached counts of globals' tracker for access, computing
+        them if needed.'''
+        key = (globals.app_config_id, globals._counts_invalidated, access.key)
+        now = datetime.utcnow()
+        with cls._lock:
+            entry = cls._cache.pop(key, None)
+            if entry is not None and entry[0] > now - cls.max_age:
+                cls._cache[key] = entry
+                return entry[1]
+        counts = cls(globals, access)
+        with cls._lock:
+            cls._cache[key] = (now, counts)
+            while len(cls._cache) > cls.cache_size:
+                cls._cache.popitem(last=False)
+        return counts
+
+    def _sum(self, by_status, statuses=None):
+        return sum(n for status, n in by_status.iteritems()
+                   if statuses is None or status in statuses)
+
+    @property
+    def total(self):
+        return self._sum(self.by_status)
+
+    @property
+    def open(self):
+        return self._sum(self.by_status, self.open_status_names)
+
+    @property
+    def closed(self):
+        return self._sum(self.by_status, self.closed_status_names)
+
+    def milestone(self, fld_name, m_name):
+        '''Return dict(hits=..., closed=...) for a milestone'''
+        by_status = self.by_milestone.get((fld_name, m_name), {})
+        return dict(hits=self._sum(by_status),
+                    closed=self._sum(by_status, self.closed_status_names))
+
+
 class TicketHistory(Snapshot):
 
     class __mongometa__:
@@ -687,6 +878,7 @@ def index(self):
             text=self.description,
             snippet_s=self.summary,
             private_b=self.private,
+            read_roles_ws=security.AccessFilter.index_roles(self.acl, 'read'),
             discussion_disabled_b=self.discussion_disabled,
             votes_up_i=self.votes_up,
             votes_down_i=self.votes_down,
@@ -858,47 +1050,13 @@ def _get_discussion_disabled(self):
 
     def commit(self, **kwargs):
         VersionedArtifact.commit(self)
+        self.globals.invalidate_counts()
         monitoring_email = self.app.config.options.get('TicketMonitoringEmail')
         if self.version > 1:
             hist = TicketHistory.query.get(
                 artifact_id=self._id, version=self.version - 1)
-            old = hist.data
-            changes = ['Ticket %s has been modified: %s' % (
-                self.ticket_num, self.summary),
-                'Edited By: %s (%s)' % (c.user.get_pref('display_name'), c.user.username)]
-            fields = [
-                ('Summary', old.summary, self.summary),
-                ('Status', old.status, self.status)]
-            if old.status != self.status and self.status in c.app.globals.set_of_closed_status_names:
-                h.log_action(log, 'closed').info('')
-                g.statsUpdater.ticketEvent(
-                    "closed", self, self.project, self.assigned_to)
-            for key in self.custom_fields:
-                fields.append(
-                    (key, old.custom_fields.get(key, ''), self.custom_fields[key]))
-            for title, o, n in fields:
-                if o != n:
-                    changes.append('%s updated: %r => %r' % (
-                        title, o, n))
-            o = hist.assigned_to
-            n = self.assigned_to
-            if o != n:
-                changes.append('Owner updated: %r => %r' % (
-                    o and o.username, n and n.username))
-                self.subscribe(user=n)
-                g.statsUpdater.ticketEvent("assigned", self, self.project, n)
-                if o:
-                    g.statsUpdater.ticketEvent(
-                        "revoked", self, self.project, o)
-            if old.description != self.description:
-                changes.append('Description updated:')
-                changes.append('\n'.join(
-                    difflib.unified_diff(
-                        a=old.description.split('\n'),
-                        b=self.description.split('\n'),
-                        fromfile='description-old',
-                        tofile='description-new')))
-            description = '\n'.join(changes)
+            description = self._record_changes(
+                hist.data, hist.assigned_to, self.assigned_to)
         else:
             self.subscribe()
             if self.assigned_to_id:
@@ -922,6 +1080,50 @@ def commit(self, **kwargs):
                                            self.app.config.options.get('TicketMonitoringType') in (
                                                'NewTicketsOnly', 'AllTicketChanges')):
                 n.send_simple(monitoring_email)
+        self._post_to_feed(description)
+
+    def _record_changes(self, old, old_assigned_to, assigned_to):
+        '''Log, count and subscribe the new owner for the changes of this
+        ticket since ``old``, the data of its previous snapshot.  Returns the
+        description of the changes.'''
+        changes = ['Ticket %s has been modified: %s' % (
+            self.ticket_num, self.summary),
+            'Edited By: %s (%s)' % (c.user.get_pref('display_name'), c.user.username)]
+        fields = [
+            ('Summary', old.summary, self.summary),
+            ('Status', old.status, self.status)]
+        if old.status != self.status and self.status in c.app.globals.set_of_closed_status_names:
+            h.log_action(log, 'closed').info('')
+            g.statsUpdater.ticketEvent(
+                "closed", self, self.project, assigned_to)
+        for key in self.custom_fields:
+            fields.append(
+                (key, old.custom_fields.get(key, ''), self.custom_fields[key]))
+        for title, o, n in fields:
+            if o != n:
+                changes.append('%s updated: %r => %r' % (
+                    title, o, n))
+        o = old_assigned_to
+        n = assigned_to
+        if o != n:
+            changes.append('Owner updated: %r => %r' % (
+                o and o.username, n and n.username))
+            self.subscribe(user=n)
+            g.statsUpdater.ticketEvent("assigned", self, self.project, n)
+            if o:
+                g.statsUpdater.ticketEvent(
+                    "revoked", self, self.project, o)
+        if old.description != self.description:
+            changes.append('Description updated:')
+            changes.append('\n'.join(
+                difflib.unified_diff(
+                    a=old.description.split('\n'),
+                    b=self.description.split('\n'),
+                    fromfile='description-old',
+                    tofile='description-new')))
+        return '\n'.join(changes)
+
+    def _post_to_feed(self, description):
         Feed.post(
             self,
             title=self.summary,
@@ -1008,47 +1210,11 @@ def move(self, app_config, notify=True):
         prior_ticket_num = self.ticket_num
         attachments = self.attachments
         attach_metadata = BaseAttachment.metadata_for(self)
-        prior_cfs = [
-            (cf['name'], cf['type'], cf['label'])
-            for cf in prior_app.globals.custom_fields or []]
-        new_cfs = [
-            (cf['name'], cf['type'], cf['label'])
-            for cf in app.globals.custom_fields or []]
-        skipped_fields = []
-        user_fields = []
-        for cf in prior_cfs:
-            if cf not in new_cfs:  # can't convert
-                skipped_fields.append(cf)
-            elif cf[1] == 'user':  # can convert and field type == user
-                user_fields.append(cf)
-        messages = []
-        for cf in skipped_fields:
-            name = cf[0]
-            messages.append('- **%s**: %s' %
-                            (name, self.custom_fields.get(name, '')))
-        for cf in user_fields:
-            name = cf[0]
-            username = self.custom_fields.get(name, None)
-            user = app_config.project.user_in_project(username)
-            if not user or user == User.anonymous():
-                messages.append('- **%s**: %s (user not in project)' %
-                                (name, username))
-                self.custom_fields[name] = ''
-        # special case: not custom user field (assigned_to_id)
-        user = self.assigned_to
-        if user and not app_config.project.user_in_project(user.username):
-            messages.append('- **assigned_to**: %s (user not in project)' %
-                            user.username)
-            self.assigned_to_id = None
-
-        custom_fields = {}
-        for cf in new_cfs:
-            fn, ft, fl = cf
-            old_val = self.custom_fields.get(fn, None)
-            if old_val is None:
-                custom_fields[fn] = None if ft == 'user' else ''
-            custom_fields[fn] = old_val
-        self.custom_fields = custom_fields
+        prior_cfs = self._move_custom_fields(prior_app)
+        new_cfs = self._move_custom_fields(app)
+        messages = self._convert_for_move(
+            app_config, prior_cfs, new_cfs,
+            app_config.project.user_in_project, self.assigned_to)
 
         # move ticket. ensure unique ticket_num
         while True:
@@ -1098,13 +1264,174 @@ def move(self, app_config, notify=True):
             moved_to_url=ticket.url(),
         )
 
+        message = self._moved_message(prior_url, messages)
+        with h.push_context(ticket.project_id, app_config_id=app_config._id):
+            ticket.discussion_thread.add_post(text=message, notify=notify)
+        return ticket
+
+    @classmethod
+    def move_many(cls, tickets, app_config):
+        '''Move ``tickets``, all from the same tracker, to the tracker of
+        ``app_config`` like :meth:`move` does with ``notify=False``, with
+        bulk writes:
+
+        - the new ticket numbers are reserved with one update
+        - tickets, their threads and posts are saved with one bulk write
+          per collection, attachments with one update each for the tickets
+          and their posts; history snapshots refer to tickets by id, and
+          need no change
+        - MovedTickets and the comments on the moved tickets are inserted
+          in bulk
+        - all that was written is indexed by one task
+
+        Returns ``(prior ticket number, moved ticket)`` pairs, in the order
+        of ``tickets``.
+        '''
+        tickets = list(tickets)
+        if not tickets:
+            return []
+        app = app_config.project.app_instance(app_config)
+        prior_app = tickets[0].app
+        prior_cfs = cls._move_custom_fields(prior_app)
+        new_cfs = cls._move_custom_fields(app)
+        # resolve the users once, not per ticket
+        in_project = {}
+
+        def user_in_project(username):
+            if username not in in_project:
+                in_project[username] = \
+                    app_config.project.user_in_project(username)
+            return in_project[username]
+        owners = dict((u._id, u) for u in User.query.find({'_id': {'$in': list(
+            set(t.assigned_to_id for t in tickets if t.assigned_to_id))}}))
+
+        moves = []
+        for ticket in tickets:
+            messages = ticket._convert_for_move(
+                app_config, prior_cfs, new_cfs, user_in_project,
+                owners.get(ticket.assigned_to_id))
+            moves.append((ticket.ticket_num, ticket.url(), messages))
+        with h.push_context(app_config.project_id, app_config_id=app_config._id):
+            ticket_nums = app.globals.reserve_ticket_nums(len(tickets))
+        for ticket, ticket_num in zip(tickets, ticket_nums):
+            ticket.ticket_num = ticket_num
+            ticket.app_config_id = app_config._id
+        cls.update_many(tickets)
+        ticket_ids = [t._id for t in tickets]
+        BaseAttachment.query.update(
+            {'artifact_id': {'$in': ticket_ids},
+             'app_config_id': prior_app.config._id},
+            {'$set': {'app_config_id': app_config._id}},
+            multi=True)
+
+        # move the tickets' discussion threads, thus all new comments will
+        # go to the new tickets' feeds
+        threads = Thread.query.find(
+            {'ref_id': {'$in': [t.index_id() for t in tickets]}}).all()
+        for thread in threads:
+            thread.app_config_id = app_config._id
+            thread.discussion_id = app_config.discussion_id
+        posts = Thread.post_class().query.find(
+            {'thread_id': {'$in': [t._id for t in threads]}}).all()
+        for post in posts:
+            post.app_config_id = app_config._id
+            post.app_id = app_config._id
+            post.discussion_id = app_config.discussion_id
+        Artifact.update_many(threads + posts)
+        Thread.attachment_class().query.update(
+            {'post_id': {'$in': [p._id for p in posts]}},
+            {'$set': {'app_config_id': app_config._id,
+                      'discussion_id': app_config.discussion_id}},
+            multi=True)
+        written = tickets + threads + posts
+
+        # reload, to reset the app_config relations of the tickets
+        for a in written:
+            session(a).expunge(a)
+        moved = dict((t._id, t) for t in cls.query.find(
+            {'_id': {'$in': ticket_ids}}))
+        result = []
+        redirects = []
+        thread_texts = []
+        for _id, (prior_num, prior_url, messages) in zip(ticket_ids, moves):
+            ticket = moved[_id]
+            h.log_action(log, 'moved').info(
+                'Ticket %s moved to %s' % (prior_url, ticket.url()))
+            # creating MovedTicket to be able to redirect from this url
+            redirects.append(MovedTicket(
+                app_config_id=prior_app.config._id, ticket_num=prior_num,
+                moved_to_url=ticket.url()))
+            thread_texts.append((ticket.discussion_thread,
+                                 cls._moved_message(prior_url, messages)))
+            result.append((prior_num, ticket))
+        written = moved.values() + Artifact.insert_many(redirects)
+        with h.push_context(app_config.project_id, app_config_id=app_config._id):
+            posts, posted = Thread.post_many(thread_texts)
+            for (thread, text), post in zip(thread_texts, posts):
+                if not thread.first_post_id:
+                    thread.first_post_id = post._id
+                thread.post_to_feed(post)
+        written += posted
+        for chunk in utils.chunked_list([a.index_id() for a in written], 100 * 1000):
+            index_tasks.add_artifacts.post(chunk)
+        prior_app.globals.invalidate_counts()
+        app.globals.invalidate_counts()
+        return result
+
+    @staticmethod
+    def _move_custom_fields(app):
+        return [(cf['name'], cf['type'], cf['label'])
+                for cf in app.globals.custom_fields or []]
+
+    def _convert_for_move(self, app_config, prior_cfs, new_cfs,
+                          user_in_project, assigned_to):
+        '''Convert the custom fields and owner of this ticket for the tracker
+        of ``app_config``.  Returns messages about the values which can't be
+        converted.'''
+        skipped_fields = []
+        user_fields = []
+        for cf in prior_cfs:
+            if cf not in new_cfs:  # can't convert
+                skipped_fields.append(cf)
+            elif cf[1] == 'user':  # can convert and field type == user
+                user_fields.append(cf)
+        messages = []
+        for cf in skipped_fields:
+            name = cf[0]
+            messages.append('- **%s**: %s' %
+                            (name, self.custom_fields.get(name, '')))
+        for cf in user_fields:
+            name = cf[0]
+            username = self.custom_fields.get(name, None)
+            user = user_in_project(username)
+            if not user or user == User.anonymous():
+                messages.append('- **%s**: %s (user not in project)' %
+                                (name, username))
+                self.custom_fields[name] = ''
+        # special case: not custom user field (assigned_to_id)
+        user = assigned_to
+        if user and not user_in_project(user.username):
+            messages.append('- **assigned_to**: %s (user not in project)' %
+                            user.username)
+            self.assigned_to_id = None
+
+        custom_fields = {}
+        for cf in new_cfs:
+            fn, ft, fl = cf
+            old_val = self.custom_fields.get(fn, None)
+            if old_val is None:
+                custom_fields[fn] = None if ft == 'user' else ''
+            custom_fields[fn] = old_val
+        self.custom_fields = custom_fields
+        return messages
+
+    @staticmethod
+    def _moved_message(prior_url, messages):
         message = 'Ticket moved from %s' % prior_url
         if messages:
             message += '\n\nCan\'t be converted:\n\n'
         message += '\n'.join(messages)
-        with h.push_context(ticket.project_id, app_config_id=app_config._id):
-            ticket.discussion_thread.add_post(text=message, notify=notify)
-        return ticket
+        return message
 
     def attachments_for_export(self):
         return [dict(bytes=attach.length,
@@ -1155,8 +1482,10 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
         See also paged_search which does a solr search
         """
         limit, page, start = g.handle_paging(limit, page, default=25)
-        q = cls.query.find(
-            dict(query, app_config_id=app_config._id, deleted=deleted))
+        access = security.AccessFilter(
+            app_config, 'read', user, app_config.project.root_project)
+        q = cls.query.find(access.mongo_query(
+            dict(query, app_config_id=app_config._id, deleted=deleted)))
         q = q.sort('ticket_num', pymongo.DESCENDING)
         if sort:
             field, direction = sort.split()
@@ -1168,13 +1497,8 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
             q = q.sort(field, direction)
         q = q.skip(start)
         q = q.limit(limit)
-        tickets = []
         count = q.count()
-        for t in q:
-            if security.has_access(t, 'read', user, app_config.project.root_project):
-                tickets.append(t)
-            else:
-                count = count - 1
+        tickets = q.all()
 
         return dict(
             tickets=tickets,
@@ -1211,6 +1535,10 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
         refined_sort = sort if sort else 'ticket_num_i desc'
         if 'ticket_num_i' not in refined_sort:
             refined_sort += ',ticket_num_i asc'
+        project = app_config.project.root_project
+        fq = security.AccessFilter(app_config, 'read', user, project).solr_filter()
+        if not (show_deleted and security.has_access(app_config, 'delete', user, project)):
+            fq.append('deleted_b:False')
         try:
             if q:
                 # also query for choices for filter options right away
@@ -1219,7 +1547,7 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
                 matches = search_artifact(
                     cls, q, short_timeout=True,
                     rows=limit, sort=refined_sort, start=start, fl='ticket_num_i',
-                    filter=filter, **params)
+                    filter=filter, fq=fq, **params)
             else:
                 matches = None
             solr_error = None
@@ -1241,13 +1569,9 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
             tickets = []
             for tn in ticket_numbers:
                 if tn in ticket_for_num:
-                    show_deleted = show_deleted and security.has_access(
-                        ticket_for_num[tn], 'delete', user, app_config.project.root_project)
-                    if (security.has_access(ticket_for_num[tn], 'read', user, app_config.project.root_project) and
-                            (show_deleted or ticket_for_num[tn].deleted == False)):
-                        tickets.append(ticket_for_num[tn])
-                    else:
-                        count = count - 1
+                    tickets.append(ticket_for_num[tn])
+                else:
+                    count = count - 1
         return dict(tickets=tickets,
                     count=count, q=q, limit=limit, page=page, sort=sort,
                     filter=filter,
@@ -1273,7 +1597,10 @@ def paged_query_or_search(cls, app_config, user, query, search_query, filter,
             t = cls.query.find().first()
             if t:
                 search_query = cls.translate_query(search_query, t.index())
-            result['filter_choices'] = tsearch.query_filter_choices(search_query)
+            access = security.AccessFilter(
+                app_config, 'read', user, app_config.project.root_project)
+            result['filter_choices'] = tsearch.query_filter_choices(
+                search_query, fq=access.solr_filter())
         else:
             result = cls.paged_search(app_config, user, search_query, filter=filter,
                                       sort=solr_sort, limit=limit, page=page, **kw)
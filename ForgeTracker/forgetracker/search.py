@@ -28,11 +28,12 @@
 }
 
 
-def query_filter_choices(arg=None):
+def query_filter_choices(arg=None, fq=None):
     """
     Makes solr query and returns facets for tickets.
 
     :param arg: solr query, string
+    :param fq: additional solr filter queries, list
     """
     params = {
         'short_timeout': True,
@@ -40,7 +41,7 @@ def query_filter_choices(arg=None):
             'project_id_s:%s' % c.project._id,
             'mount_point_s:%s' % c.app.config.options.mount_point,
             'type_s:Ticket',
-            ],
+            ] + list(fq or []),
         'rows': 0,
     }
     params.update(FACET_PARAMS)
@@ -14,3 +14,25 @@
 #       KIND, either express or implied.  See the License for the
 #       specific language governing permissions and limitations
 #       under the License.
+
+from collections import defaultdict
+
+from mock import patch
+
+from forgetracker.model.ticket import TicketCounts
+
+
+def _groups_without_aggregate(tickets, query, milestone_fields):
+    counts = defaultdict(int)
+    fields = ['status'] + ['custom_fields.%s' % f for f in milestone_fields]
+    for t in tickets.find(query, fields=fields):
+        custom_fields = t.get('custom_fields') or {}
+        key = [('status', t.get('status'))]
+        key += [('m%d' % i, custom_fields.get(f))
+                for i, f in enumerate(milestone_fields)]
+        counts[tuple(key)] += 1
+    return [(dict(pairs), count) for pairs, count in counts.iteritems()]
+
+# mim doesn't support aggregate, group the tickets in python instead
+patch_ticket_groups = patch.object(
+    TicketCounts, '_groups', staticmethod(_groups_without_aggregate))
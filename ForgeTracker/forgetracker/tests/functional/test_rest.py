@@ -28,6 +28,7 @@
 from alluratest.controller import TestRestApiBase
 
 from forgetracker import model as TM
+from forgetracker.tests import patch_ticket_groups
 
 
 class TestTrackerApiBase(TestRestApiBase):
@@ -122,6 +123,7 @@ def test_update_ticket(self):
         assert json['summary'] == 'test update ticket', json
 
 
+@patch_ticket_groups
 class TestRestIndex(TestTrackerApiBase):
 
     def setUp(self):
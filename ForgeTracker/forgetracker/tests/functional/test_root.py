@@ -48,6 +48,7 @@
 from allura import model as M
 from forgewiki import model as wm
 from forgetracker import model as tm
+from forgetracker.tests import patch_ticket_groups
 
 from allura.lib.security import has_access
 from allura.lib import helpers as h
@@ -100,6 +101,7 @@ def new_ticket(self, mount_point='/bugs/', extra_environ=None, **kw):
         return resp
 
 
+@patch_ticket_groups
 class TestMilestones(TrackerTestController):
     def test_milestone_list(self):
         r = self.app.get('/bugs/milestones')
@@ -281,6 +283,7 @@ def test_deleted_ticket_visibility(self):
         assert '<tr class=" deleted">' in r
 
 
+@patch_ticket_groups
 class TestFunctionalController(TrackerTestController):
     def test_bad_ticket_number(self):
         self.app.get('/bugs/input.project_user_select', status=404)
@@ -2757,6 +2760,7 @@ def test_search_results(self):
         assert r.html.find('table', 'ticket-list').tbody.tr.findAll('td')[7].text == 'Test Admin'
 
 
+@patch_ticket_groups
 class TestHelpTextOptions(TrackerTestController):
     def _set_options(self, new_txt='', search_txt=''):
         r = self.app.post('/admin/bugs/set_options', params={
@@ -3111,6 +3115,7 @@ def sidebar_contains(response, text):
     return text in str(sidebar_menu)
 
 
+@patch_ticket_groups
 class TestStats(TrackerTestController):
     def test_stats(self):
         r = self.app.get('/bugs/stats/', status=200)
@@ -29,9 +29,11 @@
 from allura import model as M
 from allura.tests import decorators as td
 from forgetracker import model as TM
+from forgetracker.tests import patch_ticket_groups
 from forgetracker.tests.functional.test_root import TrackerTestController
 
 
+@patch_ticket_groups
 class TestBulkExport(TrackerTestController):
 
     @td.with_tracker
@@ -20,10 +20,12 @@
 import mock
 from nose.tools import assert_equal
 from pylons import tmpl_context as c
+from ming.orm import state
 from ming.orm.ormsession import ThreadLocalORMSession
 
-import forgetracker
-from forgetracker.model import Globals
+from forgetracker.model import Globals, Ticket
+from forgetracker.model.ticket import TicketCounts
+from forgetracker.tests import patch_ticket_groups
 from forgetracker.tests.unit import TrackerTestWithModel
 from allura.lib import helpers as h
 
@@ -98,27 +100,97 @@ def test_invalidate_bin_counts(self, mock_dt, mock_task):
         assert mock_task.post.called
         assert_equal(gbl._bin_counts_invalidated, now)
 
+    @mock.patch('forgetracker.model.ticket.Ticket')
     @mock.patch('forgetracker.model.ticket.Bin')
     @mock.patch('forgetracker.model.ticket.search_artifact')
     @mock.patch('forgetracker.model.ticket.datetime')
-    def test_update_bin_counts(self, mock_dt, mock_search, mock_bin):
+    def test_update_bin_counts(self, mock_dt, mock_search, mock_bin, mock_ticket):
         now = datetime.utcnow().replace(microsecond=0)
         mock_dt.utcnow.return_value = now
         gbl = Globals()
         gbl._bin_counts_invalidated = now - timedelta(minutes=1)
         mock_bin.query.find.return_value = [
-            mock.Mock(summary='foo', terms='bar')]
-        mock_search().hits = 5
+            mock.Mock(summary='foo', terms='bar'),
+            mock.Mock(summary='baz', terms='qux'),
+            mock.Mock(summary='mine', terms='assigned_to:$USER')]
+        mock_ticket.translate_query.side_effect = lambda q, f: q + '_t'
+        mock_search().facets = {'facet_queries': {'bar_t': 5}}
 
         assert_equal(gbl._bin_counts_data, [])  # sanity pre-check
         gbl.update_bin_counts()
         assert mock_bin.query.find.called
         mock_search.assert_called_with(
-            forgetracker.model.Ticket, 'bar', rows=0, short_timeout=False)
-        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5}])
+            mock_ticket, '*:*', rows=0, short_timeout=False, facet='true',
+            **{'facet.query': ['bar_t', 'qux_t']})
+        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5},
+                                            {'summary': 'baz', 'hits': 0}])
         assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=60))
         assert_equal(gbl._bin_counts_invalidated, None)
 
+    @patch_ticket_groups
+    def test_ticket_counts(self):
+        from allura.websetup import bootstrap
+        observer = bootstrap.create_user('Random Non-Project User')
+        statuses = ['open', 'closed', 'open', 'wont-fix', 'accepted']
+        for i, status in enumerate(statuses, 1):
+            t = Ticket(app_config_id=c.app.config._id, ticket_num=i,
+                       summary='ticket %s' % i, status=status,
+                       custom_fields={'_milestone': '1.0' if i < 4 else '2.0'})
+            t.private = i == 5
+        Ticket(app_config_id=c.app.config._id, ticket_num=6, deleted=True,
+               summary='deleted', status='open',
+               custom_fields={'_milestone': '1.0'})
+        ThreadLocalORMSession.flush_all()
+        gbl = c.app.globals
+
+        counts = gbl.ticket_counts()
+        assert_equal((counts.total, counts.open, counts.closed), (5, 3, 2))
+        assert_equal(gbl.milestone_count('_milestone:1.0'),
+                     dict(name='_milestone:1.0', hits=3, closed=1))
+        assert_equal(gbl.milestone_count('_milestone:2.0'),
+                     dict(name='_milestone:2.0', hits=2, closed=1))
+        assert gbl.ticket_counts() is counts
+
+        counts = gbl.ticket_counts(observer)
+        assert_equal((counts.total, counts.open, counts.closed), (4, 2, 2))
+
+        # cached until invalidated
+        Ticket.query.get(ticket_num=1).status = 'closed'
+        ThreadLocalORMSession.flush_all()
+        assert_equal(gbl.ticket_counts().closed, 2)
+        gbl.invalidate_counts()
+        assert_equal(gbl.ticket_counts().closed, 3)
+        assert_equal(gbl.milestone_count('_milestone:1.0')['closed'], 2)
+
+    def test_ticket_counts_aggregate(self):
+        tickets = mock.Mock()
+        tickets.aggregate.return_value = {'result': [
+            {'_id': {'status': 'open', 'm0': '1.0'}, 'count': 2},
+            {'_id': {'status': 'closed'}, 'count': 1}]}
+        groups = TicketCounts._groups(tickets, {'deleted': False}, ['_milestone'])
+        assert_equal(groups, [
+            ({'status': 'open', 'm0': '1.0'}, 2), ({'status': 'closed'}, 1)])
+        pipeline = tickets.aggregate.call_args[0][0]
+        assert_equal(pipeline[0], {'$match': {'deleted': False}})
+        assert_equal(pipeline[1]['$group']['_id'], {
+            'status': '$status', 'm0': '$custom_fields._milestone'})
+        assert not tickets.find.called
+
+    def test_invalidate_counts(self):
+        gbl = c.app.globals
+        # another process takes a ticket number meanwhile
+        Globals.query.update({'_id': gbl._id}, {'$inc': {'last_ticket_num': 5}})
+        gbl.invalidate_counts()
+        assert_equal(state(gbl).status, state(gbl).clean)
+        invalidated = gbl._counts_invalidated
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        gbl = Globals.query.get(_id=gbl._id)
+        assert_equal(gbl.last_ticket_num, 5)
+        # mongo stores milliseconds
+        assert_equal(gbl._counts_invalidated,
+                     invalidated.replace(microsecond=invalidated.microsecond // 1000 * 1000))
+
     def test_append_new_labels(self):
         gbl = Globals()
         assert_equal(gbl.append_new_labels([], ['tag1']), ['tag1'])
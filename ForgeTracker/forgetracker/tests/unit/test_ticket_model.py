@@ -183,6 +183,46 @@ def test_private_ticket(self):
         assert has_access(t, 'read', user=observer)()
         assert has_access(t, 'read', user=anon)()
 
+    def test_paged_query_private(self):
+        from allura.model import ProjectRole
+        from allura.lib.security import Credentials
+        from allura.websetup import bootstrap
+
+        admin = c.user
+        creator = bootstrap.create_user('Not a Project Admin')
+        developer = bootstrap.create_user('Project Developer')
+        observer = bootstrap.create_user('Random Non-Project User')
+        ProjectRole.by_user(developer, upsert=True).roles.append(
+            ProjectRole.by_name('Developer')._id)
+        for i in range(1, 6):
+            t = Ticket(app_config_id=c.app.config._id, ticket_num=i,
+                       summary='ticket %s' % i, reported_by_id=creator._id)
+            t.private = i % 2 == 0
+        ThreadLocalORMSession.flush_all()
+        Credentials.get().clear()
+
+        def ticket_nums(user, **kw):
+            result = Ticket.paged_query(c.app.config, user, {}, **kw)
+            return result['count'], [t.ticket_num for t in result['tickets']]
+
+        assert_equal(ticket_nums(admin), (5, [5, 4, 3, 2, 1]))
+        assert_equal(ticket_nums(developer), (5, [5, 4, 3, 2, 1]))
+        assert_equal(ticket_nums(creator), (5, [5, 4, 3, 2, 1]))
+        assert_equal(ticket_nums(observer), (3, [5, 3, 1]))
+        # pages are full
+        assert_equal(ticket_nums(observer, limit=2), (3, [5, 3]))
+        assert_equal(ticket_nums(observer, limit=2, page=1), (3, [1]))
+
+    def test_index_read_roles(self):
+        from allura.model import ProjectRole
+        t = Ticket(summary='my ticket', ticket_num=3,
+                   reported_by_id=c.user._id)
+        assert_equal(t.index()['read_roles_ws'], '')
+        t.private = True
+        assert_equal(t.index()['read_roles_ws'], '%s %s' % (
+            ProjectRole.by_name('Developer')._id,
+            ProjectRole.by_user(c.user)._id))
+
     def test_feed(self):
         t = Ticket(
             app_config_id=c.app.config._id,
@@ -310,6 +350,64 @@ def test_ticket_move_with_users_not_in_project(self):
         message += '\n- **assigned_to**: test-user-0 (user not in project)'
         assert_equal(post.text, message)
 
+    @td.with_tool('test', 'Tickets', 'bugs', username='test-user')
+    @td.with_tool('test', 'Tickets', 'bugs2', username='test-user')
+    def test_ticket_move_many(self):
+        app1 = c.project.app_instance('bugs')
+        app2 = c.project.app_instance('bugs2')
+        app1.globals.custom_fields.extend([
+            {'name': '_test', 'type': 'string', 'label': 'Test field'}])
+        ThreadLocalORMSession.flush_all()
+        with h.push_context(c.project._id, app_config_id=app2.config._id):
+            Ticket.new().summary = 'existing ticket'
+        with h.push_context(c.project._id, app_config_id=app1.config._id):
+            tickets = []
+            for i in range(3):
+                ticket = Ticket.new()
+                ticket.summary = 'test ticket %s' % i
+                ticket.custom_fields['_test'] = 'test val %s' % i
+                ticket.assigned_to_id = User.by_username('test-user')._id
+                ticket.discussion_thread.add_post(text='test comment %s' % i)
+                tickets.append(ticket)
+        ThreadLocalORMSession.flush_all()
+
+        moved = Ticket.move_many(tickets, app2.config)
+        ThreadLocalORMSession.flush_all()
+        assert_equal([(num, t.ticket_num) for num, t in moved],
+                     [(1, 2), (2, 3), (3, 4)])
+        assert_equal(
+            Ticket.query.find({'app_config_id': app1.config._id}).count(), 0)
+        assert_equal(
+            Ticket.query.find({'app_config_id': app2.config._id}).count(), 4)
+        t = moved[1][1]
+        assert_equal(t.summary, 'test ticket 1')
+        assert_equal(t.url(), '/p/test/bugs2/3/')
+        assert_equal(t.assigned_to.username, 'test-user')
+        # only the fields of the new tracker, whose default _milestone is unset
+        assert_equal(t.custom_fields, {'_milestone': None})
+        assert_equal(app2.globals.last_ticket_num, 4)
+
+        posts = Post.query.find(dict(thread_id=t.discussion_thread._id)).sort(
+            'timestamp').all()
+        assert_equal([p.text for p in posts], [
+            'test comment 1',
+            'Ticket moved from /p/test/bugs/2/'
+            '\n\nCan\'t be converted:\n'
+            '\n- **_test**: test val 1'])
+        for p in posts:
+            assert_equal(p.app_config_id, app2.config._id)
+            assert_equal(p.discussion_id, app2.config.discussion_id)
+        assert_equal(t.discussion_thread.app_config_id, app2.config._id)
+        assert_equal(t.discussion_thread.num_replies, 2)
+
+    @td.with_tool('test', 'Tickets', 'bugs', username='test-user')
+    def test_reserve_ticket_nums(self):
+        with h.push_context(c.project._id, app_config_id=c.app.config._id):
+            Ticket(ticket_num=3, summary='imported ticket')
+            ThreadLocalORMSession.flush_all()
+            assert_equal(c.app.globals.reserve_ticket_nums(3), [1, 2, 4])
+            assert_equal(c.app.globals.reserve_ticket_nums(1), [5])
+
     @td.with_tool('test', 'Tickets', 'bugs', username='test-user')
     def test_attach_with_resettable_stream(self):
         with h.push_context(c.project._id, app_config_id=c.app.config._id):
@@ -336,10 +434,11 @@ def test_json_parents(self):
         assert_in('ticket_num', json_keys)  # Ticket
         assert ticket.__json__()['assigned_to'] is None
 
+    @mock.patch('forgetracker.model.ticket.security.AccessFilter')
     @mock.patch('forgetracker.model.ticket.tsearch')
     @mock.patch.object(Ticket, 'paged_search')
     @mock.patch.object(Ticket, 'paged_query')
-    def test_paged_query_or_search(self, query, search, tsearch):
+    def test_paged_query_or_search(self, query, search, tsearch, AccessFilter):
         app_cfg, user = mock.Mock(), mock.Mock()
         mongo_query = 'mongo query'
         solr_query = 'solr query'
@@ -349,6 +448,8 @@ def test_paged_query_or_search(self, query, search, tsearch):
         query.assert_called_once_with(app_cfg, user, mongo_query, sort=None, limit=None, page=0, **kw)
         assert_equal(tsearch.query_filter_choices.call_count, 1)
         assert_equal(tsearch.query_filter_choices.call_args[0][0], 'solr query')
+        assert_equal(tsearch.query_filter_choices.call_args[1]['fq'],
+                     AccessFilter.return_value.solr_filter.return_value)
         assert_equal(search.call_count, 0)
         query.reset_mock(), search.reset_mock(), tsearch.reset_mock()
 
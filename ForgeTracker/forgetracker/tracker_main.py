@@ -1073,12 +1073,8 @@ def ticket_comments_since(self, when=None):
     @expose('jinja:forgetracker:templates/tracker/stats.html')
     def stats(self, dates=None, **kw):
         globals = c.app.globals
-        total = TM.Ticket.query.find(
-            dict(app_config_id=c.app.config._id, deleted=False)).count()
-        open = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted=False, status={
-                                    '$in': list(globals.set_of_open_status_names)})).count()
-        closed = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted=False, status={
-                                      '$in': list(globals.set_of_closed_status_names)})).count()
+        counts = globals.ticket_counts()
+        total, open, closed = counts.total, counts.open, counts.closed
         now = datetime.utcnow()
         week = timedelta(weeks=1)
         fortnight = timedelta(weeks=2)
@@ -1452,6 +1448,7 @@ def delete(self, **kw):
         suffix = " {dt.hour}:{dt.minute}:{dt.second} {dt.day}-{dt.month}-{dt.year}".format(
             dt=datetime.utcnow())
         self.ticket.summary += suffix
+        c.app.globals.invalidate_counts()
         flash('Ticket successfully deleted')
         return dict(location='../' + str(self.ticket.ticket_num))
 
@@ -1463,6 +1460,7 @@ def undelete(self, **kw):
         self.ticket.deleted = False
         self.ticket.summary = re.sub(
             ' \d+:\d+:\d+ \d+-\d+-\d+$', '', self.ticket.summary)
+        c.app.globals.invalidate_counts()
         M.Shortlink.from_artifact(self.ticket)
         flash('Ticket successfully restored')
         return dict(location='../' + str(self.ticket.ticket_num))
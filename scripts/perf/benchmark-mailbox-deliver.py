@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+
+"""
+Benchmark Mailbox.deliver against the number of subscribers.
+
+For each subscriber count, creates that many tool-level direct mailboxes for
+a fake project and tool, then times delivering notifications to them.  Run
+within the Allura environment, e.g.:
+
+    paster script development.ini ../scripts/perf/benchmark-mailbox-deliver.py -- --subscribers 10 100 1000 10000
+
+The mailboxes are removed again afterwards.
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+import bson
+from mock import Mock
+from pylons import tmpl_context as c
+from ming.orm import mapper
+
+from allura import model as M
+from allura.lib import helpers as h
+
+
+def mailbox_collection():
+    return M.main_doc_session.db[mapper(M.Mailbox).collection.m.collection_name]
+
+
+def make_mailboxes(project_id, app_config_id, count):
+    docs = [dict(
+        user_id=bson.ObjectId(),
+        project_id=project_id,
+        app_config_id=app_config_id,
+        artifact_index_id=None,
+        topic=None,
+        is_flash=False,
+        type='direct',
+        frequency=dict(n=1, unit='day'),
+        queue=[],
+        queue_empty=True,
+        last_modified=datetime.utcnow()) for i in xrange(count)]
+    for i in xrange(0, len(docs), 1000):
+        mailbox_collection().insert(docs[i:i + 1000])
+
+
+def deliver_legacy(nid, artifact_index_id, topic):
+    '''Mailbox.deliver as it was: one update per mailbox'''
+    d = {
+        'project_id': c.project._id,
+        'app_config_id': c.app.config._id,
+        'artifact_index_id': {'$in': [None, artifact_index_id]},
+        'topic': {'$in': [None, topic]}
+    }
+    for mbox in M.Mailbox.query.find(d).all():
+        mbox.query.update(
+            {'$push': dict(queue=nid),
+             '$set': dict(last_modified=datetime.utcnow(),
+                          queue_empty=False),
+             })
+        M.main_orm_session.expunge(mbox)
+
+
+def main(opts):
+    modes = [('bulk', M.Mailbox.deliver)]
+    if opts.compare:
+        modes.append(('legacy', deliver_legacy))
+    for count in opts.subscribers:
+        project = Mock(_id=bson.ObjectId())
+        app = Mock()
+        app.config._id = bson.ObjectId()
+        make_mailboxes(project._id, app.config._id, count)
+        try:
+            with h.push_config(c, project=project, app=app):
+                for name, deliver in modes:
+                    start = time.time()
+                    for i in xrange(opts.notifications):
+                        deliver('benchmark-%d' % i, 'Artifact#1', None)
+                    elapsed = (time.time() - start) / opts.notifications
+                    print '%-8s %6d subscribers: %8.2fms per notification' % (
+                        name, count, elapsed * 1000)
+        finally:
+            mailbox_collection().remove(dict(project_id=project._id))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscribers', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000],
+                        help='Subscriber counts to time delivery for')
+    parser.add_argument('--notifications', type=int, default=10,
+                        help='Notifications delivered per subscriber count')
+    parser.add_argument('--compare', action='store_true',
+                        help='Also time the per-mailbox (non-bulk) delivery')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
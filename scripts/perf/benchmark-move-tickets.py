@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+
+"""
+Benchmark moving tickets between trackers.
+
+Installs two temporary trackers in a project, creates --tickets tickets with
+--comments comments each in the first one, and times moving them all to the
+second one with Ticket.move_many (as the mass move of Globals.move_tickets
+does).  Run within the Allura environment, e.g.:
+
+    paster script development.ini ../scripts/perf/benchmark-move-tickets.py -- --tickets 10000
+
+Use --compare to also time moving the same number of tickets one by one with
+Ticket.move.  The trackers are uninstalled again afterwards.
+"""
+
+import argparse
+import time
+
+from pylons import tmpl_context as c
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib import helpers as h
+from forgetracker import model as TM
+
+
+def make_tickets(app, count, comments):
+    tickets = []
+    with h.push_context(app.project._id, app_config_id=app.config._id):
+        ticket_nums = app.globals.reserve_ticket_nums(count)
+        for ticket_num in ticket_nums:
+            tickets.append(TM.Ticket(
+                ticket_num=ticket_num,
+                summary='Benchmark ticket %d' % ticket_num,
+                description='Benchmark ' * 50,
+                reported_by_id=c.user._id))
+        TM.Ticket.insert_many(tickets)
+        for i in xrange(comments):
+            M.Thread.post_many([(t.discussion_thread, 'Benchmark comment %d' % i)
+                                for t in tickets])
+        ThreadLocalORMSession.flush_all()
+    return tickets
+
+
+def move_bulk(tickets, app_config):
+    TM.Ticket.move_many(tickets, app_config)
+
+
+def move_legacy(tickets, app_config):
+    for ticket in tickets:
+        ticket.move(app_config, notify=False)
+
+
+def main(opts):
+    modes = [('bulk', move_bulk)]
+    if opts.compare:
+        modes.append(('legacy', move_legacy))
+    project = M.Project.query.get(shortname=opts.project, deleted=False)
+    user = M.User.by_username(opts.user)
+    with h.push_config(c, project=project, user=user):
+        for name, move in modes:
+            source = project.install_app('Tickets', 'benchmark-%s-from' % name)
+            destination = project.install_app('Tickets', 'benchmark-%s-to' % name)
+            ThreadLocalORMSession.flush_all()
+            try:
+                tickets = make_tickets(source, opts.tickets, opts.comments)
+                start = time.time()
+                move(tickets, destination.config)
+                ThreadLocalORMSession.flush_all()
+                elapsed = time.time() - start
+                print '%-8s %6d tickets: %8.2fs, %8.1f tickets/s' % (
+                    name, opts.tickets, elapsed, opts.tickets / elapsed)
+            finally:
+                for app in (source, destination):
+                    project.uninstall_app(app.config.options.mount_point)
+                ThreadLocalORMSession.flush_all()
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tickets', type=int, default=10000,
+                        help='Tickets moved by each mode')
+    parser.add_argument('--comments', type=int, default=1,
+                        help='Comments on each ticket')
+    parser.add_argument('--project', default='test',
+                        help='Shortname of the project to install the trackers in')
+    parser.add_argument('--user', default='test-admin',
+                        help='Username of an admin of the project')
+    parser.add_argument('--compare', action='store_true',
+                        help='Also time moving the tickets one by one')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Benchmark the repository refresh on a synthetic git repository.
+
+Creates a git repository with --commits commits (each touching a few files
+spread over a directory tree), then times refreshing its commits into mongo,
+reporting commits per second.  Run within the Allura environment, e.g.:
+
+    paster script development.ini ../scripts/perf/benchmark-refresh.py -- --commits 5000
+
+This writes repo_ci, repo_tree, repo_trees, artifact_reference and shortlink
+documents to the configured database, and removes them again afterwards
+unless --keep is given.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import bson
+import tg
+from mock import Mock
+
+from allura.lib import helpers as h
+from allura.lib import utils
+from allura.model import repo_refresh
+from allura.model.repository import CommitDoc, TreeDoc, TreesDoc
+from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
+from forgegit.model.git_repo import GitImplementation
+
+
+def make_repo(path, commits, dirs, files):
+    '''Create a git repository at path with a linear history of ``commits``
+    commits, each modifying ``files`` files somewhere in ``dirs`` directories.
+    Uses git fast-import, so even large repositories are created quickly.'''
+    subprocess.check_call(['git', 'init', '--bare', '-q', path])
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                            cwd=path, stdin=subprocess.PIPE)
+    w = proc.stdin.write
+    for i in xrange(commits):
+        message = 'Commit %d\n' % i
+        w('commit refs/heads/master\n')
+        w('committer Bench <bench@example.com> %d +0000\n' % (1400000000 + i))
+        w('data %d\n%s\n' % (len(message), message))
+        for j in xrange(files):
+            n = (i * files + j) % (dirs * 10)
+            content = 'file %d, version %d\n' % (n, i)
+            w('M 644 inline dir%d/sub%d/file%d.txt\n' % (n % dirs, n % 3, n))
+            w('data %d\n%s\n' % (len(content), content))
+    proc.stdin.close()
+    if proc.wait():
+        raise Exception('git fast-import failed')
+
+
+def fake_repo(path):
+    repo = Mock(_id=bson.ObjectId(), full_fs_path=path,
+                _refresh_precompute=True, _refresh_bulk=True)
+    repo.app.config.project_id = bson.ObjectId()
+    repo.app.config._id = bson.ObjectId()
+    repo.shorthand_for_commit = lambda oid: '[%s]' % oid[:6]
+    repo.url_for_commit = lambda oid: '/p/bench/code/ci/%s/' % oid
+    repo._impl = GitImplementation(repo)
+    return repo
+
+
+def refresh_legacy(repo, commit_ids):
+    '''The per-commit refresh, as done for SCMs without bulk support'''
+    seen = set()
+    for oid in commit_ids:
+        repo._impl.refresh_commit_info(oid, seen, True)
+    repo_refresh.refresh_commit_repos(commit_ids, repo)
+    for oid in commit_ids:
+        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
+        repo_refresh.refresh_children(ci)
+    cache = {}
+    for oid in commit_ids:
+        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
+        cache = repo_refresh.refresh_commit_trees(ci, cache)
+
+
+def refresh_bulk(repo, commit_ids):
+    repo_refresh.refresh_commits_bulk(repo, commit_ids)
+
+
+def refresh_bulk_gitpython(repo, commit_ids):
+    with h.push_config(tg.config, **{'scm.git.refresh_backend': 'gitpython'}):
+        repo_refresh.refresh_commits_bulk(repo, commit_ids)
+
+
+def cleanup(repo, commit_ids):
+    tree_ids = set()
+    for chunk in utils.chunked_list(commit_ids, 1000):
+        for doc in TreesDoc.m.find(dict(_id={'$in': chunk})):
+            tree_ids.update(doc.tree_ids)
+        CommitDoc.m.remove(dict(_id={'$in': chunk}))
+        TreesDoc.m.remove(dict(_id={'$in': chunk}))
+    for chunk in utils.chunked_list(list(tree_ids), 1000):
+        TreeDoc.m.remove(dict(_id={'$in': chunk}))
+    ArtifactReferenceDoc.m.remove(
+        {'artifact_reference.project_id': repo.app.config.project_id})
+    ShortlinkDoc.m.remove(dict(project_id=repo.app.config.project_id))
+
+
+def main(opts):
+    tmpdir = tempfile.mkdtemp(prefix='allura-bench-')
+    try:
+        path = os.path.join(tmpdir, 'bench.git')
+        print 'Creating repository with %d commits...' % opts.commits
+        make_repo(path, opts.commits, opts.dirs, opts.files)
+        modes = [('bulk', refresh_bulk)]
+        if opts.compare:
+            modes.append(('gitpython', refresh_bulk_gitpython))
+            modes.append(('legacy', refresh_legacy))
+        for name, func in modes:
+            repo = fake_repo(path)
+            commit_ids = list(reversed(list(repo._impl.all_commit_ids())))
+            start = time.time()
+            func(repo, commit_ids)
+            elapsed = time.time() - start
+            print '%-10s %6d commits in %8.2fs: %8.1f commits/s' % (
+                name, len(commit_ids), elapsed, len(commit_ids) / elapsed)
+            if not opts.keep:
+                cleanup(repo, commit_ids)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--commits', type=int, default=2000,
+                        help='Number of commits in the synthetic repository')
+    parser.add_argument('--dirs', type=int, default=20,
+                        help='Number of top-level directories')
+    parser.add_argument('--files', type=int, default=3,
+                        help='Number of files modified by each commit')
+    parser.add_argument('--compare', action='store_true',
+                        help='Also time the GitPython bulk and per-commit (non-bulk) refresh')
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't remove the refreshed documents afterwards")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+
+"""
+Benchmark sending mail through allura.lib.mail_util.
+
+Sends a number of messages to a local stand-in SMTP server, the MailServer of
+the bundled `paster smtp_server` command run in a thread (which accepts and
+discards the messages instead of routing them to taskd), and times:
+
+  connect   a new connection per message, as sendmail tasks used to
+  session   one persistent SMTPClient session
+  pool      an SMTPSenderPool of --concurrency sessions
+
+Run within the Allura environment, e.g.:
+
+    paster script development.ini ../scripts/perf/benchmark-smtp.py -- --messages 1000
+
+Use --server to send to an already running `paster smtp_server` instead (its
+messages are routed to taskd as usual).
+"""
+
+import argparse
+import asyncore
+import time
+from threading import Thread
+
+import tg
+
+from allura.command.smtp_server import MailServer
+from allura.lib import helpers as h
+from allura.lib import mail_util
+
+
+class DiscardingMailServer(MailServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        pass
+
+
+def start_server():
+    server = DiscardingMailServer(('127.0.0.1', 0), None)
+    t = Thread(target=asyncore.loop, kwargs=dict(timeout=0.1))
+    t.daemon = True
+    t.start()
+    return server.socket.getsockname()
+
+
+def message(i):
+    return dict(
+        addrs=['benchmark-%d@localhost' % i],
+        fromaddr='benchmark@localhost',
+        reply_to='benchmark@localhost',
+        subject='Benchmark message %d' % i,
+        message_id='benchmark-%d@localhost' % i,
+        in_reply_to=None,
+        message=mail_util.encode_email_part(u'Benchmark ' * 50, 'plain'))
+
+
+def send_connect(count, opts):
+    for i in xrange(count):
+        client = mail_util.SMTPClient()
+        client.sendmail(**message(i))
+        client.close()
+
+
+def send_session(count, opts):
+    client = mail_util.SMTPClient()
+    client.send_batch(message(i) for i in xrange(count))
+    client.close()
+
+
+def send_pool(count, opts):
+    pool = mail_util.SMTPSenderPool(opts.concurrency)
+    for i in xrange(count):
+        pool.submit([message(i)])
+    pool.join()
+
+
+MODES = [('connect', send_connect), ('session', send_session),
+         ('pool', send_pool)]
+
+
+def main(opts):
+    if opts.server:
+        host, port = opts.server.rsplit(':', 1)
+    else:
+        host, port = start_server()
+    with h.push_config(tg.config, smtp_server=host, smtp_port=str(port),
+                       smtp_ssl='false', smtp_tls='false', smtp_user=''):
+        for name, send in MODES:
+            if opts.modes and name not in opts.modes:
+                continue
+            start = time.time()
+            send(opts.messages, opts)
+            elapsed = time.time() - start
+            print '%-8s %6d messages: %8.2fs, %8.1f messages/s' % (
+                name, opts.messages, elapsed, opts.messages / elapsed)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='Messages sent by each mode')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Sessions used by the pool mode')
+    parser.add_argument('--modes', nargs='+',
+                        choices=[name for name, send in MODES],
+                        help='Modes to time (default all)')
+    parser.add_argument('--server', metavar='HOST:PORT',
+                        help='Send to this SMTP server instead of a local stand-in')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())